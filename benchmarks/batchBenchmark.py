@@ -0,0 +1,178 @@
+"""Write batching benchmark.
+
+A control loop sends COMMANDS messages per tick, TICKS ticks at 200 Hz,
+through every transport to local stand-in robots: a TCP server counting
+received lines (Bluetooth RFCOMM sockets are replaced with TCP sockets,
+serial ports are reached through pyserial's socket:// URL) and an HTTP
+server counting action requests (WiFi). Each run is done writing every
+message (one syscall or request each) and with a WriteBatcher set, and the
+write syscalls or HTTP requests made, messages received by the robot and
+time spent sending per tick are reported.
+
+Usage: python batchBenchmark.py [TICKS] [COMMANDS] [WINDOW_US]
+"""
+
+import http.server
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import types
+import urllib.parse
+
+import serial
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import bluetoothManager, serialManager  # noqa: E402
+from pyBittle import wifiManager, writeBatcher  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+PERIOD = 0.005  # Control loop tick (seconds)
+TICK = ("kwk", "i 0 30 1 -20", "kbalance", "F", "m 8 40", "d")
+
+
+class LineRobot(socketserver.StreamRequestHandler):
+    """Stand-in robot: prints its boot banner and counts received lines.
+    """
+
+    def handle(self):
+        self.wfile.write(b"Init\r\nFinished!\r\n\r\n")
+        for line in self.rfile:
+            self.server.received += 1
+
+
+class HttpRobot(http.server.BaseHTTPRequestHandler):
+    """Stand-in WiFi robot: counts action requests and the messages in
+    them.
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/action":
+            name = urllib.parse.parse_qs(url.query)['name'][0]
+            self.server.requests += 1
+            self.server.received += len(name.splitlines())
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingPort:
+    """Forwards to a socket or serial port, counting write calls.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.writes = 0
+
+    def send(self, data):
+        self.writes += 1
+        return self.target.send(data)
+
+    def write(self, data):
+        self.writes += 1
+        return self.target.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+class TcpRfcommSocket(socket.socket):
+    """RFCOMM socket stand-in: connect((address, port)) reaches the robot
+    over TCP.
+    """
+
+    def __init__(self, protocol=None):
+        super().__init__(socket.AF_INET, socket.SOCK_STREAM)
+
+
+def start_servers():
+    line_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                  LineRobot)
+    http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  HttpRobot)
+    for server in (line_server, http_server):
+        server.daemon_threads = True
+        server.received = server.requests = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return line_server, http_server
+
+
+def open_manager(transport, line_server, http_server):
+    """Returns a connected manager and the counter of its writes.
+    """
+    if transport == 'bluetooth':
+        manager = bluetoothManager.BluetoothManager()
+        manager.address, manager.port = line_server.server_address
+        manager.socket = CountingPort(manager.socket)
+        manager.connect()
+        return manager, manager.socket
+    elif transport == 'serial':
+        manager = serialManager.SerialManager()
+        host, port = line_server.server_address
+        manager.serial = CountingPort(
+            serial.serial_for_url(f"socket://{host}:{port}"))
+        return manager, manager.serial
+    manager = wifiManager.WifiManager()
+    host, port = http_server.server_address
+    manager.ip = host
+    manager._http_address = f"http://{host}:{port}/"  # Not on port 80
+    return manager, None
+
+
+def run(transport, batched, ticks, commands, window, servers):
+    """Runs the control loop, returns (writes, messages received, mean
+    seconds sending per tick).
+    """
+    line_server, http_server = servers
+    manager, counter = open_manager(transport, *servers)
+    if batched:
+        manager.write_batcher = writeBatcher.WriteBatcher(window)
+    line_server.received = http_server.received = http_server.requests = 0
+    messages = [TICK[number % len(TICK)] + "\n"
+                for number in range(commands)]
+    sending = 0.0
+    for _ in range(ticks):
+        start = time.perf_counter()
+        for msg in messages:
+            manager.send_msg(msg)
+        sending += time.perf_counter() - start
+        time.sleep(PERIOD)
+    manager.close()
+    server = http_server if transport == 'wifi' else line_server
+    deadline = time.monotonic() + 5
+    while server.received < ticks * commands and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writes = http_server.requests if counter is None else counter.writes
+    return writes, server.received, sending / ticks
+
+
+if __name__ == "__main__":
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    commands = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    window = float(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    bluetoothManager.bluetooth = types.SimpleNamespace(
+        RFCOMM=None, BluetoothSocket=TcpRfcommSocket)
+    servers = start_servers()
+    print(f"{ticks} ticks, {commands} commands per tick, {window:g} us "
+          f"window")
+    print(f"{'transport':<10} {'mode':<8} {'writes':>7} {'received':>9} "
+          f"{'per tick (ms)':>14}")
+    for transport in ('bluetooth', 'serial', 'wifi'):
+        for batched in (False, True):
+            writes, received, per_tick = run(transport, batched, ticks,
+                                             commands, window, servers)
+            print(f"{transport:<10} {'batched' if batched else 'single':<8} "
+                  f"{writes:>7} {received:>9} {per_tick * 1000:>14.3f}")
+    for server in servers:
+        server.shutdown()
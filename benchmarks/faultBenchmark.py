@@ -0,0 +1,108 @@
+"""Degraded link benchmark.
+
+A Bittle exchanges messages with a local stand-in robot (a TCP server
+echoing every line, reached through pyserial's socket:// URL) over a serial
+link degraded by each of pyBittle.faultInjection's profiles. Throughput,
+correct, corrupted and lost replies, and recovery time after injected
+disconnections (from the first failed operation to the next correct echo)
+are reported. Runs with the same SEED inject the same faults.
+
+Usage: python faultBenchmark.py [MESSAGES] [SEED]
+"""
+
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import serial
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import bittleManager, faultInjection  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+RECV_TIMEOUT = 0.2
+
+
+class EchoRobot(socketserver.StreamRequestHandler):
+    """Stand-in robot: echoes every received line.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write(line)
+
+
+def start_robot():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), EchoRobot)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def robot_bittle(server):
+    bittle = bittleManager.Bittle()
+    host, port = server.server_address
+    bittle.serialManager.serial = serial.serial_for_url(
+        f"socket://{host}:{port}", timeout=RECV_TIMEOUT)
+    return bittle
+
+
+def run(bittle, messages):
+    """Sends messages waiting for their echo; returns (elapsed seconds,
+    correct, corrupted, lost replies, recovery times).
+    """
+    correct = corrupted = lost = 0
+    recoveries = []
+    failed_at = None
+    start = time.perf_counter()
+    for number in range(messages):
+        msg = f"k{number}\n"
+        try:
+            bittle.send_msg_serial(msg, force=True)
+            reply = bittle.receive_msg_serial()
+        except serial.SerialException:
+            if failed_at is None:
+                failed_at = time.perf_counter()
+            time.sleep(RECV_TIMEOUT)  # Back off while the link is down
+            continue
+        if reply == msg.encode():
+            correct += 1
+            if failed_at is not None:
+                recoveries.append(time.perf_counter() - failed_at)
+                failed_at = None
+        elif reply:
+            corrupted += 1
+            # Resynchronize: drop what is left of a reordered exchange
+            bittle.serialManager.serial.reset_input_buffer()
+        else:
+            lost += 1
+    return time.perf_counter() - start, correct, corrupted, lost, recoveries
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    server = start_robot()
+    print(f"{'profile':<10} {'msg/s':>7} {'correct':>8} {'corrupt':>8} "
+          f"{'lost':>6} {'disconn':>8} {'recovery (s)':>13}")
+    for name in faultInjection.PROFILES:
+        bittle = robot_bittle(server)
+        faults = faultInjection.inject(
+            bittle.serialManager,
+            faultInjection.FaultProfile.preset(name, seed=seed))
+        elapsed, correct, corrupted, lost, recoveries = \
+            run(bittle, messages)
+        recovery = f"{sum(recoveries) / len(recoveries):.2f}" \
+            if recoveries else "-"
+        print(f"{name:<10} {messages / elapsed:>7.1f} {correct:>8} "
+              f"{corrupted:>8} {lost:>6} {faults.stats['disconnects']:>8} "
+              f"{recovery:>13}")
+        bittle.close()
+    server.shutdown()
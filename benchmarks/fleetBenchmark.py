@@ -0,0 +1,59 @@
+"""Fleet scale benchmark using the vectorized simulator.
+
+Drive N simulated Bittles through the regular Bittle interface
+(send_movement_serial, send_command_serial) and report the time spent in
+control code and in simulation ticks.
+
+Usage: python fleetBenchmark.py [N] [TICKS]
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import bittleManager, fleetSimulator  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+directions = list(bittleManager.Direction)
+
+
+def control(bittles, tick):
+    """Example control code: every Bittle changes direction once a second.
+    """
+    if tick % 50:
+        return
+    for number, bittle in enumerate(bittles):
+        if (number + tick) % 7 == 0:
+            bittle.send_command_serial(bittleManager.Command.SIT)
+        else:
+            direction = directions[(number + tick) % len(directions)]
+            bittle.send_movement_serial(direction)
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    fleet = fleetSimulator.FleetSimulator(size, loss=0.01, seed=0)
+    bittles = fleet.robots()
+    control_time = tick_time = 0.0
+    for tick in range(ticks):
+        start = time.perf_counter()
+        control(bittles, tick)
+        middle = time.perf_counter()
+        fleet.step()
+        tick_time += time.perf_counter() - middle
+        control_time += middle - start
+    print(f"Bittles: {size}, ticks: {ticks}, simulated: {fleet.time:.1f} s")
+    print(f"Messages sent: {fleet.sent.sum()}, delivered: "
+          f"{fleet.delivered.sum()}, dropped: {fleet.dropped.sum()}")
+    print(f"Control code: {control_time:.3f} s "
+          f"({control_time / max(fleet.sent.sum(), 1) * 1e6:.2f} us/msg)")
+    print(f"Simulation: {tick_time:.3f} s "
+          f"({tick_time / ticks * 1e3:.3f} ms/tick)")
+    print(f"Moving: {fleet.moving.sum()}, mean distance from origin: "
+          f"{(fleet.x ** 2 + fleet.y ** 2).mean() ** 0.5:.2f} m")
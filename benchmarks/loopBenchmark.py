@@ -0,0 +1,138 @@
+"""Control loop benchmark.
+
+A teleop-like callback (a movement command and its reply through serial,
+plus some short-lived cyclic garbage, with a large live heap that makes full
+garbage collections slow) runs at RATE Hz for SECONDS seconds against a
+local stand-in robot (a TCP server echoing every line, reached through
+pyserial's socket:// URL):
+
+    naive       while True: callback(); time.sleep(period)
+    loop        ControlLoop, garbage collector untouched
+    loop+gc     ControlLoop, garbage collector frozen and disabled, young
+                collections run in slack time
+    loop+rt     As loop+gc, pinned to CPU 0 with SCHED_FIFO priority (only
+                applied if permitted)
+
+Achieved rate, deadline misses (ticks ending after the next tick's
+deadline), start jitter over the ideal schedule and callback duration are
+reported.
+
+Usage: python loopBenchmark.py [RATE] [SECONDS] [HEAP_OBJECTS]
+"""
+
+import gc
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import serial
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import bittleManager, controlLoop  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+class EchoRobot(socketserver.StreamRequestHandler):
+    """Stand-in robot: echoes every received line.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write(line)
+
+
+def start_robot():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), EchoRobot)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def robot_bittle(server):
+    bittle = bittleManager.Bittle()
+    host, port = server.server_address
+    bittle.serialManager.serial = serial.serial_for_url(
+        f"socket://{host}:{port}", timeout=1)
+    return bittle
+
+
+STARTS = []  # Start time of every tick of the current run
+
+
+def teleop(bittle, tick):
+    """Sends a movement and waits for its echo, leaving cyclic garbage.
+    """
+    STARTS.append(time.perf_counter())
+    direction = bittleManager.Direction.FORWARD if tick % 2 else \
+        bittleManager.Direction.FORWARDLEFT
+    message = bittleManager.movement_msg(bittle.gait, direction)
+    bittle.send_msg_serial(message + "\n", force=True)  # Echoed back
+    bittle.receive_msg_serial()
+    for _ in range(50):
+        node = {'tick': tick}
+        node['self'] = node
+
+
+def naive(bittle, ticks, period):
+    """Runs the callback with a sleep per tick, measuring it as ControlLoop
+    does against the ideal schedule.
+    """
+    durations = controlLoop.TimeHistogram()
+    jitter = controlLoop.TimeHistogram()
+    misses = 0
+    start = time.perf_counter()
+    for tick in range(ticks):
+        begin = time.perf_counter()
+        jitter.record(max(begin - (start + tick * period), 0.0))
+        teleop(bittle, tick)
+        end = time.perf_counter()
+        durations.record(end - begin)
+        if end > start + (tick + 1) * period:
+            misses += 1
+        time.sleep(period)
+    return misses, jitter, durations
+
+
+def row(name, misses, jitter, durations):
+    """Prints a run's measurements, its rate from its ticks' start times.
+    """
+    rate = (len(STARTS) - 1) / (STARTS[-1] - STARTS[0])
+    STARTS.clear()
+    jitter = jitter.summary()
+    durations = durations.summary()
+    print(f"{name:<8} {rate:>8.1f} {misses:>7} "
+          f"{jitter['p99'] * 1000:>9.3f} {jitter['max'] * 1000:>9.3f} "
+          f"{durations['p99'] * 1000:>9.3f} {durations['max'] * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    heap_objects = int(sys.argv[3]) if len(sys.argv) > 3 else 300000
+
+    heap = [[number] for number in range(heap_objects)]  # Live state
+    server = start_robot()
+    bittle = robot_bittle(server)
+    ticks = int(rate * seconds)
+    print(f"{rate:g} Hz, {ticks} ticks, {heap_objects} live objects")
+    print(f"{'loop':<8} {'rate Hz':>8} {'misses':>7} {'jit p99':>9} "
+          f"{'jit max':>9} {'dur p99':>9} {'dur max':>9}  (ms)")
+    row('naive', *naive(bittle, ticks, 1.0 / rate))
+    for name, options in (
+            ('loop', {'gc_mode': None}),
+            ('loop+gc', {'gc_mode': 'freeze', 'gc_slack': 0.5 / rate}),
+            ('loop+rt', {'gc_mode': 'freeze', 'gc_slack': 0.5 / rate,
+                         'cpu': 0, 'priority': 50})):
+        gc.collect()
+        loop = controlLoop.ControlLoop(bittle, teleop, rate, **options)
+        loop.run(ticks)
+        row(name, loop.overruns.count, loop.jitter, loop.durations)
+        if name == 'loop+rt':
+            print(f"pinned: {loop.pinned}, realtime: {loop.realtime}")
+    bittle.close()
+    server.shutdown()
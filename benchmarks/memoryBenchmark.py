@@ -0,0 +1,57 @@
+"""Memory benchmark comparing Bittle and CompactBittle instances.
+
+Create N instances of each class and report the memory allocated per
+instance (measured with tracemalloc). CompactBittle instances are measured
+both bare and with a serial manager attached.
+
+Usage: python memoryBenchmark.py [N]
+"""
+
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import bittleManager  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+def measure(factory, count):
+    """Returns allocated bytes per instance created by factory.
+
+    Parameters:
+            factory (callable) : Returns a new instance.
+            count (int) : Number of instances to create.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    instances = [factory() for _ in range(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del instances
+    return (current - start) / count
+
+
+def compact_with_serial():
+    bittle = bittleManager.CompactBittle()
+    bittle.serialManager  # Attach manager
+    return bittle
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    results = [
+        ("Bittle", measure(bittleManager.Bittle, count)),
+        ("CompactBittle", measure(bittleManager.CompactBittle, count)),
+        ("CompactBittle + serial", measure(compact_with_serial, count)),
+    ]
+    reference = results[0][1]
+    print(f"Instances: {count}")
+    for name, size in results:
+        print(f"{name:<24} {size:>10.0f} bytes/instance "
+              f"({size / reference:.1%} of Bittle)")
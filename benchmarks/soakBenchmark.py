@@ -0,0 +1,248 @@
+"""Connection churn soak test.
+
+Runs thousands of connect/send/recv/disconnect cycles of BluetoothManager
+and SerialManager against a local stand-in robot (a TCP server running in a
+child process, so its sockets are not counted) and tracks open file
+descriptors, RSS and tracemalloc snapshots over time. Every FAIL_EVERY-th
+connection the robot hangs up before its boot banner, exercising the failed
+connect() path.
+
+Two lifecycles are tested per transport: 'reuse' (one long-lived manager
+reconnecting, as long-running controllers do) and 'fresh' (a new manager
+per cycle, used as a context manager). Bluetooth RFCOMM sockets are
+replaced with TCP sockets, serial ports are reached through pyserial's
+socket:// URL; the managers' own connect() and close() are exercised.
+
+Unclosed sockets reaching the garbage collector are counted through
+ResourceWarning. Exits with status 1 if descriptors or traced memory grow,
+or a resource was left to the garbage collector.
+
+Serial runs default to fewer cycles: closing a socket:// port takes 0.3 s.
+
+Usage: python soakBenchmark.py [CYCLES] [SERIAL_CYCLES] [FAIL_EVERY]
+"""
+
+import gc
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import time
+import tracemalloc
+import types
+import warnings
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import bluetoothManager, serialManager  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+SAMPLES = 10  # Measurements per run
+BOOT_TIME = 0.005
+FD_TOLERANCE = 2
+MEMORY_TOLERANCE = 256 * 1024  # Traced bytes
+
+
+class BootingRobot(socketserver.StreamRequestHandler):
+    """Stand-in robot: boots (pyserial flushes input when opening a port),
+    prints its banner and echoes every line. Every server.fail_every-th
+    connection is closed before the banner.
+    """
+
+    def handle(self):
+        self.server.connections += 1
+        if self.server.fail_every and \
+                self.server.connections % self.server.fail_every == 0:
+            return
+        time.sleep(BOOT_TIME)
+        self.wfile.write(b"Init\r\nFinished!\r\n\r\n")
+        for line in self.rfile:
+            self.wfile.write(line)
+
+
+def serve(ports, fail_every):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), BootingRobot)
+    server.daemon_threads = True
+    server.connections = 0
+    server.fail_every = fail_every
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_robot(fail_every):
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve,
+                                      args=(ports, fail_every), daemon=True)
+    process.start()
+    return process, ports.get()
+
+
+class TcpRfcommSocket(socket.socket):
+    """RFCOMM socket stand-in: connect((address, port)) reaches the robot
+    over TCP.
+    """
+
+    def __init__(self, protocol=None):
+        super().__init__(socket.AF_INET, socket.SOCK_STREAM)
+
+
+def open_fds():
+    """Returns the number of open file descriptors, None if unknown.
+    """
+    for path in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            pass
+    return None
+
+
+def rss():
+    """Returns the resident set size (bytes), None if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def bluetooth_manager(port):
+    manager = bluetoothManager.BluetoothManager()
+    manager.address = '127.0.0.1'
+    manager.port = port
+    manager.recv_timeout = 2
+    return manager
+
+
+def serial_manager(port):
+    manager = serialManager.SerialManager()
+    manager.serial = serialManager.serial.serial_for_url(
+        f"socket://127.0.0.1:{port}", do_not_open=True)
+    manager.port = f"socket://127.0.0.1:{port}"
+    manager.timeout = 2
+    manager.initialize()
+    return manager
+
+
+def connect(manager):
+    """Returns True if connected; a hang up before the banner is a refused
+    connection (socket:// ports raise SerialException, an OSError).
+    """
+    try:
+        return manager.connect()
+    except OSError:
+        return False
+
+
+def exchange(manager, transport, msg):
+    """Sends msg and returns True if it is echoed.
+    """
+    manager.send_msg(msg)
+    recv = manager.recv_line if transport == 'bluetooth' else \
+        manager.recv_msg
+    for _ in range(3):  # Skip the banner's trailing blank line
+        line = recv()
+        if line.strip():
+            return line.strip() == msg.strip().encode()
+    return False
+
+
+def soak(transport, lifecycle, port, cycles):
+    """Runs connection cycles, returns (samples, echo failures, refused
+    connections, first and last tracemalloc snapshots).
+    """
+    create = bluetooth_manager if transport == 'bluetooth' else \
+        serial_manager
+    manager = create(port) if lifecycle == 'reuse' else None
+    samples = []
+    failures = refused = 0
+    every = max(cycles // SAMPLES, 1)
+    first = None
+    for cycle in range(1, cycles + 1):
+        if lifecycle == 'reuse':
+            if connect(manager):
+                failures += not exchange(manager, transport, f"k{cycle}\n")
+            else:
+                refused += 1
+            manager.close_connection()
+        else:
+            with create(port) as fresh:
+                if connect(fresh):
+                    failures += not exchange(fresh, transport,
+                                             f"k{cycle}\n")
+                else:
+                    refused += 1
+        if cycle % every == 0:
+            gc.collect()
+            samples.append((cycle, open_fds(), rss(),
+                            tracemalloc.get_traced_memory()[0]))
+            if first is None:  # Baseline after warm up
+                first = tracemalloc.take_snapshot()
+    if manager is not None:
+        manager.close()
+    gc.collect()
+    return samples, failures, refused, first, tracemalloc.take_snapshot()
+
+
+def growth(samples, column):
+    values = [sample[column] for sample in samples]
+    if None in values or len(values) < 2:
+        return None
+    return values[-1] - values[0]
+
+
+def report(transport, lifecycle, samples, failures, refused, warned,
+           first, last):
+    """Prints a run's measurements, returns True if it leaked.
+    """
+    print(f"{transport} / {lifecycle}: {samples[-1][0]} cycles, "
+          f"{refused} refused, {failures} echo failures, {warned} "
+          f"ResourceWarnings")
+    print(f"  {'cycle':>7} {'fds':>5} {'rss (KiB)':>10} "
+          f"{'traced (KiB)':>13}")
+    for cycle, fds, resident, traced in samples:
+        print(f"  {cycle:>7} {'-' if fds is None else fds:>5} "
+              f"{'-' if resident is None else resident // 1024:>10} "
+              f"{traced // 1024:>13}")
+    fds = growth(samples, 1)
+    traced = growth(samples, 3)
+    print(f"  growth: fds {fds}, traced {traced / 1024:.1f} KiB")
+    stats = [stat for stat in last.compare_to(first, 'lineno')
+             if stat.size_diff > 0][:3]
+    for stat in stats:
+        print(f"    {stat}")
+    return bool((fds or 0) > FD_TOLERANCE or traced > MEMORY_TOLERANCE or
+                warned)
+
+
+if __name__ == "__main__":
+    cycles = {'bluetooth': int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+              'serial': int(sys.argv[2]) if len(sys.argv) > 2 else 200}
+    fail_every = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    bluetoothManager.bluetooth = types.SimpleNamespace(
+        RFCOMM=None, BluetoothSocket=TcpRfcommSocket)
+    process, port = start_robot(fail_every)
+    tracemalloc.start()
+    leaked = False
+    try:
+        for transport in ('bluetooth', 'serial'):
+            for lifecycle in ('reuse', 'fresh'):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always', ResourceWarning)
+                    result = soak(transport, lifecycle, port,
+                                  cycles[transport])
+                warned = sum(issubclass(warning.category, ResourceWarning)
+                             for warning in caught)
+                leaked |= report(transport, lifecycle, *result[:3], warned,
+                                 *result[3:])
+                print()
+    finally:
+        process.terminate()
+    print("Leak detected" if leaked else "No leak detected")
+    sys.exit(1 if leaked else 0)
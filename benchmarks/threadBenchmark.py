@@ -0,0 +1,114 @@
+"""Multi-threaded producers benchmark.
+
+N producer threads share one SerialManager connected to a local stand-in
+robot (a TCP server echoing every line after a small delay, reached through
+pyserial's socket:// URL). Each producer sends messages and waits for
+their replies, first through a TransportDispatcher and then calling
+send_msg/recv_msg directly, and the number of replies routed to the wrong
+producer, throughput and lock contention are reported.
+
+Usage: python threadBenchmark.py [N] [MESSAGES_PER_THREAD] [DELAY_MS]
+"""
+
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import serial
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import serialManager, transportDispatcher  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+class EchoRobot(socketserver.StreamRequestHandler):
+    """Stand-in robot: echoes every received line after server.delay.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            time.sleep(self.server.delay)
+            self.wfile.write(line)
+
+
+def start_robot(delay):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), EchoRobot)
+    server.daemon_threads = True
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def robot_manager(server):
+    manager = serialManager.SerialManager()
+    host, port = server.server_address
+    manager.serial = serial.serial_for_url(f"socket://{host}:{port}",
+                                           timeout=0.5)
+    return manager
+
+
+def run(producers, count, produce):
+    """Runs producers threads calling produce(message); returns
+    (elapsed seconds, wrong replies).
+    """
+    wrong = [0] * producers
+
+    def producer(thread):
+        for number in range(count):
+            msg = f"k{thread}-{number}\n"
+            if produce(msg) != msg.encode():
+                wrong[thread] += 1
+
+    threads = [threading.Thread(target=producer, args=(thread,))
+               for thread in range(producers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sum(wrong)
+
+
+def report(name, producers, count, elapsed, wrong, manager):
+    total = producers * count
+    print(f"{name}: {total / elapsed:.0f} msg/s, wrong replies: {wrong} "
+          f"of {total}")
+    for lock_name in ('send_lock', 'recv_lock'):
+        stats = getattr(manager, lock_name).stats()
+        print(f"  {lock_name}: {stats['contentions']} contentions of "
+              f"{stats['acquisitions']}, wait {stats['wait_time']:.3f} s "
+              f"(max {stats['max_wait'] * 1e3:.2f} ms)")
+
+
+if __name__ == "__main__":
+    producers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    delay = float(sys.argv[3]) / 1e3 if len(sys.argv) > 3 else 0.0005
+    server = start_robot(delay)
+
+    manager = robot_manager(server)
+    # The stand-in robot echoes whole lines, match them as such
+    with transportDispatcher.TransportDispatcher(
+            manager, matcher=transportDispatcher.echo_matcher) as dispatcher:
+        elapsed, wrong = run(producers, count, dispatcher.request)
+        metrics = dispatcher.metrics()
+    report("Dispatcher", producers, count, elapsed, wrong, manager)
+    print(f"  queue wait: {metrics['queue_wait']:.3f} s (max "
+          f"{metrics['max_queue_wait'] * 1e3:.2f} ms), max depth: "
+          f"{metrics['max_queue_depth']}, mean reply: "
+          f"{metrics['mean_reply_time'] * 1e3:.3f} ms")
+
+    manager = robot_manager(server)
+
+    def direct(msg):
+        manager.send_msg(msg)
+        return manager.recv_msg()
+
+    elapsed, wrong = run(producers, count, direct)
+    report("Direct send/recv", producers, count, elapsed, wrong, manager)
+    server.shutdown()
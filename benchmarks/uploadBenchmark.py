@@ -0,0 +1,80 @@
+"""Chunked skill upload benchmark.
+
+Uploads a random behavior skill through a SerialManager connected to a local
+stand-in robot (a TCP server running skillUpload.ChunkReceiver, reached
+through pyserial's socket:// URL) which corrupts a fraction of the received
+bytes, and reports throughput, retransmissions and the chunk size reached.
+
+Usage: python uploadBenchmark.py [FRAMES] [CORRUPTION_RATE] [WINDOW]
+"""
+
+import os
+import random
+import socketserver
+import sys
+import threading
+
+import serial
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from pyBittle import serialManager, skillUpload  # noqa: E402
+
+
+__author__ = "EnriqueMoran"
+
+
+class UploadRobot(socketserver.BaseRequestHandler):
+    """Stand-in robot: reassembles chunks, corrupting received bytes with
+    probability server.corruption.
+    """
+
+    def handle(self):
+        receiver = skillUpload.ChunkReceiver()
+        self.server.receivers.append(receiver)
+        while True:
+            data = bytearray(self.request.recv(4096))
+            if not data:
+                break
+            for index in range(len(data)):
+                if random.random() < self.server.corruption:
+                    data[index] ^= 0xFF
+            for answer in receiver.feed(data):
+                self.request.sendall(answer)
+
+
+def start_robot(corruption):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), UploadRobot)
+    server.daemon_threads = True
+    server.corruption = corruption
+    server.receivers = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    corruption = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0005
+    window = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    random.seed(1)
+    skill = skillUpload.encode_skill(
+        [[random.randint(-90, 90) for _ in range(16)] + [8, 0, 0, 0]
+         for _ in range(frames)], loop=(0, frames - 1, 1))
+    server = start_robot(corruption)
+    host, port = server.server_address
+
+    for chunk_size in (None, 512):
+        manager = serialManager.SerialManager()
+        manager.serial = serial.serial_for_url(f"socket://{host}:{port}",
+                                               timeout=0.2)
+        upload = skillUpload.SkillUpload(manager, skill, window=window,
+                                         chunk_size=chunk_size)
+        initial = upload.chunk_size
+        report = upload.run()
+        received = server.receivers[-1].data()
+        print(f"Initial chunk size {initial}: {report!r}")
+        print(f"  final chunk size: {report.chunk_size}, wire bytes: "
+              f"{report.wire_bytes} for {report.size}, intact: "
+              f"{received == skill}")
+        manager.serial.close()
+    server.shutdown()
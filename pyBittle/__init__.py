@@ -1,7 +1,27 @@
 from pyBittle.bittleManager import *
 from pyBittle.bluetoothManager import *
+from pyBittle.choreography import *
+from pyBittle.controlLoop import *
+from pyBittle.eventBus import *
+from pyBittle.faultInjection import *
+from pyBittle.fleetConnector import *
+from pyBittle.fleetSync import *
+from pyBittle.flowControl import *
+from pyBittle.linkRouter import *
+from pyBittle.linkTuner import *
+from pyBittle.meteredLock import *
+from pyBittle.methodProfiler import *
+from pyBittle.receiveBuffer import *
+from pyBittle.routePlanner import *
+from pyBittle.rttEstimator import *
 from pyBittle.serialManager import *
+from pyBittle.skillUpload import *
+from pyBittle.stateCache import *
+from pyBittle.tracing import *
+from pyBittle.transportDispatcher import *
+from pyBittle.wifiHealth import *
 from pyBittle.wifiManager import *
+from pyBittle.writeBatcher import *
 
 __author__ = "EnriqueMoran"
 
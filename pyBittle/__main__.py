@@ -0,0 +1,111 @@
+"""Command line interface for scripted Bittle sessions.
+
+Connects to Bittle through the chosen transport, streams the commands of a
+script file (or stdin) and prints a throughput/latency summary at the end.
+See pyBittle.batchRunner for the script format.
+
+Usage examples:
+
+    python -m pyBittle --transport serial routine.txt
+    echo "ack on\nrepeat 50\nSIT\nREST\nend" | python -m pyBittle -t bluetooth
+    python -m pyBittle -t wifi --ip 192.168.1.241 soak.txt
+"""
+
+import argparse
+import sys
+
+from pyBittle.batchRunner import TRANSPORTS, BatchRunner, parse_script
+from pyBittle.bittleManager import Bittle
+
+
+__author__ = "EnriqueMoran"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pyBittle",
+        description="Stream a command script to Bittle and print a "
+                    "throughput/latency summary.")
+    parser.add_argument('script', nargs='?', default='-',
+                        help="script file, '-' or omitted for stdin")
+    parser.add_argument('-t', '--transport', choices=TRANSPORTS,
+                        default='serial', help="connection (default: serial)")
+    parser.add_argument('--name', help="Bluetooth device name, first Bittle "
+                                       "found if omitted")
+    parser.add_argument('--port', help="serial port, discovered if omitted")
+    parser.add_argument('--ip', help="Bittle IP address (WiFi)")
+    parser.add_argument('--ack', action='store_true',
+                        help="wait for Bittle's reply after each message")
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help="maximum messages per second (default: no "
+                             "limit)")
+    return parser.parse_args(argv)
+
+
+def connect(bittle, args):
+    """Connects bittle through args.transport, returns True if connected.
+    """
+    if args.transport == 'bluetooth':
+        if args.name:
+            bittle.bluetoothManager.name = args.name
+        return bittle.connect_bluetooth(get_first_bittle=not args.name)
+    elif args.transport == 'serial':
+        if args.port:
+            bittle.serialManager.port = args.port
+        return bittle.connect_serial(discover_port=not args.port)
+    else:
+        if not args.ip:
+            raise ValueError("--ip is required for WiFi transport.")
+        bittle.wifiManager.ip = args.ip
+        return bittle.has_wifi_connection()
+
+
+def disconnect(bittle, transport):
+    if transport == 'bluetooth':
+        bittle.disconnect_bluetooth()
+    elif transport == 'serial':
+        bittle.disconnect_serial()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.script == '-':
+            steps = parse_script(sys.stdin)
+        else:
+            with open(args.script) as script:
+                steps = parse_script(script)
+    except (OSError, ValueError) as err:
+        print(f"Error: {err!s}", file=sys.stderr)
+        return 2
+
+    bittle = Bittle()
+    try:
+        connected = connect(bittle, args)
+    except (OSError, TypeError, ValueError) as err:  # SerialException...
+        print(f"Error: {err!s}", file=sys.stderr)
+        return 2
+    if not connected:
+        print(f"Can't connect to Bittle through {args.transport}.",
+              file=sys.stderr)
+        return 1
+
+    runner = BatchRunner(bittle, args.transport)
+    runner.ack = args.ack
+    runner.rate = args.rate
+    status = 0
+    try:
+        runner.run(steps)
+    except KeyboardInterrupt:
+        print("Interrupted.", file=sys.stderr)
+    except OSError as err:  # SerialException, socket and HTTP errors
+        print(f"Error: {err!s}", file=sys.stderr)
+        status = 1
+    finally:
+        disconnect(bittle, args.transport)
+    print(runner.summary())
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""This module runs scripted command sessions.
+
+BatchRunner parses command scripts and streams them to Bittle through a
+chosen transport, pacing and ack-gating them as requested, and summarizes
+throughput and latency at the end. It backs the `python -m pyBittle`
+command line interface.
+
+Script format, one directive per line ('#' starts a comment):
+
+    GREETING            Send a Command (command GREETING is also valid).
+    gait TROT           Set current Gait.
+    move FORWARD        Send a movement with current gait (Direction name).
+    msg kbalance        Send a custom message.
+    wait 1.5            Sleep given seconds.
+    rate 10             Send at most 10 messages per second (0 disables).
+    ack on              Wait for Bittle's reply after each message.
+    repeat 100          Repeat the following directives...
+    end                 ...until the matching end.
+"""
+
+import math
+import socket
+import time
+
+from pyBittle.bittleManager import Command, Direction, Gait
+
+
+__author__ = "EnriqueMoran"
+
+
+TRANSPORTS = ('bluetooth', 'serial', 'wifi')
+
+
+def parse_script(lines):
+    """Parses script lines into a list of steps.
+
+    Parameters:
+        lines (iterable) : Script lines.
+
+    Returns:
+        steps ([tuple]) : (directive, argument) tuples; 'repeat' steps
+        argument is a (count, steps) tuple.
+    """
+    root = []
+    blocks = [(root, 0, 0)]  # (steps, repeat count, line number)
+    for number, line in enumerate(lines, 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        directive = words[0].lower()
+        argument = words[1] if len(words) > 1 else None
+        steps = blocks[-1][0]
+        try:
+            if directive == 'end':
+                if len(blocks) == 1:
+                    raise ValueError("'end' without 'repeat'")
+                block, count, _ = blocks.pop()
+                blocks[-1][0].append(('repeat', (count, block)))
+            elif directive == 'repeat':
+                count = int(argument)
+                if count < 0:
+                    raise ValueError("repeat count must be positive")
+                blocks.append(([], count, number))
+            elif directive == 'wait':
+                wait = float(argument)
+                if not (0 <= wait < math.inf):
+                    raise ValueError("wait must be positive")
+                steps.append(('wait', wait))
+            elif directive == 'rate':
+                rate = float(argument)
+                if rate < 0:
+                    raise ValueError("rate must be positive")
+                steps.append(('rate', rate))
+            elif directive == 'ack':
+                if argument not in ('on', 'off'):
+                    raise ValueError("ack must be 'on' or 'off'")
+                steps.append(('ack', argument == 'on'))
+            elif directive == 'gait':
+                steps.append(('gait', Gait[argument.upper()]))
+            elif directive == 'move':
+                steps.append(('movement', Direction[argument.upper()]))
+            elif directive == 'msg':
+                if argument is None:
+                    raise ValueError("missing message")
+                steps.append(('msg', line.split(None, 1)[1].split('#')[0]
+                              .strip()))
+            elif directive == 'command':
+                steps.append(('command', Command[argument.upper()]))
+            else:
+                steps.append(('command', Command[words[0].upper()]))
+        except (KeyError, TypeError, ValueError, AttributeError) as err:
+            raise ValueError(f"Line {number}: invalid directive "
+                             f"'{line.strip()}' ({err!s}).") from None
+    if len(blocks) > 1:
+        raise ValueError(f"Line {blocks[-1][2]}: 'repeat' without 'end'.")
+    return root
+
+
+class BatchRunner:
+    """Streams parsed script steps to Bittle through one transport.
+
+    Attributes
+    ----------
+    bittle : Bittle
+        Bittle to send commands to.
+    transport : str
+        'bluetooth', 'serial' or 'wifi'.
+    ack : bool
+        Whether to wait for Bittle's reply after each message.
+    rate : float
+        Maximum messages per second, 0 for no limit.
+    sent : int
+        Messages sent.
+    acked : int
+        Messages replied.
+    timeouts : int
+        Messages without reply (or with WiFi error response).
+    latencies : [float]
+        Reply latency of every acked message (seconds).
+
+    Methods
+    -------
+    run(steps):
+        Executes given steps.
+    summary():
+        Returns a text summary of the session.
+    """
+
+    def __init__(self, bittle, transport):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Transport must be one of {TRANSPORTS}.")
+        self.bittle = bittle
+        self.transport = transport
+        self.ack = False
+        self.rate = 0.0
+        self.sent = 0
+        self.acked = 0
+        self.timeouts = 0
+        self.latencies = []
+        self._next_send = 0.0
+        self._start = None
+        self._end = None
+
+    def __repr__(self):
+        return f"BatchRunner - transport: {self.transport}, ack: " \
+               f"{self.ack}, rate: {self.rate}, sent: {self.sent}"
+
+    def run(self, steps):
+        """Executes given steps.
+
+        Parameters:
+            steps ([tuple]) : Steps returned by parse_script().
+        """
+        if self._start is None:
+            self._start = time.perf_counter()
+        for directive, argument in steps:
+            if directive == 'repeat':
+                count, block = argument
+                for _ in range(count):
+                    self.run(block)
+            elif directive == 'wait':
+                time.sleep(argument)
+            elif directive == 'rate':
+                self.rate = argument
+            elif directive == 'ack':
+                self.ack = argument
+            elif directive == 'gait':
+                self.bittle.gait = argument
+            else:
+                self._send(directive, argument)
+            self._end = time.perf_counter()
+
+    def _send(self, directive, argument):
+        """Sends a message honouring rate and ack settings.
+        """
+        if self.rate:
+            delay = self._next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_send = max(self._next_send, time.perf_counter()) + \
+                1 / self.rate
+        method = getattr(self.bittle, f"send_{directive}_{self.transport}")
+        start = time.perf_counter()
+        res = method(argument)
+        self.sent += 1
+        if self.transport == 'wifi':  # Reply is the response code
+            if res == 200:
+                self._acked(start)
+            else:
+                self.timeouts += 1
+        elif self.ack:
+            if self._receive():
+                self._acked(start)
+            else:
+                self.timeouts += 1
+
+    def _receive(self):
+        """Returns Bittle's reply, empty if there is none.
+        """
+        if self.transport == 'bluetooth':
+            try:
+                return self.bittle.receive_msg_bluetooth()
+            except socket.error:
+                return b''
+        return self.bittle.receive_msg_serial()
+
+    def _acked(self, start):
+        self.acked += 1
+        self.latencies.append(time.perf_counter() - start)
+
+    def summary(self):
+        """Returns a text summary of the session.
+        """
+        if self._start is None:
+            elapsed = 0.0
+        else:
+            end = time.perf_counter() if self._end is None else self._end
+            elapsed = end - self._start
+        lines = [f"Transport: {self.transport}",
+                 f"Messages sent: {self.sent}, acked: {self.acked}, "
+                 f"timeouts: {self.timeouts}",
+                 f"Elapsed: {elapsed:.3f} s, throughput: "
+                 f"{self.sent / elapsed if elapsed else 0.0:.1f} msg/s"]
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            percentiles = ', '.join(
+                f"p{p}: {percentile(latencies, p) * 1e3:.1f} ms"
+                for p in (50, 90, 99))
+            lines.append(f"Latency {percentiles}, max: "
+                         f"{latencies[-1] * 1e3:.1f} ms")
+        return "\n".join(lines)
+
+
+def percentile(values, p):
+    """Returns the p percentile (0-100) of sorted values, nearest rank.
+    """
+    if not values:
+        raise ValueError("Values must not be empty.")
+    index = min(max(math.ceil(p / 100 * len(values)) - 1, 0),
+                len(values) - 1)
+    return values[index]
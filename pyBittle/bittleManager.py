@@ -10,7 +10,10 @@ import uuid
 from enum import Enum
 
 from pyBittle.bluetoothManager import *
+from pyBittle.linkTuner import tune_serial
 from pyBittle.serialManager import *
+from pyBittle.skillUpload import upload_skill
+from pyBittle.tracing import tracer
 from pyBittle.wifiManager import *
 
 __author__ = "EnriqueMoran"
@@ -68,6 +71,23 @@ class Direction(str, Enum):
     BACKWARDRIGHT = 'BR'
 
 
+def movement_msg(gait, direction):
+    """Returns the message that moves Bittle in given direction with given
+    gait (backward directions have their own gait).
+
+    Parameters:
+        gait (Gait) : Gait to use.
+        direction (Direction) : Movement direction.
+
+    Returns:
+        msg (str) : Message to send.
+    """
+    if direction in [Direction.BACKWARD, Direction.BACKWARDLEFT,
+                     Direction.BACKWARDRIGHT]:
+        return 'kbk' + direction[1:]
+    return gait.value + direction.value
+
+
 class Bittle:
     """High level class that represents your Bittle.
 
@@ -83,6 +103,9 @@ class Bittle:
         Manager for sending messages to Bittle through Serial connection.
     gait : Gait
         Current gait.
+    stateCache : StateCache
+        If set, messages that would not change Bittle's state are skipped
+        (unless sent with force=True). None by default.
     commands : {Command: str}
         Avaliable commands that can be sent to Bittle.
 
@@ -96,8 +119,14 @@ class Bittle:
         Sends a custom message to Bittle through Bluetooth connection.
     receive_msg_bluetooth(buffer_size):
         Returns received message from Bittle through Bluetooth connection.
+    receive_view_bluetooth():
+        Returns received message from Bittle through Bluetooth connection
+        as a reusable buffer view.
     send_movement_bluetooth(direction):
         Sends a movement command to Bittle through Bluetooth connection.
+    upload_skill_bluetooth(skill):
+        Uploads a custom skill to Bittle through Bluetooth connection
+        (needs firmware implementing pyBittle.skillUpload's protocol).
     disconnect_bluetooth():
         Closes Bluetooth connection with Bittle.
     has_wifi_connection():
@@ -116,51 +145,71 @@ class Bittle:
         Sends a custom message to Bittle through Serial connection.
     receive_msg_serial(buffer_size):
         Returns received message from Bittle through Serial connection.
+    receive_view_serial():
+        Returns received message from Bittle through Serial connection
+        as a reusable buffer view.
     send_movement_serial(direction):
         Sends a movement command to Bittle through Serial connection.
+    upload_skill_serial(skill):
+        Uploads a custom skill to Bittle through Serial connection
+        (needs firmware implementing pyBittle.skillUpload's protocol).
+    tune_serial_link():
+        Probes and applies the fastest stable baud rate and a low latency
+        write timeout to the Serial connection.
     disconnect_serial():
         Closes Serial connection with Bittle.
+    close():
+        Closes every connection and releases the managers' sockets, ports
+        and pooled connections, also done when used as a context manager.
     """
 
+    _commands = {  # Command : message to Bittle, shared by all instances
+        Command.REST: 'd',
+        Command.FORWARD: 'F',
+        Command.GYRO: 'g',
+        Command.LEFT: 'L',
+        Command.BALANCE: 'kbalance',
+        Command.RIGHT: 'R',
+        Command.SHUTDOWN: 'z',
+        Command.BACKWARD: 'B',
+        Command.CALIBRATION: 'c',
+        Command.STEP: 'kvt',
+        Command.CRAWL: 'kcr',
+        Command.WALK: 'kwk',
+        Command.TROT: 'ktr',
+        Command.LOOKUP: 'klu',
+        Command.BUTTUP: 'kbuttUp',
+        Command.RUN: 'krn',
+        Command.BOUND: 'kbd',
+        Command.GREETING: 'khi',
+        Command.PUSHUP: 'kpu',
+        Command.PEE: 'kpee',
+        Command.STRETCH: 'kstr',
+        Command.SIT: 'ksit',
+        Command.ZERO: 'kzero',
+        Command.BUNNY: 'kbdF',
+        Command.BACKFLIP: 'kbf',
+        Command.SLEEP: 'kstp',
+        Command.CHECKAROUND: 'kck'
+    }
+
     def __init__(self):
         self._id = uuid.uuid4()  # Bittle's id
         self.bluetoothManager = BluetoothManager()
         self.wifiManager = WifiManager()
         self.serialManager = SerialManager()
         self._gait = Gait.WALK  # Current gait
-        self._commands = {  # Command : message to Bittle
-            Command.REST: 'd',
-            Command.FORWARD: 'F',
-            Command.GYRO: 'g',
-            Command.LEFT: 'L',
-            Command.BALANCE: 'kbalance',
-            Command.RIGHT: 'R',
-            Command.SHUTDOWN: 'z',
-            Command.BACKWARD: 'B',
-            Command.CALIBRATION: 'c',
-            Command.STEP: 'kvt',
-            Command.CRAWL: 'kcr',
-            Command.WALK: 'kwk',
-            Command.TROT: 'ktr',
-            Command.LOOKUP: 'klu',
-            Command.BUTTUP: 'kbuttUp',
-            Command.RUN: 'krn',
-            Command.BOUND: 'kbd',
-            Command.GREETING: 'khi',
-            Command.PUSHUP: 'kpu',
-            Command.PEE: 'kpee',
-            Command.STRETCH: 'kstr',
-            Command.SIT: 'ksit',
-            Command.ZERO: 'kzero',
-            Command.BUNNY: 'kbdF',
-            Command.BACKFLIP: 'kbf',
-            Command.SLEEP: 'kstp',
-            Command.CHECKAROUND: 'kck'
-        }
+        self.stateCache = None  # Optional StateCache
 
     def __eq__(self, other):
         return self._id == other._id
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __str__(self):  # TODO: Complete
         return f"Bittle with id '{self._id}' Bluetooth name: " \
                 f"'{self.bluetoothManager.name} ' MAC address: " \
@@ -179,6 +228,60 @@ class Bittle:
         else:
             raise TypeError("New gait must be Gait type.")
 
+    def _should_send(self, message, force):
+        """Returns False if self.stateCache says message is redundant.
+        """
+        return self.stateCache is None or \
+            self.stateCache.should_send(message, force)
+
+    def _observe(self, data):
+        """Feeds received data to self.stateCache.
+        """
+        if self.stateCache is not None:
+            self.stateCache.observe(data)
+        return data
+
+    def _sent(self, res):
+        """Invalidates self.stateCache unless the manager sent the message:
+        serial and Bluetooth managers return True (False if their flow
+        control dropped it), WiFi manager returns the response code (200 if
+        sent).
+        """
+        if res is not True and res != 200 and self.stateCache is not None:
+            self.stateCache.invalidate()
+
+    def _send(self, transport, message, force):
+        """Sends message through given transport's manager unless
+        self.stateCache considers it redundant, tracing it if
+        pyBittle.tracing.tracer is enabled.
+
+        Returns:
+            res : Manager's send_msg() result, None if skipped.
+        """
+        trace = tracer.begin(str(self._id), transport, message) \
+            if tracer.enabled else None
+        try:
+            send = self._should_send(message, force)
+            if trace is not None:
+                trace.lap('validate')
+            if not send:
+                return None
+            manager = getattr(self, transport + 'Manager')
+            batcher = getattr(manager, 'write_batcher', None)
+            if self.stateCache is not None and batcher is not None:
+                # Queued messages may fail after send_msg() returns
+                batcher.failure_callbacks.add(self.stateCache.invalidate)
+            try:
+                res = manager.send_msg(message)
+            except BaseException:
+                self._sent(None)  # Not sent, Bittle's state is unknown
+                raise
+            self._sent(res)
+            return res
+        finally:
+            if trace is not None:
+                tracer.detach()
+
     def connect_bluetooth(self, get_first_bittle=True):
         """Connects to Bittle.
 
@@ -197,25 +300,30 @@ class Bittle:
             res = self.bluetoothManager.connect()
         return res
 
-    def send_command_bluetooth(self, command):
+    def send_command_bluetooth(self, command, force=False):
         """Sends command to Bittle through Bluetooth connection.
 
         Parameters:
             command (Comand) : Command to send.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
         """
         if isinstance(command, Command):
-            self.bluetoothManager.send_msg(self._commands[command])
+            message = self._commands[command]
+            self._send('bluetooth', message, force)
         else:
             raise TypeError("Command type must be Command.")
 
-    def send_msg_bluetooth(self, message):
+    def send_msg_bluetooth(self, message, force=False):
         """Sends custom message to Bittle through Bluetooth connection.
 
         Parameters:
             message (str) : Message to send.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
         """
         if isinstance(message, str):
-            self.bluetoothManager.send_msg(message)
+            self._send('bluetooth', message, force)
         else:
             raise TypeError("Message type must be str.")
 
@@ -228,23 +336,47 @@ class Bittle:
         Returns:
             data (bytes) : Received data.
         """
-        return self.bluetoothManager.recv_msg(buffer_size)
+        return self._observe(self.bluetoothManager.recv_msg(buffer_size))
+
+    def receive_view_bluetooth(self):
+        """Receives a message from Bittle through Bluetooth connection
+        without allocating a new bytes object.
+
+        Returns:
+            data (memoryview) : Received data, valid until next call.
+        """
+        return self._observe(self.bluetoothManager.recv_view())
 
-    def send_movement_bluetooth(self, direction):
+    def send_movement_bluetooth(self, direction, force=False):
         """Sends movement commands with current gait through Bluetooth
         connection.
+
+        Parameters:
+            direction (Direction) : Movement direction.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
         """
         if isinstance(direction, Direction):
-            command = ''
-            if direction in [Direction.BACKWARD, Direction.BACKWARDLEFT,
-                             Direction.BACKWARDRIGHT]:
-                command = 'kbk' + direction[1:]
-            else:
-                command = self.gait.value + direction.value
-            self.send_msg_bluetooth(command)
+            command = movement_msg(self.gait, direction)
+            self.send_msg_bluetooth(command, force)
         else:
             raise TypeError("Direction must be Direction type.")
 
+    def upload_skill_bluetooth(self, skill, **kwargs):
+        """Uploads a custom skill to Bittle through Bluetooth connection, in
+        checksummed chunks (see pyBittle.skillUpload). Bittle's firmware
+        must implement the chunk protocol (as pyBittle.skillUpload's
+        ChunkReceiver does), stock OpenCat firmware does not.
+
+        Parameters:
+            skill (bytes or [[int]]) : Encoded skill or its frames.
+            kwargs : SkillUpload parameters (chunk_size, window...).
+
+        Returns:
+            report (UploadReport) : Upload statistics.
+        """
+        return upload_skill(self.bluetoothManager, skill, **kwargs)
+
     def disconnect_bluetooth(self):
         """Closes Bluetooth connection.
         """
@@ -255,48 +387,60 @@ class Bittle:
         """
         return self.wifiManager.has_connection()
 
-    def send_command_wifi(self, command):
+    def send_command_wifi(self, command, force=False):
         """Sends command to Bittle through WiFi connection.
 
         Parameters:
             command (Comand) : Command to send.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
 
         Returns:
             res (int) : REST API response code, -1 if
-            there is no connection.
+            there is no connection, None if skipped by self.stateCache,
+            True if queued in wifiManager.write_batcher.
         """
         if isinstance(command, Command):
-            return self.wifiManager.send_msg(self._commands[command])
+            message = self._commands[command]
+            return self._send('wifi', message, force)
         else:
             raise TypeError("Command type must be Command.")
 
-    def send_msg_wifi(self, message):
+    def send_msg_wifi(self, message, force=False):
         """Sends custom message to Bittle through WiFi connection.
 
         Parameters:
             message (str) : Message to send.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
 
         Returns:
             res (int) : REST API response code, -1 if
-            there is no connection.
+            there is no connection, None if skipped by self.stateCache,
+            True if queued in wifiManager.write_batcher.
         """
         if isinstance(message, str):
-            return self.wifiManager.send_msg(message)
+            return self._send('wifi', message, force)
         else:
             raise TypeError("Message type must be str.")
 
-    def send_movement_wifi(self, direction):
+    def send_movement_wifi(self, direction, force=False):
         """Sends movement commands with current gait through WiFi
         connection.
+
+        Parameters:
+            direction (Direction) : Movement direction.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
+
+        Returns:
+            res (int) : REST API response code, -1 if
+            there is no connection, None if skipped by self.stateCache,
+            True if queued in wifiManager.write_batcher.
         """
         if isinstance(direction, Direction):
-            command = ''
-            if direction in [Direction.BACKWARD, Direction.BACKWARDLEFT,
-                             Direction.BACKWARDRIGHT]:
-                command = 'kbk' + direction[1:]
-            else:
-                command = self.gait.value + direction.value
-            self.send_msg_wifi(command)
+            command = movement_msg(self.gait, direction)
+            return self.send_msg_wifi(command, force)
         else:
             raise TypeError("Direction must be Direction type.")
 
@@ -322,25 +466,30 @@ class Bittle:
         res = self.serialManager.connect()
         return res
 
-    def send_command_serial(self, command):
+    def send_command_serial(self, command, force=False):
         """Sends command to Bittle through serial connection.
 
         Parameters:
             command (Comand) : Command to send.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
         """
         if isinstance(command, Command):
-            self.serialManager.send_msg(self._commands[command])
+            message = self._commands[command]
+            self._send('serial', message, force)
         else:
             raise TypeError("Command type must be Command.")
 
-    def send_msg_serial(self, message):
+    def send_msg_serial(self, message, force=False):
         """Sends custom message to Bittle through serial connection.
 
         Parameters:
             message (str) : Message to send.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
         """
         if isinstance(message, str):
-            self.serialManager.send_msg(message)
+            self._send('serial', message, force)
         else:
             raise TypeError("Message type must be str.")
 
@@ -350,24 +499,207 @@ class Bittle:
         Returns:
             data (bytes) : Received data.
         """
-        return self.serialManager.recv_msg()
+        return self._observe(self.serialManager.recv_msg())
+
+    def receive_view_serial(self):
+        """Receives a message from Bittle through serial connection
+        without allocating a new bytes object.
 
-    def send_movement_serial(self, direction):
+        Returns:
+            data (memoryview) : Received data, valid until next call.
+        """
+        return self._observe(self.serialManager.recv_view())
+
+    def send_movement_serial(self, direction, force=False):
         """Sends movement commands with current gait through serial
         connection.
+
+        Parameters:
+            direction (Direction) : Movement direction.
+            force (bool) : If True, send it even if self.stateCache
+            considers it redundant.
         """
         if isinstance(direction, Direction):
-            command = ''
-            if direction in [Direction.BACKWARD, Direction.BACKWARDLEFT,
-                             Direction.BACKWARDRIGHT]:
-                command = 'kbk' + direction[1:]
-            else:
-                command = self.gait.value + direction.value
-            self.send_msg_serial(command)
+            command = movement_msg(self.gait, direction)
+            self.send_msg_serial(command, force)
         else:
             raise TypeError("Direction must be Direction type.")
 
+    def upload_skill_serial(self, skill, **kwargs):
+        """Uploads a custom skill to Bittle through serial connection, in
+        checksummed chunks (see pyBittle.skillUpload). Bittle's firmware
+        must implement the chunk protocol (as pyBittle.skillUpload's
+        ChunkReceiver does), stock OpenCat firmware does not.
+
+        Parameters:
+            skill (bytes or [[int]]) : Encoded skill or its frames.
+            kwargs : SkillUpload parameters (chunk_size, window...).
+
+        Returns:
+            report (UploadReport) : Upload statistics.
+        """
+        return upload_skill(self.serialManager, skill, **kwargs)
+
+    def tune_serial_link(self, **kwargs):
+        """Tunes the serial connection: fastest baud rate Bittle answers at
+        and write timeout from measured round trips, cached per device (see
+        pyBittle.linkTuner). The read timeout is kept unless reply_timeout
+        is given, as skills are echoed once performed.
+
+        Parameters:
+            kwargs : tune_serial() parameters (baudrates, use_cache...).
+
+        Returns:
+            settings (LinkSettings) : Applied settings.
+        """
+        return tune_serial(self.serialManager, **kwargs)
+
     def disconnect_serial(self):
         """Closes Serial connection.
         """
-        self.serialManager.close_connection()
\ No newline at end of file
+        self.serialManager.close_connection()
+
+    def close(self):
+        """Closes every connection and releases the managers' resources.
+        """
+        for name in ('bluetoothManager', 'wifiManager', 'serialManager'):
+            getattr(self, name).close()
+
+
+class CompactBittle:
+    """Memory compact version of Bittle, meant for large simulated fleets.
+
+    Same interface as Bittle, but instances have no __dict__, share
+    Bittle's command table and only create each manager the first time it is
+    used (managers can also be attached by assigning them).
+
+    Attributes
+    ----------
+    id : uuid.UUID
+        Bittle's unique id.
+    bluetoothManager : BluetoothManager
+        Manager for sending messages to Bittle through Bluetooth connection,
+        created on first access.
+    wifiManager : WifiManager
+        Manager for sending messages to Bittle through WiFi connection,
+        created on first access.
+    serialManager : SerialManager
+        Manager for sending messages to Bittle through Serial connection,
+        created on first access.
+    gait : Gait
+        Current gait.
+    stateCache : StateCache
+        Optional state cache, see Bittle.
+
+    Methods
+    -------
+    has_manager(name):
+        Returns True if given manager has already been attached.
+    close():
+        Closes the attached managers.
+
+    See Bittle for the rest of methods.
+    """
+
+    __slots__ = ('_id', '_gait', '_bluetoothManager', '_wifiManager',
+                 '_serialManager', 'stateCache')
+
+    _commands = Bittle._commands
+
+    def __init__(self):
+        self._id = uuid.uuid4()  # Bittle's id
+        self._gait = Gait.WALK  # Current gait
+        self._bluetoothManager = None
+        self._wifiManager = None
+        self._serialManager = None
+        self.stateCache = None  # Optional StateCache
+
+    def __str__(self):
+        return f"CompactBittle with id '{self._id}' managers: " \
+               f"{', '.join(self._attached_managers()) or 'none'}"
+
+    @property
+    def bluetoothManager(self):
+        if self._bluetoothManager is None:
+            self._bluetoothManager = BluetoothManager()
+        return self._bluetoothManager
+
+    @bluetoothManager.setter
+    def bluetoothManager(self, new_manager):
+        self._bluetoothManager = new_manager
+
+    @property
+    def wifiManager(self):
+        if self._wifiManager is None:
+            self._wifiManager = WifiManager()
+        return self._wifiManager
+
+    @wifiManager.setter
+    def wifiManager(self, new_manager):
+        self._wifiManager = new_manager
+
+    @property
+    def serialManager(self):
+        if self._serialManager is None:
+            self._serialManager = SerialManager()
+        return self._serialManager
+
+    @serialManager.setter
+    def serialManager(self, new_manager):
+        self._serialManager = new_manager
+
+    def _attached_managers(self):
+        return [name for name in ('bluetoothManager', 'wifiManager',
+                                  'serialManager')
+                if self.has_manager(name)]
+
+    def close(self):
+        """Closes the attached managers (none is created).
+        """
+        for name in self._attached_managers():
+            getattr(self, name).close()
+
+    def has_manager(self, name):
+        """Returns True if given manager has already been attached.
+
+        Parameters:
+            name (str) : 'bluetoothManager', 'wifiManager' or
+            'serialManager'.
+        """
+        if name in ('bluetoothManager', 'wifiManager', 'serialManager'):
+            return getattr(self, '_' + name) is not None
+        else:
+            raise ValueError("Unknown manager name.")
+
+    # Behaviour is shared with Bittle, methods only rely on the attributes
+    # defined above.
+    __eq__ = Bittle.__eq__
+    __hash__ = None
+    __enter__ = Bittle.__enter__
+    __exit__ = Bittle.__exit__
+    gait = Bittle.gait
+    _should_send = Bittle._should_send
+    _observe = Bittle._observe
+    _sent = Bittle._sent
+    _send = Bittle._send
+    connect_bluetooth = Bittle.connect_bluetooth
+    send_command_bluetooth = Bittle.send_command_bluetooth
+    send_msg_bluetooth = Bittle.send_msg_bluetooth
+    receive_msg_bluetooth = Bittle.receive_msg_bluetooth
+    receive_view_bluetooth = Bittle.receive_view_bluetooth
+    send_movement_bluetooth = Bittle.send_movement_bluetooth
+    upload_skill_bluetooth = Bittle.upload_skill_bluetooth
+    disconnect_bluetooth = Bittle.disconnect_bluetooth
+    has_wifi_connection = Bittle.has_wifi_connection
+    send_command_wifi = Bittle.send_command_wifi
+    send_msg_wifi = Bittle.send_msg_wifi
+    send_movement_wifi = Bittle.send_movement_wifi
+    connect_serial = Bittle.connect_serial
+    send_command_serial = Bittle.send_command_serial
+    send_msg_serial = Bittle.send_msg_serial
+    receive_msg_serial = Bittle.receive_msg_serial
+    receive_view_serial = Bittle.receive_view_serial
+    send_movement_serial = Bittle.send_movement_serial
+    upload_skill_serial = Bittle.upload_skill_serial
+    tune_serial_link = Bittle.tune_serial_link
+    disconnect_serial = Bittle.disconnect_serial
@@ -10,6 +10,10 @@ import subprocess
 import bluetooth
 import serial.tools.list_ports
 
+from pyBittle.meteredLock import MeteredLock
+from pyBittle.receiveBuffer import ReceiveBuffer
+from pyBittle.tracing import tracer
+
 
 __author__ = "EnriqueMoran"
 
@@ -27,10 +31,28 @@ class BluetoothManager:
         Communication port.
     discovery_timeout : int
         Time for discovery Bluetooth devices (seconds).
-    recv_timeout : int
+    recv_timeout : float
         Socket timeout for receiving messages (seconds).
+    rtt_estimator : RttEstimator
+        If set, timeout for receiving replies is adapted to measured
+        round-trip times instead of recv_timeout. None by default.
+    flow_control : FlowController
+        If set, limits the bytes written and not yet answered by Bittle.
+        None by default.
+    write_batcher : WriteBatcher
+        If set, messages sent close together are written at once. None by
+        default.
     socket : bluetooth.BluetoothSocket
         Socket for Bluetooth connection.
+    socket_wrapper : callable
+        If set, every new socket is passed to it and its result used instead
+        (e.g. faultInjection.FaultySocket). None by default.
+    recv_buffer : ReceiveBuffer
+        Reusable buffer used by recv_view() and recv_line().
+    send_lock : MeteredLock
+        Serializes writes to the socket, measuring contention.
+    recv_lock : MeteredLock
+        Serializes reads from the socket, measuring contention.
 
     Methods
     -------
@@ -41,11 +63,20 @@ class BluetoothManager:
     connect():
         Connects to Bittle.
     send_msg(msg):
-        Sends a message to Bittle.
+        Sends a message to Bittle. Returns False if dropped by flow control.
+    send_raw(data):
+        Sends already encoded data to Bittle. Returns False if dropped by
+        flow control.
     recv_msg(buffer_size=1024):
         Returns received message from Bittle.
+    recv_view():
+        Returns received message from Bittle as a view of recv_buffer.
+    recv_line():
+        Returns a received line from Bittle.
     close_connection():
         Closes connection with Bittle.
+    close():
+        Releases the socket, also done when used as a context manager.
     """
 
     def __init__(self):
@@ -54,10 +85,26 @@ class BluetoothManager:
         self._port = 1
         self._discovery_timeout = 8
         self._recv_timeout = 10
-        self.socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        self.socket_wrapper = None
+        self.socket = self._new_socket()
+        self._socket_used = False  # Used sockets can't connect again
+        self.recv_buffer = ReceiveBuffer()
+        self.rtt_estimator = None
+        self.flow_control = None
+        self.write_batcher = None
+        self.send_lock = MeteredLock()
+        self.recv_lock = MeteredLock()
 
     def __del__(self):
-        self.socket.close()
+        sock = getattr(self, 'socket', None)  # __init__ may have failed
+        if sock is not None:
+            sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def __repr__(self):
         return f"BluetoothManager - name: {self.name}, address: " \
@@ -118,10 +165,11 @@ class BluetoothManager:
 
     @recv_timeout.setter
     def recv_timeout(self, new_timeout):
-        if isinstance(new_timeout, int) and new_timeout > 0:
+        if isinstance(new_timeout, (int, float)) and new_timeout > 0:
             self._recv_timeout = new_timeout
         else:
-            raise TypeError("New timeout type must be int, greater than 0.")
+            raise TypeError("New timeout type must be int or float, "
+                            "greater than 0.")
 
     def initialize_name_and_address(self, get_first_bittle=True):
         """Sets self._name and self._address values by searching
@@ -171,38 +219,158 @@ class BluetoothManager:
         Connects to Bittle and wait until full response is given
         (response will contain "Finished! at the end").
         Once its connected, set self.socket's timeout to self._recv_timeout.
+        A previously used socket is closed and replaced first, so connect()
+        can be called again after a failure or close_connection().
 
         Returns:
             res (bool) : True if connected succesfully, False otherwise.
         """
         res = False
+        if self._socket_used:
+            self.socket.close()
+            self.socket = self._new_socket()
+        self._socket_used = True
         try:
             self.socket.connect((self.address, self.port))
             self.socket.settimeout(self._recv_timeout)
+            self.recv_buffer.clear()
+            if self.flow_control is not None:
+                self.flow_control.clear()
             while True:
-                data = self.socket.recv(1024)  # TODO: adjust buffer size
+                data = self.recv_buffer.read_line(self._recv_into)
                 if len(data) == 0:
                     break
-                elif b"Finished!" in data:
+                elif b"Finished!" in bytes(data):
                     res = True
                     break
         except:
             pass
-        if not res:  # Reset socket
-            self.socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        if not res:  # Release the socket, next connect() creates a new one
+            self.socket.close()
         return res
 
+    def _new_socket(self):
+        """Returns a new RFCOMM socket, wrapped by self.socket_wrapper if
+        set.
+        """
+        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        if self.socket_wrapper is not None:
+            sock = self.socket_wrapper(sock)
+        return sock
+
+    def _recv_into(self, buffer):
+        """Receives into buffer, returns the number of bytes received.
+        Falls back to recv() on sockets without recv_into().
+        """
+        try:
+            recv_into = self.socket.recv_into
+        except AttributeError:
+            data = self.socket.recv(len(buffer))
+            buffer[:len(data)] = data
+            size = len(data)
+        else:
+            size = recv_into(buffer)
+        if size and tracer.enabled:
+            tracer.received_bytes(self)
+        return size
+
     def send_msg(self, msg):
-        """Sends a message to Bittle.
+        """Sends a message to Bittle (terminated by a newline if batched
+        by self.write_batcher, see pyBittle.writeBatcher).
 
         Parameters:
             msg (str) : Message to send.
+
+        Returns:
+            res (bool) : False if self.flow_control dropped the message,
+            True otherwise (or queued in self.write_batcher).
         """
         if isinstance(msg, str) and msg:
-            self.socket.send(msg)
+            if self.write_batcher is not None:
+                self.write_batcher.queue(self._send, msg)
+                return True
+            return self._send(msg.encode(), msg)
         else:
             raise TypeError("Message must be non empty str.")
 
+    def send_raw(self, data):
+        """Sends already encoded data to Bittle.
+
+        Parameters:
+            data (bytes) : Data to send.
+
+        Returns:
+            res (bool) : False if self.flow_control dropped the data, True
+            otherwise.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)) and data:
+            self._flush_batch()
+            return self._send(data)
+        else:
+            raise TypeError("Data must be non empty bytes.")
+
+    def _send(self, data, msg=None, batch=None):
+        """Writes data through self.flow_control (if set), registering msg
+        in self.rtt_estimator once written; batch is [(msg, size, trace)]
+        of the messages packed in data by self.write_batcher, None if data
+        is msg alone. Returns False if dropped.
+        """
+        if batch is None:
+            trace = tracer.current() if tracer.enabled else None
+            if trace is not None:
+                trace.lap('encode')
+            batch = ((msg, len(data), trace),)
+        flow_control = self.flow_control
+        if flow_control is not None and not flow_control.reserve(len(data)):
+            return False
+        try:
+            with self.send_lock:
+                for _, _, trace in batch:
+                    if trace is not None:
+                        trace.lap('enqueue')
+                        tracer.written(self, trace)
+                partial = self._send_all(data)
+                for _, _, trace in batch:
+                    if trace is not None:
+                        trace.lap('write')
+                if flow_control is not None:
+                    flow_control.written(len(data), partial,
+                                         [size for _, size, _ in batch]
+                                         if len(batch) > 1 else None)
+                if self.rtt_estimator is not None:
+                    for msg, _, _ in batch:
+                        if msg is not None:
+                            self.rtt_estimator.sent('bluetooth', msg)
+        except BaseException as err:
+            for _, _, trace in batch:
+                if trace is not None:
+                    tracer.discard(self, trace)
+            if flow_control is not None:
+                flow_control.cancel(len(data),
+                                    isinstance(err, socket.timeout))
+            raise
+        return True
+
+    def _flush_batch(self):
+        """Writes messages queued in self.write_batcher, if set.
+        """
+        if self.write_batcher is not None:
+            self.write_batcher.flush()
+
+    def _send_all(self, data):
+        """Sends data, resending whatever send() did not take. Returns the
+        number of partial writes.
+        """
+        partial = 0
+        sent = self.socket.send(data)
+        while sent < len(data):
+            if sent == 0:
+                raise ConnectionError("Bluetooth connection closed.")
+            partial += 1
+            data = data[sent:]
+            sent = self.socket.send(data)
+        return partial
+
     def recv_msg(self, buffer_size=1024):
         """Receives a message from Bittle.
 
@@ -214,15 +382,98 @@ class BluetoothManager:
         """
         data = b''
         if isinstance(buffer_size, int) and buffer_size > 0:
-            try:
-                data = self.socket.recv(buffer_size)
-            except socket.error as err:
-                raise socket.error("{!s}".format(err)) from None
+            self._flush_batch()
+            with self.recv_lock:
+                awaited = self._set_reply_timeout()
+                try:
+                    data = self.socket.recv(buffer_size)
+                except socket.error as err:
+                    self._reply_done(awaited, b'')
+                    raise socket.error("{!s}".format(err)) from None
+                self._reply_done(awaited, data)
         else:
             raise TypeError("Buffer size must be int, greater than zero.")
         return data
 
+    def recv_view(self):
+        """Receives a message from Bittle into self.recv_buffer.
+
+        The view is only valid until the next call, copy it (bytes(data))
+        to keep it.
+
+        Returns:
+            data (memoryview) : Received data.
+        """
+        return self._recv_buffered(self.recv_buffer.fill)
+
+    def recv_line(self):
+        """Receives a line (till '\n' character) from Bittle.
+
+        If the socket times out in the middle of a line, the partial line
+        is kept for the next call.
+
+        Returns:
+            data (bytes) : Received line, empty if the connection was
+            closed.
+        """
+        return bytes(self._recv_buffered(self.recv_buffer.read_line))
+
+    def _recv_buffered(self, read):
+        """Receives through self.recv_buffer using given read method.
+        """
+        self._flush_batch()
+        with self.recv_lock:
+            awaited = self._set_reply_timeout()
+            try:
+                data = read(self._recv_into)
+            except socket.error as err:
+                self._reply_done(awaited, b'')
+                raise socket.error("{!s}".format(err)) from None
+            self._reply_done(awaited, data)
+            return data
+
+    def _set_reply_timeout(self):
+        """Sets socket timeout from self.rtt_estimator. Returns True if a
+        reply is awaited.
+        """
+        if self.rtt_estimator is None:
+            return False
+        timeout = self.rtt_estimator.timeout('bluetooth')
+        self.socket.settimeout(self._recv_timeout if timeout is None
+                               else timeout)
+        return timeout is not None
+
+    def _reply_done(self, awaited, data):
+        """Registers in self.rtt_estimator whether the awaited reply was
+        received (a partial line is not a reply yet), and releases answered
+        messages from self.flow_control.
+        """
+        if data and self.flow_control is not None:
+            self.flow_control.received(data)
+        if data and tracer.enabled:
+            tracer.received_line(self, data)
+        if awaited:
+            if not data:
+                self.rtt_estimator.timed_out('bluetooth')
+            else:  # A sample per complete reply line, not per chunk
+                if isinstance(data, memoryview):
+                    data = data.tobytes()
+                lines = data.count(b'\n')
+                if lines:
+                    self.rtt_estimator.received('bluetooth', lines)
+
     def close_connection(self):
-        """Closes connection.
+        """Closes connection, writing queued messages first.
+        """
+        try:
+            self._flush_batch()
+        finally:
+            self._socket_used = True
+            self.socket.close()
+
+    def close(self):
+        """Closes connection and releases the socket. The manager can still
+        connect() again.
         """
-        self.socket.close()
+        self.close_connection()
+        self.recv_buffer.clear()
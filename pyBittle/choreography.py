@@ -0,0 +1,298 @@
+"""This module compiles choreographies into pre-encoded command streams.
+
+A choreography is validated and encoded once into a Routine: the distinct
+encoded messages, the sequence in which they are sent and the time (relative
+to the start) at which each one is sent. Playing a Routine through any
+manager costs a sleep and a write per step, without re-validating or
+re-encoding anything.
+
+Choreographies can be written as text, using the script format of
+pyBittle.batchRunner ('gait', 'move', commands, 'msg', 'wait' and
+'repeat'/'end'), or as a list of steps:
+
+    Command.GREETING                    Send a Command.
+    (Gait.TROT, Direction.FORWARD)      Send a movement.
+    'kbalance'                          Send a custom message.
+    1.5                                 Wait given seconds.
+    ('repeat', 4, [...])                Repeat given steps.
+"""
+
+import collections
+import struct
+import threading
+import time
+
+from array import array
+
+from pyBittle.batchRunner import parse_script
+from pyBittle.bittleManager import Bittle, Command, Direction, Gait, \
+    movement_msg
+
+
+__author__ = "EnriqueMoran"
+
+
+_HEADER = struct.Struct('<4sIII')  # Magic, frames, steps, frames size
+_MAGIC = b'PBR1'
+
+ROUTINE_CACHE_SIZE = 128  # Cached routines, least recently used dropped
+
+_cache = collections.OrderedDict()  # Frozen choreography : Routine
+_cache_lock = threading.Lock()
+
+
+class Routine:
+    """Compiled choreography.
+
+    Attributes
+    ----------
+    frames : (bytes)
+        Distinct encoded messages.
+    messages : (str)
+        Distinct messages, same order as frames.
+    sequence : array.array
+        Index in frames of every step.
+    times : array.array
+        Send time of every step, relative to start (seconds).
+    duration : float
+        Time from start to the end of the last wait (seconds).
+
+    Methods
+    -------
+    play(manager, speed=1.0):
+        Sends the routine through given manager.
+    to_bytes():
+        Returns the routine serialized.
+    from_bytes(data):
+        Returns a routine from serialized data (class method).
+    """
+
+    __slots__ = ('frames', 'messages', 'sequence', 'times', 'duration')
+
+    def __init__(self, frames, sequence, times, duration):
+        self.frames = tuple(frames)
+        self.messages = tuple(frame.decode() for frame in self.frames)
+        self.sequence = sequence
+        self.times = times
+        self.duration = duration
+
+    def __repr__(self):
+        return f"Routine - steps: {len(self)}, frames: {len(self.frames)}, " \
+               f"duration: {self.duration}"
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __eq__(self, other):
+        return isinstance(other, Routine) and \
+            self.frames == other.frames and \
+            self.sequence == other.sequence and \
+            self.times == other.times and self.duration == other.duration
+
+    __hash__ = None
+
+    def play(self, manager, speed=1.0):
+        """Sends the routine through given manager, keeping its timing
+        (absolute deadlines, so write time does not accumulate).
+
+        Managers with send_raw() (BluetoothManager, SerialManager) get the
+        encoded frames, the rest (WifiManager) get str messages.
+
+        Parameters:
+            manager : Manager to send the steps through.
+            speed (float) : Playback speed factor.
+
+        Returns:
+            late (float) : Maximum delay of a step over its schedule
+            (seconds).
+        """
+        if not (isinstance(speed, (int, float)) and speed > 0):
+            raise TypeError("Speed must be number, greater than 0.")
+        send = getattr(manager, 'send_raw', None)
+        items = self.frames
+        if send is None:
+            send = manager.send_msg
+            items = self.messages
+        sleep = time.sleep
+        clock = time.perf_counter
+        scale = 1.0 / speed
+        late = 0.0
+        start = clock()
+        for index, at in zip(self.sequence, self.times):
+            delay = start + at * scale - clock()
+            if delay > 0:
+                sleep(delay)
+            elif -delay > late:
+                late = -delay
+            send(items[index])
+        delay = start + self.duration * scale - clock()
+        if delay > 0:
+            sleep(delay)
+        return late
+
+    def to_bytes(self):
+        """Returns the routine serialized, see from_bytes().
+        """
+        frames = b'\n'.join(self.frames)
+        return _HEADER.pack(_MAGIC, len(self.frames), len(self.sequence),
+                            len(frames)) + \
+            struct.pack('<d', self.duration) + frames + \
+            self.sequence.tobytes() + self.times.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Returns a routine from data returned by to_bytes().
+
+        Parameters:
+            data (bytes) : Serialized routine.
+        """
+        magic, frame_count, step_count, frames_size = \
+            _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("Data is not a serialized routine.")
+        offset = _HEADER.size
+        duration, = struct.unpack_from('<d', data, offset)
+        offset += 8
+        frames = bytes(data[offset:offset + frames_size]).split(b'\n') \
+            if frame_count else []
+        offset += frames_size
+        sequence = array('I')
+        sequence.frombytes(data[offset:offset + step_count *
+                                sequence.itemsize])
+        offset += step_count * sequence.itemsize
+        times = array('d')
+        times.frombytes(data[offset:offset + step_count * times.itemsize])
+        if len(frames) != frame_count or len(times) != step_count:
+            raise ValueError("Truncated routine data.")
+        return cls(frames, sequence, times, duration)
+
+
+class _Compiler:
+    """Unrolls validated steps into frames, sequence and times.
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.indices = {}  # Message : frame index
+        self.sequence = array('I')
+        self.times = array('d')
+        self.now = 0.0
+        self.gait = Gait.WALK
+
+    def emit(self, msg):
+        if not (isinstance(msg, str) and msg):
+            raise TypeError("Message must be non empty str.")
+        index = self.indices.get(msg)
+        if index is None:
+            frame = msg.encode()
+            if b'\n' in frame:
+                raise ValueError("Message must not contain new lines.")
+            index = self.indices[msg] = len(self.frames)
+            self.frames.append(frame)
+        self.sequence.append(index)
+        self.times.append(self.now)
+
+    def wait(self, seconds):
+        if seconds < 0:
+            raise ValueError("Wait must be positive.")
+        self.now += seconds
+
+    def repeat(self, count, steps, compile_steps):
+        if not (isinstance(count, int) and count >= 0):
+            raise TypeError("Repeat count must be positive int.")
+        for _ in range(count):
+            compile_steps(steps)
+
+    def compile_list(self, steps):
+        for step in steps:
+            if isinstance(step, Command):
+                self.emit(Bittle._commands[step])
+            elif isinstance(step, str):
+                self.emit(step)
+            elif isinstance(step, (int, float)) and \
+                    not isinstance(step, bool):
+                self.wait(step)
+            elif isinstance(step, tuple) and len(step) == 2 and \
+                    isinstance(step[0], Gait) and \
+                    isinstance(step[1], Direction):
+                self.emit(movement_msg(step[0], step[1]))
+            elif isinstance(step, tuple) and len(step) == 3 and \
+                    step[0] == 'repeat':
+                self.repeat(step[1], step[2], self.compile_list)
+            else:
+                raise TypeError(f"Invalid choreography step: {step!r}.")
+
+    def compile_script(self, steps):
+        for directive, argument in steps:
+            if directive == 'command':
+                self.emit(Bittle._commands[argument])
+            elif directive == 'movement':
+                self.emit(movement_msg(self.gait, argument))
+            elif directive == 'gait':
+                self.gait = argument
+            elif directive == 'msg':
+                self.emit(argument)
+            elif directive == 'wait':
+                self.wait(argument)
+            elif directive == 'repeat':
+                self.repeat(argument[0], argument[1], self.compile_script)
+            else:
+                raise ValueError(f"'{directive}' is not supported in "
+                                 f"choreographies.")
+
+
+def _freeze(step):
+    """Returns a hashable copy of a step (or list of steps) keeping the type
+    of every value, so equal values of different types (a list and a tuple,
+    1 and True, 'kwk' and Gait.WALK) are not the same cache key.
+    """
+    if isinstance(step, (list, tuple)):
+        return type(step), tuple(_freeze(item) for item in step)
+    return type(step), step
+
+
+def compile_choreography(choreography, use_cache=True):
+    """Validates and compiles a choreography.
+
+    Parameters:
+        choreography (str or list) : Choreography text or list of steps.
+        use_cache (bool) : If True, returns the cached Routine when the same
+        choreography has already been compiled (the last
+        ROUTINE_CACHE_SIZE used ones are kept).
+
+    Returns:
+        routine (Routine) : Compiled choreography.
+    """
+    if isinstance(choreography, str):
+        key = choreography
+    elif isinstance(choreography, (list, tuple)):
+        key = _freeze(choreography)
+    else:
+        raise TypeError("Choreography must be str or list of steps.")
+    if use_cache:
+        with _cache_lock:
+            routine = _cache.get(key)
+            if routine is not None:
+                _cache.move_to_end(key)
+        if routine is not None:
+            return routine
+    compiler = _Compiler()
+    if isinstance(choreography, str):
+        compiler.compile_script(parse_script(choreography.splitlines()))
+    else:
+        compiler.compile_list(choreography)
+    routine = Routine(compiler.frames, compiler.sequence, compiler.times,
+                      compiler.now)
+    if use_cache:
+        with _cache_lock:
+            _cache[key] = routine
+            if len(_cache) > ROUTINE_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return routine
+
+
+def clear_cache():
+    """Discards cached routines.
+    """
+    with _cache_lock:
+        _cache.clear()
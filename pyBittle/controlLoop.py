@@ -0,0 +1,390 @@
+"""This module runs control loops at a fixed rate.
+
+ControlLoop calls a callback with a Bittle every period, scheduled on
+absolute deadlines (tick n starts at start + n * period), so callback time
+and sleep inaccuracy do not accumulate as in a `while True: ...;
+time.sleep(period)` loop. The last spin seconds before a deadline are busy
+waited, as sleeps wake up late. A tick finishing after the next tick's
+deadline is a deadline miss; the deadlines it overran are skipped instead of
+run back to back.
+
+Per-tick duration, wake-up jitter (how late a tick started) and overrun of
+missed deadlines are recorded in logarithmic histograms that can be queried
+from other threads while the loop runs.
+
+Optionally, the loop thread is pinned to a CPU and given real-time priority
+(SCHED_FIFO, Linux, needs CAP_SYS_NICE or root), and the garbage collector
+is disabled while the loop runs ('disable', process wide), after moving
+every existing object out of its reach ('freeze'), so no collection pauses
+a tick. Previous settings are restored when the loop ends. With gc_slack
+set, young generation collections still run when a tick leaves that much
+time before the next deadline.
+"""
+
+import gc
+import math
+import os
+import threading
+import time
+
+from array import array
+
+
+__author__ = "EnriqueMoran"
+
+
+GC_MODES = (None, 'disable', 'freeze')
+
+_MIN_TIME = 1e-6  # Seconds of the first histogram bin
+_BINS_PER_OCTAVE = 8  # About 9 % wide bins
+_OCTAVES = 27  # 1 us to 134 s
+
+
+class TimeHistogram:
+    """Logarithmic histogram of durations, 1 us to 134 s.
+
+    Attributes
+    ----------
+    count : int
+        Recorded durations.
+    total : float
+        Sum of recorded durations (seconds).
+    max : float
+        Longest recorded duration (seconds).
+
+    Methods
+    -------
+    record(seconds):
+        Records a duration.
+    percentile(quantile):
+        Returns the duration below which quantile of the records fall.
+    summary():
+        Returns count, mean, percentiles and maximum.
+    buckets():
+        Returns the non empty bins.
+    reset():
+        Discards recorded durations.
+    """
+
+    __slots__ = ('_counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        return f"TimeHistogram - count: {self.count}, mean: " \
+               f"{self.mean():.6f}, max: {self.max:.6f}"
+
+    def reset(self):
+        self._counts = array('Q', [0]) * (_BINS_PER_OCTAVE * _OCTAVES)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """Records a duration (seconds).
+        """
+        if seconds > _MIN_TIME:
+            index = min(int(math.log2(seconds / _MIN_TIME) *
+                            _BINS_PER_OCTAVE), len(self._counts) - 1)
+        else:
+            index = 0
+        self._counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, quantile):
+        """Returns the duration (seconds, upper bound of its bin) below
+        which quantile (0 to 1) of the records fall, 0.0 if empty.
+        """
+        counts = self._counts.tolist()  # Snapshot, the loop keeps writing
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = quantile * total
+        seen = 0
+        for index, count in enumerate(counts[:-1]):
+            seen += count
+            if count and seen >= rank:
+                return min(self._upper(index), self.max)
+        return self.max  # Last bin has no upper bound
+
+    def summary(self):
+        """Returns {'count', 'mean', 'p50', 'p90', 'p99', 'p999', 'max'}
+        (seconds).
+        """
+        return {'count': self.count, 'mean': self.mean(),
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'p999': self.percentile(0.999), 'max': self.max}
+
+    def buckets(self):
+        """Returns [(upper bound seconds, count)] of the non empty bins.
+        """
+        return [(self._upper(index), count)
+                for index, count in enumerate(self._counts.tolist())
+                if count]
+
+    @staticmethod
+    def _upper(index):
+        return _MIN_TIME * 2 ** ((index + 1) / _BINS_PER_OCTAVE)
+
+
+class ControlLoop:
+    """Fixed-rate loop calling callback(bittle, tick) every period. The loop
+    stops when callback returns False, stop() is called or callback raises
+    (the error is raised again by run() or stop()).
+
+    Attributes
+    ----------
+    bittle : Bittle
+        Bittle passed to callback.
+    callback : callable
+        Called every tick with the Bittle and the tick number.
+    rate : float
+        Ticks per second.
+    period : float
+        Seconds between ticks.
+    spin : float
+        Seconds before a deadline that are busy waited instead of slept.
+    cpu : int
+        CPU the loop thread is pinned to, None to leave it.
+    priority : int
+        SCHED_FIFO priority (1 to 99) of the loop thread, None to leave it.
+    gc_mode : str
+        None to leave the garbage collector alone, 'disable' to disable it
+        while the loop runs, 'freeze' to also collect and freeze existing
+        objects first.
+    gc_slack : float
+        With the collector disabled, young generation collections due run
+        when at least this many seconds are left before the next deadline.
+        None to never collect.
+    durations : TimeHistogram
+        Callback duration of every tick.
+    jitter : TimeHistogram
+        Delay of every tick's start over its deadline.
+    overruns : TimeHistogram
+        Delay of every missed deadline (tick end over next deadline).
+    ticks : int
+        Ticks run.
+    skipped : int
+        Deadlines skipped after misses.
+    collections : int
+        Young generation collections run in slack time.
+    pinned : bool
+        Whether the loop thread was pinned to cpu.
+    realtime : bool
+        Whether the loop thread got real-time priority.
+    running : bool
+        Whether the loop is running.
+
+    Methods
+    -------
+    run(ticks=None):
+        Runs the loop in the calling thread.
+    start(ticks=None):
+        Runs the loop in a new thread.
+    stop(timeout=None):
+        Stops the loop and waits for it.
+    stats():
+        Returns tick counters and histogram summaries.
+    reset():
+        Resets counters and histograms.
+    """
+
+    def __init__(self, bittle, callback, rate=50.0, spin=0.0005, cpu=None,
+                 priority=None, gc_mode='freeze', gc_slack=None):
+        if not callable(callback):
+            raise TypeError("Callback must be callable.")
+        if not (isinstance(rate, (int, float)) and rate > 0):
+            raise TypeError("Rate must be number, greater than 0.")
+        if not (isinstance(spin, (int, float)) and spin >= 0):
+            raise TypeError("Spin must be positive number.")
+        if gc_mode not in GC_MODES:
+            raise ValueError("GC mode must be None, 'disable' or 'freeze'.")
+        if priority is not None and not (isinstance(priority, int) and
+                                         1 <= priority <= 99):
+            raise TypeError("Priority must be int, from 1 to 99.")
+        self.bittle = bittle
+        self.callback = callback
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.spin = spin
+        self.cpu = cpu
+        self.priority = priority
+        self.gc_mode = gc_mode
+        self.gc_slack = gc_slack
+        self.durations = TimeHistogram()
+        self.jitter = TimeHistogram()
+        self.overruns = TimeHistogram()
+        self.pinned = False
+        self.realtime = False
+        self.running = False
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.reset()
+
+    def __repr__(self):
+        return f"ControlLoop - rate: {self.rate}, ticks: {self.ticks}, " \
+               f"misses: {self.overruns.count}, running: {self.running}"
+
+    def reset(self):
+        """Resets counters and histograms.
+        """
+        self.ticks = 0
+        self.skipped = 0
+        self.collections = 0
+        for histogram in (self.durations, self.jitter, self.overruns):
+            histogram.reset()
+
+    def stats(self):
+        """Returns {'ticks', 'misses', 'miss_rate', 'skipped',
+        'collections', 'duration', 'jitter', 'overrun'}, the last three
+        being TimeHistogram summaries.
+        """
+        ticks = self.ticks
+        misses = self.overruns.count
+        return {'ticks': ticks, 'misses': misses,
+                'miss_rate': misses / ticks if ticks else 0.0,
+                'skipped': self.skipped, 'collections': self.collections,
+                'duration': self.durations.summary(),
+                'jitter': self.jitter.summary(),
+                'overrun': self.overruns.summary()}
+
+    def start(self, ticks=None):
+        """Runs the loop in a new thread (CPU pinning and priority only
+        apply to it).
+
+        Parameters:
+            ticks (int) : Ticks to run, None to run until stopped.
+        """
+        if self.running:
+            raise RuntimeError("Control loop is already running.")
+        self.running = True  # Before the thread starts, see stop()
+        self._stop.clear()  # Not in the thread, stop() may come first
+        self._thread = threading.Thread(target=self._run_thread,
+                                        args=(ticks,), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the loop after its current tick and waits for it.
+
+        Returns:
+            res (bool) : False if the loop thread did not end within timeout.
+        """
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                return False
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return True
+
+    def _run_thread(self, ticks):
+        try:
+            self._run(ticks)
+        except BaseException as err:
+            self.error = err
+
+    def run(self, ticks=None):
+        """Runs the loop in the calling thread until callback returns
+        False, stop() is called or ticks ticks have run.
+
+        Parameters:
+            ticks (int) : Ticks to run, None to run until stopped.
+        """
+        self.running = True
+        self._stop.clear()
+        self._run(ticks)
+
+    def _run(self, ticks):
+        restore = self._configure_thread()
+        gc_enabled = gc.isenabled()
+        if self.gc_mode == 'freeze':
+            gc.collect()
+            gc.freeze()
+        if self.gc_mode is not None:
+            gc.disable()
+        try:
+            self._loop(ticks)
+        finally:
+            if self.gc_mode == 'freeze':
+                gc.unfreeze()
+            if gc_enabled:
+                gc.enable()
+            restore()
+            self.running = False
+
+    def _configure_thread(self):
+        """Pins the calling thread to self.cpu and gives it SCHED_FIFO
+        self.priority, where supported and allowed. Returns a function
+        restoring the previous settings.
+        """
+        self.pinned = self.realtime = False
+        affinity = policy = None
+        if self.cpu is not None and hasattr(os, 'sched_setaffinity'):
+            try:
+                affinity = os.sched_getaffinity(0)  # 0: calling thread
+                os.sched_setaffinity(0, {self.cpu})
+                self.pinned = True
+            except (OSError, ValueError):
+                affinity = None
+        if self.priority is not None and hasattr(os, 'sched_setscheduler'):
+            try:
+                policy = (os.sched_getscheduler(0), os.sched_getparam(0))
+                os.sched_setscheduler(0, os.SCHED_FIFO,
+                                      os.sched_param(self.priority))
+                self.realtime = True
+            except OSError:
+                policy = None
+
+        def restore():
+            if affinity is not None:
+                os.sched_setaffinity(0, affinity)
+            if policy is not None:
+                os.sched_setscheduler(0, *policy)
+        return restore
+
+    def _loop(self, ticks):
+        clock = time.perf_counter
+        period = self.period
+        stopping = self._stop.is_set
+        wait = self._stop.wait
+        collect = self.gc_mode is not None and self.gc_slack is not None
+        threshold = gc.get_threshold()[0]  # Young collection trigger
+        count = 0
+        deadline = clock()
+        while ticks is None or count < ticks:
+            start = clock()
+            self.jitter.record(start - deadline)
+            keep_going = self.callback(self.bittle, self.ticks)
+            end = clock()
+            self.durations.record(end - start)
+            self.ticks += 1
+            count += 1
+            deadline += period
+            if end > deadline:  # Missed: skip the overrun deadlines
+                self.overruns.record(end - deadline)
+                missed = int((end - deadline) / period) + 1
+                self.skipped += missed
+                deadline += missed * period
+            if keep_going is False or stopping():
+                break
+            if collect and gc.get_count()[0] >= threshold and \
+                    deadline - clock() >= self.gc_slack:
+                gc.collect(0)
+                self.collections += 1
+            delay = deadline - clock() - self.spin
+            if delay > 0 and wait(delay):
+                break  # Stopped while sleeping
+            while clock() < deadline:
+                pass
@@ -0,0 +1,330 @@
+"""This module fans out Bittle's incoming messages to subscribers.
+
+EventBus runs a single reader thread per attached transport. Every received
+line is classified once into a topic ('ack', 'imu', 'boot', 'error' or
+'other') and handed to the subscribers of that topic as the same Event
+(its data is never copied). Each subscriber has its own bounded queue, so a
+slow subscriber loses its oldest events instead of stalling the reader or
+the other subscribers.
+
+Lines can also be published from other sources, e.g. the unsolicited
+replies of a TransportDispatcher: TransportDispatcher(manager,
+unsolicited=lambda line: bus.publish(line, 'serial')).
+"""
+
+import collections
+import re
+import threading
+import time
+
+
+__author__ = "EnriqueMoran"
+
+
+TOPICS = ('ack', 'imu', 'boot', 'error', 'other')
+
+BOOT_MARKERS = (b'Finished!', b'Ready!', b'Init', b'Calibrat')
+ERROR_MARKERS = (b'rror', b'Wrong', b'Undefined', b'Unknown', b'Overflow')
+
+_MIN_BACKOFF = 0.001  # Pause after a read returning nothing at once
+_MAX_BACKOFF = 0.05
+
+# Three or more numbers: yaw, pitch, roll and accelerations
+_IMU_LINE = re.compile(rb'^(?:ypr\W*)?(?:-?\d+(?:\.\d+)?[\s,\t]+){2,}'
+                       rb'-?\d+(?:\.\d+)?$')
+
+
+def classify(line):
+    """Returns the topic of a received line.
+
+    Parameters:
+        line (bytes) : Received line.
+
+    Returns:
+        topic (str) : 'ack' (a single token, OpenCat's reply to a
+        command), 'imu' (numeric sample), 'boot' (start up banner),
+        'error' or 'other'.
+    """
+    line = line.strip()
+    if len(line) == 1:
+        return 'ack'
+    elif _IMU_LINE.match(line):
+        return 'imu'
+    elif any(marker in line for marker in BOOT_MARKERS):
+        return 'boot'
+    elif any(marker in line for marker in ERROR_MARKERS):
+        return 'error'
+    return 'other'
+
+
+class Event:
+    """Classified incoming line, shared by every subscriber.
+
+    Attributes
+    ----------
+    topic : str
+        Line topic.
+    data : bytes
+        Received line.
+    transport : str
+        Transport it was received from.
+    received_at : float
+        time.monotonic() of reception.
+    """
+
+    __slots__ = ('topic', 'data', 'transport', 'received_at')
+
+    def __init__(self, topic, data, transport, received_at):
+        self.topic = topic
+        self.data = data
+        self.transport = transport
+        self.received_at = received_at
+
+    def __repr__(self):
+        return f"Event - topic: {self.topic}, transport: {self.transport}, " \
+               f"data: {self.data!r}"
+
+
+class Subscription:
+    """Bounded queue of events of some topics.
+
+    Attributes
+    ----------
+    topics : frozenset
+        Subscribed topics.
+    max_queue : int
+        Events kept; when full, the oldest one is dropped.
+    dropped : int
+        Events dropped because the queue was full.
+    delivered : int
+        Events taken from the queue.
+
+    Methods
+    -------
+    get(timeout=None):
+        Returns the next event, None on timeout or once closed.
+    close():
+        Stops receiving events.
+    """
+
+    def __init__(self, bus, topics, max_queue, callback=None):
+        self.topics = frozenset(topics)
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.delivered = 0
+        self._bus = bus
+        self._events = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        if callback is not None:
+            self._thread = threading.Thread(target=self._run,
+                                            args=(callback,),
+                                            name="pyBittle-subscriber",
+                                            daemon=True)
+            self._thread.start()
+
+    def __repr__(self):
+        return f"Subscription - topics: {sorted(self.topics)}, queued: " \
+               f"{len(self._events)}, dropped: {self.dropped}"
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+
+    def _put(self, event):
+        """Queues event without blocking, dropping the oldest one if full.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._events) >= self.max_queue:
+                self._events.popleft()
+                self.dropped += 1
+            self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Returns the next event.
+
+        Parameters:
+            timeout (float) : Seconds to wait, None to wait forever.
+
+        Returns:
+            event (Event) : Next event, None on timeout or once closed.
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._events or self._closed, timeout):
+                return None
+            if not self._events:
+                return None
+            self.delivered += 1
+            return self._events.popleft()
+
+    def close(self):
+        """Stops receiving events; queued ones are discarded.
+        """
+        self._bus.unsubscribe(self)
+        with self._condition:
+            self._closed = True
+            self._events.clear()
+            self._condition.notify_all()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self, callback):
+        for event in self:
+            callback(event)
+
+
+class EventBus:
+    """In-process publish/subscribe of Bittle's incoming lines.
+
+    Attributes
+    ----------
+    published : collections.Counter
+        Lines published per topic.
+
+    Methods
+    -------
+    subscribe(topics=TOPICS, callback=None, max_queue=100):
+        Returns a Subscription to some topics.
+    unsubscribe(subscription):
+        Stops delivering events to a subscription.
+    publish(line, transport):
+        Classifies a line and delivers it to its subscribers.
+    attach(manager, transport):
+        Starts reading a manager's lines in background.
+    detach(transport):
+        Stops reading a transport.
+    close():
+        Detaches every transport and closes every subscription.
+    """
+
+    def __init__(self):
+        self.published = collections.Counter()
+        self._subscribers = {topic: () for topic in TOPICS}
+        self._lock = threading.Lock()
+        self._readers = {}  # Transport : (thread, stop event)
+
+    def __repr__(self):
+        return f"EventBus - transports: {sorted(self._readers)}, " \
+               f"published: {dict(self.published)}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def subscribe(self, topics=TOPICS, callback=None, max_queue=100):
+        """Subscribes to some topics.
+
+        Parameters:
+            topics (str or [str]) : Topics to receive.
+            callback (callable) : If set, called with every event from the
+            subscription's own thread; otherwise events are taken with
+            Subscription.get().
+            max_queue (int) : Events queued before dropping the oldest.
+
+        Returns:
+            subscription (Subscription) : Subscription.
+        """
+        if isinstance(topics, str):
+            topics = (topics,)
+        unknown = set(topics) - set(TOPICS)
+        if unknown:
+            raise ValueError(f"Unknown topics: {sorted(unknown)}.")
+        if not (isinstance(max_queue, int) and max_queue > 0):
+            raise TypeError("Max queue must be int, greater than 0.")
+        subscription = Subscription(self, topics, max_queue, callback)
+        with self._lock:  # Subscriber tuples are replaced, never mutated,
+            for topic in subscription.topics:  # so publish() needs no lock
+                self._subscribers[topic] += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscribers[topic] = tuple(
+                    subscriber for subscriber in self._subscribers[topic]
+                    if subscriber is not subscription)
+
+    def publish(self, line, transport=None):
+        """Classifies a line and delivers it to its topic subscribers.
+
+        Parameters:
+            line (bytes) : Received line.
+            transport (str) : Transport it was received from.
+
+        Returns:
+            event (Event) : Published event.
+        """
+        topic = classify(line)
+        event = Event(topic, line, transport, time.monotonic())
+        with self._lock:
+            self.published[topic] += 1
+        for subscriber in self._subscribers[topic]:
+            subscriber._put(event)
+        return event
+
+    def attach(self, manager, transport):
+        """Starts a reader thread publishing every line received by a
+        manager. The manager must not be read from anywhere else.
+
+        Parameters:
+            manager (BluetoothManager or SerialManager) : Manager to read.
+            transport (str) : Name of the transport ('bluetooth',
+            'serial'...).
+        """
+        if transport in self._readers:
+            raise ValueError(f"Transport '{transport}' already attached.")
+        read = getattr(manager, 'recv_line', None) or manager.recv_msg
+        stop = threading.Event()
+        thread = threading.Thread(target=self._read_loop,
+                                  args=(read, transport, stop),
+                                  name=f"pyBittle-bus-{transport}",
+                                  daemon=True)
+        self._readers[transport] = (thread, stop)
+        thread.start()
+
+    def detach(self, transport, timeout=None):
+        """Stops reading a transport (after its current read returns).
+        """
+        thread, stop = self._readers.pop(transport)
+        stop.set()
+        thread.join(timeout)
+
+    def close(self):
+        """Detaches every transport and closes every subscription.
+        """
+        for transport in list(self._readers):
+            self.detach(transport)
+        with self._lock:
+            subscriptions = {subscriber for subscribers
+                             in self._subscribers.values()
+                             for subscriber in subscribers}
+        for subscription in subscriptions:
+            subscription.close()
+
+    def _read_loop(self, read, transport, stop):
+        backoff = 0.0
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                line = read()
+            except OSError:  # Socket timeout or error
+                stop.wait(_MAX_BACKOFF)
+                continue
+            if line:
+                backoff = 0.0
+                self.publish(bytes(line), transport)
+            elif time.perf_counter() - start < _MIN_BACKOFF:
+                # Returned at once (closed port or socket), don't spin
+                backoff = min(max(backoff * 2, _MIN_BACKOFF), _MAX_BACKOFF)
+                stop.wait(backoff)
@@ -0,0 +1,504 @@
+"""This module injects link faults between the managers and their transport.
+
+Proxies wrap the object a manager talks through (FaultySocket for
+BluetoothManager.socket, FaultySerial for SerialManager.serial and
+FaultySession for WifiManager.session) and degrade the link following a
+FaultProfile:
+
+    latency     Delay before every write (base latency plus jitter drawn
+                from a 'normal', 'exponential' or 'pareto' distribution,
+                the latter giving occasional long stalls).
+    loss        Probability of losing a write or a received chunk (a lost
+                reply is noticed as a receive timeout). HTTP requests are
+                delayed by TCP retransmissions instead, failing once the
+                request timeout is exceeded (or after 6 retransmissions
+                without timeout).
+    corruption  Probability of flipping a bit of each byte (not applied to
+                HTTP, TCP checksums repair it).
+    reorder     Probability of holding a write back until after the next
+                one (not applied to HTTP).
+    disconnect  Probability per operation of the link going down for
+                disconnect_time seconds; meanwhile every operation raises
+                the transport's connection error.
+
+Faults are drawn from a random.Random seeded by the profile, so a single
+threaded run is reproducible. inject() wraps a manager's transport (it
+survives reconnections) and returns the FaultInjector holding the fault
+statistics; remove() restores the clean link.
+"""
+
+import collections
+import random
+import time
+
+import requests
+import serial
+
+
+__author__ = "EnriqueMoran"
+
+
+DISTRIBUTIONS = ('normal', 'exponential', 'pareto')
+
+PROFILES = {  # Name : FaultProfile parameters
+    'clean': {},
+    'congested': {'latency': 0.02, 'jitter': 0.02, 'loss': 0.01},
+    'weak': {'latency': 0.03, 'jitter': 0.02, 'distribution': 'pareto',
+             'loss': 0.05, 'corruption': 0.001, 'reorder': 0.02},
+    'flaky': {'latency': 0.01, 'jitter': 0.01, 'loss': 0.02,
+              'disconnect': 0.005, 'disconnect_time': 1.0}
+}
+
+_PARETO_SHAPE = 1.5
+_TCP_RTO = 0.2  # Initial TCP retransmission timeout (seconds)
+_TCP_RETRIES = 6  # Retransmissions before TCP gives up (tcp_syn_retries)
+
+
+class FaultProfile:
+    """Seeded description of a degraded link.
+
+    Attributes
+    ----------
+    latency : float
+        Base delay added to every write (seconds).
+    jitter : float
+        Scale of the random delay added to latency (seconds).
+    distribution : str
+        Jitter distribution: 'normal', 'exponential' or 'pareto'.
+    loss : float
+        Probability of losing a write or a received chunk.
+    corruption : float
+        Probability of corrupting each byte.
+    reorder : float
+        Probability of a write being delivered after the next one.
+    disconnect : float
+        Probability per operation of a temporary disconnection.
+    disconnect_time : float
+        Duration of a disconnection (seconds).
+    seed : int
+        Random seed, None for a random one.
+
+    Methods
+    -------
+    preset(name, seed=None):
+        Returns one of PROFILES.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, distribution='normal',
+                 loss=0.0, corruption=0.0, reorder=0.0, disconnect=0.0,
+                 disconnect_time=1.0, seed=None):
+        for name, value in (('Latency', latency), ('Jitter', jitter),
+                            ('Disconnect time', disconnect_time)):
+            if not (isinstance(value, (int, float)) and value >= 0):
+                raise TypeError(f"{name} must be positive int or float.")
+        for name, value in (('Loss', loss), ('Corruption', corruption),
+                            ('Reorder', reorder),
+                            ('Disconnect', disconnect)):
+            if not (isinstance(value, (int, float)) and 0 <= value <= 1):
+                raise TypeError(f"{name} must be a probability between 0 "
+                                f"and 1.")
+        if distribution not in DISTRIBUTIONS:
+            raise TypeError("Distribution must be 'normal', 'exponential' "
+                            "or 'pareto'.")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.loss = loss
+        self.corruption = corruption
+        self.reorder = reorder
+        self.disconnect = disconnect
+        self.disconnect_time = disconnect_time
+        self.seed = seed
+
+    def __repr__(self):
+        return f"FaultProfile - latency: {self.latency}, jitter: " \
+               f"{self.jitter} ({self.distribution}), loss: {self.loss}, " \
+               f"corruption: {self.corruption}, reorder: {self.reorder}, " \
+               f"disconnect: {self.disconnect}, seed: {self.seed}"
+
+    @classmethod
+    def preset(cls, name, seed=None):
+        """Returns a profile from PROFILES.
+
+        Parameters:
+            name (str) : 'clean', 'congested', 'weak' or 'flaky'.
+            seed (int) : Random seed.
+        """
+        if name not in PROFILES:
+            raise ValueError(f"Unknown profile '{name}'.")
+        return cls(seed=seed, **PROFILES[name])
+
+
+class FaultInjector:
+    """Draws the faults of a profile and counts them. Shared by every proxy
+    of a link.
+
+    Attributes
+    ----------
+    profile : FaultProfile
+        Injected faults.
+    stats : collections.Counter
+        Operations ('writes', 'reads', 'requests') and faults ('delayed'
+        seconds, 'lost', 'corrupted' bytes, 'reordered', 'disconnects',
+        'refused' operations while disconnected).
+
+    Methods
+    -------
+    latency():
+        Returns the latency of a write.
+    delay():
+        Sleeps the latency of a write.
+    link_down():
+        Returns True while disconnected.
+    lose():
+        Returns True if a write or chunk must be lost.
+    reorder():
+        Returns True if a write must be held back.
+    corrupt(data):
+        Returns data with corrupted bytes.
+    corrupt_into(buffer, size):
+        Corrupts bytes of a buffer in place.
+    """
+
+    def __init__(self, profile):
+        if not isinstance(profile, FaultProfile):
+            raise TypeError("Profile must be FaultProfile.")
+        self.profile = profile
+        self.stats = collections.Counter()
+        self._random = random.Random(profile.seed)
+        self._down_until = 0.0
+
+    def __repr__(self):
+        return f"FaultInjector - stats: {dict(self.stats)}"
+
+    def latency(self):
+        """Returns the latency of a write (seconds).
+        """
+        profile = self.profile
+        if not profile.jitter:
+            return profile.latency
+        if profile.distribution == 'normal':
+            extra = self._random.gauss(0, profile.jitter)
+        elif profile.distribution == 'exponential':
+            extra = self._random.expovariate(1 / profile.jitter)
+        else:
+            extra = profile.jitter * \
+                (self._random.paretovariate(_PARETO_SHAPE) - 1)
+        return max(profile.latency + extra, 0.0)
+
+    def delay(self):
+        """Sleeps the latency of a write.
+        """
+        latency = self.latency()
+        if latency:
+            self.stats['delayed'] += latency
+            time.sleep(latency)
+
+    def link_down(self):
+        """Returns True while disconnected, possibly starting a
+        disconnection.
+        """
+        now = time.monotonic()
+        if now < self._down_until:
+            self.stats['refused'] += 1
+            return True
+        if self.profile.disconnect and \
+                self._random.random() < self.profile.disconnect:
+            self._down_until = now + self.profile.disconnect_time
+            self.stats['disconnects'] += 1
+            return True
+        return False
+
+    def lose(self):
+        if self.profile.loss and self._random.random() < self.profile.loss:
+            self.stats['lost'] += 1
+            return True
+        return False
+
+    def reorder(self):
+        if self.profile.reorder and \
+                self._random.random() < self.profile.reorder:
+            self.stats['reordered'] += 1
+            return True
+        return False
+
+    def corrupt(self, data):
+        """Returns data with some bits flipped (data itself if none).
+        """
+        positions = self._positions(len(data))
+        if not positions:
+            return data
+        data = bytearray(data)
+        self._flip(data, positions)
+        return bytes(data)
+
+    def corrupt_into(self, buffer, size):
+        """Corrupts the first size bytes of a writable buffer in place.
+        """
+        self._flip(buffer, self._positions(size))
+
+    def _positions(self, size):
+        probability = self.profile.corruption
+        if not probability:
+            return ()
+        return [position for position in range(size)
+                if self._random.random() < probability]
+
+    def _flip(self, buffer, positions):
+        for position in positions:
+            buffer[position] ^= 1 << self._random.randrange(8)
+        self.stats['corrupted'] += len(positions)
+
+
+class _Proxy:
+    """Forwards every attribute not overridden to the wrapped object.
+    """
+
+    __slots__ = ('target', 'faults', '_held')
+
+    def __init__(self, target, faults):
+        if not isinstance(faults, FaultInjector):  # FaultProfile
+            faults = FaultInjector(faults)
+        object.__setattr__(self, 'target', target)
+        object.__setattr__(self, 'faults', faults)
+        object.__setattr__(self, '_held', None)
+
+    def __repr__(self):
+        return f"{type(self).__name__} - target: {self.target!r}"
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def __setattr__(self, name, value):
+        if name in _Proxy.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.target, name, value)
+
+    def _outgoing(self, write, data):
+        """Writes data through the faults: delayed, lost, corrupted or held
+        back until after the next write.
+        """
+        faults = self.faults
+        faults.stats['writes'] += 1
+        faults.delay()
+        if faults.lose():
+            return
+        data = faults.corrupt(data)
+        if self._held is None and faults.reorder():
+            self._held = data
+            return
+        write(data)
+        self._release(write)
+
+    def _release(self, write):
+        held = self._held
+        if held is not None:
+            self._held = None
+            write(held)
+
+
+class FaultySocket(_Proxy):
+    """Socket proxy (BluetoothManager.socket) injecting faults.
+
+    Methods
+    -------
+    send(data):
+        Sends data through the faults.
+    recv(buffer_size):
+        Receives data through the faults.
+    recv_into(buffer, nbytes=0):
+        Receives data into buffer through the faults.
+    """
+
+    __slots__ = ()
+
+    def _check(self):
+        if self.faults.link_down():
+            raise ConnectionResetError("Injected disconnection.")
+
+    def _write(self, data):
+        while data:
+            data = data[self.target.send(data):]
+
+    def send(self, data):
+        self._check()
+        self._outgoing(self._write, bytes(data))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def recv(self, buffer_size):
+        self._release(self._write)
+        while True:
+            self._check()
+            data = self.target.recv(buffer_size)
+            self.faults.stats['reads'] += 1
+            if data and self.faults.lose():
+                continue  # Lost, wait for more (or time out)
+            return self.faults.corrupt(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        self._release(self._write)
+        while True:
+            self._check()
+            try:
+                size = self.target.recv_into(buffer, nbytes)
+            except AttributeError:  # Sockets without recv_into()
+                data = self.target.recv(nbytes or len(buffer))
+                buffer[:len(data)] = data
+                size = len(data)
+            self.faults.stats['reads'] += 1
+            if size and self.faults.lose():
+                continue
+            self.faults.corrupt_into(buffer, size)
+            return size
+
+
+class FaultySerial(_Proxy):
+    """Serial port proxy (SerialManager.serial) injecting faults. Port
+    settings (baudrate, timeout...) are forwarded to the wrapped port.
+
+    Methods
+    -------
+    write(data):
+        Writes data through the faults.
+    read(size=1):
+        Reads data through the faults.
+    readline():
+        Reads a line through the faults.
+    readinto(buffer):
+        Reads data into buffer through the faults.
+    """
+
+    __slots__ = ()
+
+    def _check(self):
+        if self.faults.link_down():
+            raise serial.SerialException("Injected disconnection.")
+
+    def write(self, data):
+        self._check()
+        self._outgoing(self.target.write, bytes(data))
+        return len(data)
+
+    def _incoming(self, read, *args):
+        self._release(self.target.write)
+        while True:
+            self._check()
+            data = read(*args)
+            self.faults.stats['reads'] += 1
+            if data and self.faults.lose():
+                continue
+            return self.faults.corrupt(data)
+
+    def read(self, size=1):
+        return self._incoming(self.target.read, size)
+
+    def readline(self, *args):
+        return self._incoming(self.target.readline, *args)
+
+    def readinto(self, buffer):
+        self._release(self.target.write)
+        while True:
+            self._check()
+            size = self.target.readinto(buffer)
+            self.faults.stats['reads'] += 1
+            if size and self.faults.lose():
+                continue
+            self.faults.corrupt_into(buffer, size)
+            return size
+
+
+class FaultySession(_Proxy):
+    """HTTP session proxy (WifiManager.session) injecting latency, TCP
+    retransmission delays and disconnections.
+
+    Methods
+    -------
+    request(method, url, **kwargs):
+        Sends a request through the faults.
+    get(url, **kwargs), head(url, **kwargs), post(url, **kwargs):
+        Same as request().
+    """
+
+    __slots__ = ()
+
+    def request(self, method, url, **kwargs):
+        faults = self.faults
+        faults.stats['requests'] += 1
+        if faults.link_down():
+            raise requests.ConnectionError("Injected disconnection.")
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, tuple):
+            timeout = sum(value for value in timeout if value)
+        latency = faults.latency()
+        rto = _TCP_RTO
+        retries = 0
+        while (timeout is None or latency < timeout) and faults.lose():
+            if retries == _TCP_RETRIES:  # Lost for good
+                faults.stats['delayed'] += latency
+                time.sleep(latency)
+                raise requests.ConnectionError("Injected connection "
+                                               "timeout.")
+            latency += rto  # Lost segment, retransmitted after RTO
+            rto *= 2
+            retries += 1
+        if timeout is not None and latency >= timeout:
+            faults.stats['delayed'] += timeout
+            time.sleep(timeout)
+            raise requests.Timeout("Injected timeout.")
+        faults.stats['delayed'] += latency
+        time.sleep(latency)
+        return self.target.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+def inject(manager, profile):
+    """Wraps a manager's transport with fault injecting proxies.
+
+    Parameters:
+        manager (BluetoothManager, SerialManager or WifiManager) : Manager
+        whose link is degraded.
+        profile (FaultProfile or FaultInjector) : Faults to inject; pass
+        the same FaultInjector to several managers to share its random
+        sequence and statistics.
+
+    Returns:
+        faults (FaultInjector) : Injector, holding fault statistics.
+    """
+    faults = profile if isinstance(profile, FaultInjector) else \
+        FaultInjector(profile)
+    if hasattr(manager, 'session'):
+        manager.session = FaultySession(manager.session, faults)
+    elif hasattr(manager, 'serial'):
+        manager.serial = FaultySerial(manager.serial, faults)
+    elif hasattr(manager, 'socket_wrapper'):  # Sockets are replaced
+        manager.socket_wrapper = lambda sock: FaultySocket(sock, faults)
+        manager.socket = FaultySocket(manager.socket, faults)
+    else:
+        raise TypeError("Manager must be BluetoothManager, SerialManager or "
+                        "WifiManager.")
+    return faults
+
+
+def remove(manager):
+    """Removes the proxies added by inject().
+    """
+    for name in ('session', 'serial', 'socket'):
+        proxy = getattr(manager, name, None)
+        while isinstance(proxy, _Proxy):
+            proxy = proxy.target
+            setattr(manager, name, proxy)
+    if hasattr(manager, 'socket_wrapper'):
+        manager.socket_wrapper = None
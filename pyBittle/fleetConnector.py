@@ -0,0 +1,237 @@
+"""This module connects fleets of Bittles concurrently.
+
+connect_fleet() brings up a list of robot specs in parallel with bounded
+concurrency. Bluetooth devices are discovered once for the whole fleet and
+CH340 serial ports are listed once and handed out, then every robot is
+connected in its own worker and a per-robot report (connect time, failure
+reason) is returned. A failed discovery only fails the robots that needed
+it.
+"""
+
+import copy
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import serial.tools.list_ports
+
+from pyBittle.bittleManager import Bittle
+
+
+__author__ = "EnriqueMoran"
+
+
+class RobotSpec:
+    """Describes how to connect one Bittle.
+
+    Attributes
+    ----------
+    transport : str
+        'bluetooth', 'serial' or 'wifi'.
+    name : str
+        Bluetooth device name, any Bittle found if None.
+    address : str
+        Bluetooth MAC address, skips name lookup if set.
+    port : str
+        Serial port, any free CH340 port if None.
+    ip : str
+        Bittle IP address (WiFi).
+    bittle : Bittle
+        Bittle instance to use, a new one is created if None.
+    """
+
+    __slots__ = ('transport', 'name', 'address', 'port', 'ip', 'bittle')
+
+    def __init__(self, transport, name=None, address=None, port=None,
+                 ip=None, bittle=None):
+        if transport not in ('bluetooth', 'serial', 'wifi'):
+            raise ValueError("Transport must be 'bluetooth', 'serial' or "
+                             "'wifi'.")
+        if transport == 'wifi' and not ip:
+            raise ValueError("WiFi robots need an ip.")
+        self.transport = transport
+        self.name = name
+        self.address = address
+        self.port = port
+        self.ip = ip
+        self.bittle = bittle
+
+    def __repr__(self):
+        target = self.address or self.name or self.port or self.ip or 'any'
+        return f"RobotSpec - transport: {self.transport}, target: {target}"
+
+
+class ConnectReport:
+    """Result of connecting one Bittle.
+
+    Attributes
+    ----------
+    spec : RobotSpec
+        Connected spec (a copy of the given one, with its assigned target).
+    bittle : Bittle
+        Bittle instance.
+    connected : bool
+        Whether the connection succeeded.
+    elapsed : float
+        Connection time, excluding shared discovery (seconds).
+    error : str
+        Failure reason, None if connected.
+    """
+
+    __slots__ = ('spec', 'bittle', 'connected', 'elapsed', 'error')
+
+    def __init__(self, spec, bittle, connected, elapsed, error=None):
+        self.spec = spec
+        self.bittle = bittle
+        self.connected = connected
+        self.elapsed = elapsed
+        self.error = error
+
+    def __repr__(self):
+        return f"ConnectReport - {self.spec!r}, connected: " \
+               f"{self.connected}, elapsed: {self.elapsed:.3f}, error: " \
+               f"{self.error}"
+
+
+def _assign_bluetooth(specs, devices):
+    """Sets name and address of bluetooth specs from discovered devices.
+    Specs without a matching device are left without address.
+    """
+    free = [(address, name) for address, name in devices
+            if not any(spec.address == address for spec in specs)]
+    for spec in specs:
+        if spec.address:
+            continue
+        search_name = spec.name or "Petoi"
+        for device in free:
+            address, name = device
+            if search_name in name:
+                spec.name, spec.address = name, address
+                free.remove(device)
+                break
+
+
+def _assign_serial(specs):
+    """Sets port of serial specs without one from free CH340 ports.
+    """
+    used = {spec.port for spec in specs if spec.port}
+    free = [port.device for port in serial.tools.list_ports.comports()
+            if "CH340" in port.description and port.device not in used]
+    for spec in specs:
+        if not spec.port and free:
+            spec.port = free.pop(0)
+
+
+def _connect(spec, bittle, semaphore, error=None):
+    """Connects bittle as described by spec, returns its ConnectReport.
+    If error (shared discovery failure) is set, fails without connecting.
+    """
+    if error is not None:
+        return ConnectReport(spec, bittle, False, 0.0, error)
+    with semaphore:
+        start = time.perf_counter()
+        connected = False
+        error = None
+        try:
+            if spec.transport == 'bluetooth':
+                if spec.address:
+                    manager = bittle.bluetoothManager
+                    manager.name = spec.name or spec.address
+                    manager.address = spec.address
+                    connected = manager.connect()
+                    error = None if connected else "Connection failed " \
+                        "(no boot banner received)."
+                else:
+                    error = "Bittle not found among discovered devices."
+            elif spec.transport == 'serial':
+                if spec.port:
+                    bittle.serialManager.port = spec.port
+                    connected = bittle.connect_serial(discover_port=False)
+                    error = None if connected else "Connection failed " \
+                        "(no boot banner received)."
+                else:
+                    error = "No free CH340 serial port found."
+            else:
+                bittle.wifiManager.ip = spec.ip
+                connected = bittle.has_wifi_connection()
+                error = None if connected else "REST API not reachable."
+        except Exception as err:
+            connected = False
+            error = f"{type(err).__name__}: {err!s}"
+        return ConnectReport(spec, bittle, connected,
+                             time.perf_counter() - start, error)
+
+
+def _discovery_failed(specs, errors, transport, target, err):
+    """Records err as the failure of every transport spec without target.
+    """
+    error = f"Discovery failed: {type(err).__name__}: {err!s}"
+    for index, spec in enumerate(specs):
+        if spec.transport == transport and not getattr(spec, target):
+            errors[index] = error
+
+
+def connect_fleet(specs, max_workers=8, max_bluetooth=4, factory=Bittle):
+    """Connects every spec concurrently. Bluetooth and serial specs without
+    target get the discovered device or port assigned to them.
+
+    Parameters:
+        specs ([RobotSpec]) : Robots to connect.
+        max_workers (int) : Maximum concurrent connections.
+        max_bluetooth (int) : Maximum concurrent Bluetooth connections
+        (adapters handle few connection attempts at once).
+        factory (callable) : Creates Bittle instances for specs without
+        one (Bittle, CompactBittle...).
+
+    Returns:
+        reports ([ConnectReport]) : One report per spec, same order. Given
+        specs are not modified, reports hold copies.
+    """
+    specs = [copy.copy(spec) for spec in specs]  # Targets are assigned
+    bittles = [spec.bittle if spec.bittle is not None else factory()
+               for spec in specs]
+    errors = {}  # Spec index : shared discovery failure
+    bluetooth_specs = [spec for spec in specs
+                       if spec.transport == 'bluetooth']
+    if any(not spec.address for spec in bluetooth_specs):
+        # Single discovery scan shared by every Bluetooth robot
+        manager = next(bittle.bluetoothManager for spec, bittle
+                       in zip(specs, bittles)
+                       if spec.transport == 'bluetooth')
+        try:
+            _assign_bluetooth(bluetooth_specs, manager.get_paired_devices())
+        except Exception as err:
+            _discovery_failed(specs, errors, 'bluetooth', 'address', err)
+    if any(spec.transport == 'serial' and not spec.port for spec in specs):
+        try:
+            _assign_serial([spec for spec in specs
+                            if spec.transport == 'serial'])
+        except Exception as err:
+            _discovery_failed(specs, errors, 'serial', 'port', err)
+
+    unbounded = threading.BoundedSemaphore(max(len(specs), 1))
+    bluetooth = threading.BoundedSemaphore(max_bluetooth)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_connect, spec, bittle,
+                                   bluetooth if spec.transport == 'bluetooth'
+                                   else unbounded, errors.get(index))
+                   for index, (spec, bittle)
+                   in enumerate(zip(specs, bittles))]
+        return [future.result() for future in futures]
+
+
+def summarize(reports):
+    """Returns a text summary of connect_fleet() reports.
+    """
+    connected = [report for report in reports if report.connected]
+    lines = [f"Connected {len(connected)} of {len(reports)} Bittles."]
+    if connected:
+        times = sorted(report.elapsed for report in connected)
+        lines.append(f"Connect time min: {times[0]:.2f} s, median: "
+                     f"{times[len(times) // 2]:.2f} s, max: "
+                     f"{times[-1]:.2f} s")
+    for report in reports:
+        if not report.connected:
+            lines.append(f"  {report.spec!r}: {report.error}")
+    return "\n".join(lines)
@@ -0,0 +1,438 @@
+"""This module simulates fleets of Bittles without hardware.
+
+FleetSimulator keeps the state of every virtual Bittle in NumPy arrays and
+advances all of them at once on each tick. SimulatedLink plays the role of
+BluetoothManager, SerialManager and WifiManager, so the regular
+send_command_*/send_movement_*/send_msg_* methods of a Bittle can drive the
+simulation unchanged.
+
+Requires NumPy (pip install pyBittle[sim]), this module is not imported by
+the pyBittle package, import it explicitly.
+"""
+
+import math
+
+import numpy as np
+
+from pyBittle.bittleManager import Bittle, CompactBittle, Direction, Gait
+
+
+__author__ = "EnriqueMoran"
+
+
+BACKWARD_GAIT = 'kbk'
+
+GAITS = [gait.value for gait in Gait] + [BACKWARD_GAIT]
+DIRECTIONS = [direction.value for direction in Direction]
+
+# Calibrated speed (m/s) and turn rate (rad/s) per gait, backward gait last
+GAIT_SPEED = np.array([0.10, 0.05, 0.20, 0.30, 0.07])
+GAIT_TURN_RATE = np.array([0.50, 0.30, 0.70, 0.80, 0.40])
+
+# Speed and turn sign per direction (same order as DIRECTIONS)
+DIRECTION_SPEED = np.array([1.0, 1.0, 1.0, -1.0, -1.0, -1.0])
+DIRECTION_TURN = np.array([0.0, 1.0, -1.0, 0.0, 1.0, -1.0])
+
+KIND_RAW = 0  # Message without modelled effect
+KIND_MOVE = 1  # Gait + direction
+KIND_SKILL = 2  # Command (posture, skill, ...)
+
+NO_SKILL = 0
+
+
+class FleetSimulator:
+    """Vectorized simulator of many virtual Bittles.
+
+    Messages sent through a SimulatedLink are queued and, on step(), go
+    through each robot's simulated link (latency, jitter and loss) and are
+    applied to the robot state. All per robot work is done with NumPy array
+    operations.
+
+    Attributes
+    ----------
+    size : int
+        Number of simulated Bittles.
+    time : float
+        Simulation time (seconds).
+    dt : float
+        Tick duration (seconds).
+    x, y, heading : numpy.ndarray
+        Pose of every Bittle (meters, radians).
+    gait : numpy.ndarray
+        Current gait of every Bittle, index of GAITS.
+    direction : numpy.ndarray
+        Current movement direction, index of DIRECTIONS.
+    moving : numpy.ndarray
+        Whether every Bittle is moving.
+    skill : numpy.ndarray
+        Last skill of every Bittle (Command value, 0 if none).
+    latency, jitter, loss : numpy.ndarray
+        Link one-way latency mean and deviation (seconds) and loss
+        probability of every Bittle.
+    sent, delivered, dropped : numpy.ndarray
+        Message counters of every Bittle.
+
+    Methods
+    -------
+    robot(index):
+        Returns a CompactBittle driving given simulated Bittle.
+    robots():
+        Returns a CompactBittle for every simulated Bittle.
+    set_link(latency=None, jitter=None, loss=None, indices=None):
+        Sets simulated link parameters.
+    send_msg(index, msg):
+        Queues a message for given Bittle.
+    send_msgs(indices, msg):
+        Queues the same message for many Bittles.
+    step():
+        Advances simulation one tick.
+    run(duration):
+        Advances simulation given time.
+    """
+
+    _skills = {msg: command.value for command, msg
+               in Bittle._commands.items()}
+
+    def __init__(self, size, dt=0.02, latency=0.03, jitter=0.01, loss=0.0,
+                 seed=None):
+        if not (isinstance(size, int) and size > 0):
+            raise TypeError("Size must be int, greater than 0.")
+        if not (isinstance(dt, (int, float)) and dt > 0):
+            raise TypeError("Tick duration must be number, greater than 0.")
+        self._size = size
+        self._dt = float(dt)
+        self._time = 0.0
+        self._rng = np.random.default_rng(seed)
+        self.x = np.zeros(size)
+        self.y = np.zeros(size)
+        self.heading = np.zeros(size)
+        self.gait = np.zeros(size, dtype=np.int8)
+        self.direction = np.zeros(size, dtype=np.int8)
+        self.moving = np.zeros(size, dtype=bool)
+        self.skill = np.zeros(size, dtype=np.int16)
+        self.latency = np.full(size, float(latency))
+        self.jitter = np.full(size, float(jitter))
+        self.loss = np.full(size, float(loss))
+        self.sent = np.zeros(size, dtype=np.int64)
+        self.delivered = np.zeros(size, dtype=np.int64)
+        self.dropped = np.zeros(size, dtype=np.int64)
+        self._acks = np.zeros(size, dtype=np.int64)  # Echoes not yet read
+        # Message table: code -> (kind, gait, direction, skill)
+        self._codes = {}
+        self._code_rows = []
+        self._code_table = np.zeros((0, 4), dtype=np.int16)
+        # Messages sent since last tick
+        self._new_index = []
+        self._new_code = []
+        self._new_time = []
+        # Messages travelling through the links
+        self._pending_index = np.zeros(0, dtype=np.int64)
+        self._pending_code = np.zeros(0, dtype=np.int64)
+        self._pending_time = np.zeros(0)
+
+    def __repr__(self):
+        return f"FleetSimulator - size: {self.size}, time: {self.time}, " \
+               f"dt: {self.dt}, pending: {self.pending}"
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def dt(self):
+        return self._dt
+
+    @dt.setter
+    def dt(self, new_dt):
+        if isinstance(new_dt, (int, float)) and new_dt > 0:
+            self._dt = float(new_dt)
+        else:
+            raise TypeError("Tick duration must be number, greater than 0.")
+
+    @property
+    def pending(self):
+        return len(self._pending_index) + len(self._new_index)
+
+    def robot(self, index):
+        """Returns a CompactBittle whose managers are links to the simulated
+        Bittle at given index.
+
+        Parameters:
+            index (int) : Simulated Bittle index.
+        """
+        if not (isinstance(index, int) and 0 <= index < self.size):
+            raise IndexError("Index out of fleet range.")
+        link = SimulatedLink(self, index)
+        bittle = CompactBittle()
+        bittle.bluetoothManager = link
+        bittle.serialManager = link
+        bittle.wifiManager = link
+        return bittle
+
+    def robots(self):
+        """Returns a list with a CompactBittle for every simulated Bittle.
+        """
+        return [self.robot(index) for index in range(self.size)]
+
+    def set_link(self, latency=None, jitter=None, loss=None, indices=None):
+        """Sets simulated link parameters.
+
+        Parameters:
+            latency (float or array) : One-way latency mean (seconds).
+            jitter (float or array) : One-way latency deviation (seconds).
+            loss (float or array) : Loss probability (0 to 1).
+            indices (array) : Bittles to update, all of them if None.
+        """
+        target = slice(None) if indices is None else indices
+        if latency is not None:
+            self.latency[target] = latency
+        if jitter is not None:
+            self.jitter[target] = jitter
+        if loss is not None:
+            self.loss[target] = loss
+
+    def _code(self, msg):
+        """Returns the code of given message, decoding it the first time.
+        """
+        code = self._codes.get(msg)
+        if code is None:
+            if not (isinstance(msg, str) and msg):
+                raise TypeError("Message must be non empty str.")
+            code = len(self._code_rows)
+            self._codes[msg] = code
+            self._code_rows.append(self._decode(msg))
+        return code
+
+    def _decode(self, msg):
+        """Returns (kind, gait, direction, skill) modelling given message.
+        """
+        if msg in self._skills:
+            return KIND_SKILL, 0, 0, self._skills[msg]
+        for gait, prefix in enumerate(GAITS):
+            suffix = msg[len(prefix):]
+            if msg.startswith(prefix) and suffix:
+                if prefix == BACKWARD_GAIT:
+                    suffix = 'B' + suffix
+                if suffix in DIRECTIONS:
+                    return KIND_MOVE, gait, DIRECTIONS.index(suffix), \
+                        NO_SKILL
+        return KIND_RAW, 0, 0, NO_SKILL
+
+    def send_msg(self, index, msg):
+        """Queues a message for given Bittle, it will go through the
+        simulated link on next step().
+
+        Parameters:
+            index (int) : Simulated Bittle index.
+            msg (str) : Message to send.
+        """
+        code = self._code(msg)
+        self._new_index.append(index)
+        self._new_code.append(code)
+        self._new_time.append(self._time)
+
+    def send_msgs(self, indices, msg):
+        """Queues the same message for many Bittles.
+
+        Parameters:
+            indices (array) : Simulated Bittle indices.
+            msg (str) : Message to send.
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        code = self._code(msg)
+        self._new_index.extend(indices.tolist())
+        self._new_code.extend([code] * len(indices))
+        self._new_time.extend([self._time] * len(indices))
+
+    def _transmit(self):
+        """Moves messages sent since last tick into the links, drawing
+        their loss and latency.
+        """
+        if not self._new_index:
+            return
+        index = np.array(self._new_index, dtype=np.int64)
+        code = np.array(self._new_code, dtype=np.int64)
+        sent_at = np.array(self._new_time)
+        self._new_index, self._new_code, self._new_time = [], [], []
+        np.add.at(self.sent, index, 1)
+        lost = self._rng.random(len(index)) < self.loss[index]
+        np.add.at(self.dropped, index[lost], 1)
+        index, code, sent_at = index[~lost], code[~lost], sent_at[~lost]
+        delay = self.latency[index] + \
+            self.jitter[index] * self._rng.standard_normal(len(index))
+        arrival = sent_at + np.maximum(delay, 0.0)
+        self._pending_index = np.concatenate((self._pending_index, index))
+        self._pending_code = np.concatenate((self._pending_code, code))
+        self._pending_time = np.concatenate((self._pending_time, arrival))
+
+    def _deliver(self):
+        """Applies every message that reached its Bittle, in arrival
+        order.
+        """
+        due = self._pending_time <= self._time
+        if not due.any():
+            return
+        order = np.argsort(self._pending_time[due], kind='stable')
+        index = self._pending_index[due][order]
+        code = self._pending_code[due][order]
+        self._pending_index = self._pending_index[~due]
+        self._pending_code = self._pending_code[~due]
+        self._pending_time = self._pending_time[~due]
+        np.add.at(self.delivered, index, 1)
+        np.add.at(self._acks, index, 1)
+
+        if len(self._code_table) != len(self._code_rows):
+            self._code_table = np.array(self._code_rows, dtype=np.int16)
+        rows = self._code_table[code]
+        modelled = rows[:, 0] != KIND_RAW
+        index, rows = index[modelled], rows[modelled]
+        # Last message per Bittle wins
+        reversed_index = index[::-1]
+        _, last = np.unique(reversed_index, return_index=True)
+        last = len(index) - 1 - last
+        index, rows = index[last], rows[last]
+
+        move = rows[:, 0] == KIND_MOVE
+        self.moving[index] = move
+        self.gait[index[move]] = rows[move, 1]
+        self.direction[index[move]] = rows[move, 2]
+        self.skill[index[~move]] = rows[~move, 3]
+
+    def step(self):
+        """Advances simulation one tick.
+        """
+        self._transmit()
+        self._time += self._dt
+        self._deliver()
+        moving = self.moving
+        speed = GAIT_SPEED[self.gait] * DIRECTION_SPEED[self.direction] * \
+            moving
+        turn = GAIT_TURN_RATE[self.gait] * DIRECTION_TURN[self.direction] * \
+            moving
+        self.heading += turn * self._dt
+        np.remainder(self.heading, 2 * math.pi, out=self.heading)
+        self.x += np.cos(self.heading) * speed * self._dt
+        self.y += np.sin(self.heading) * speed * self._dt
+
+    def run(self, duration):
+        """Advances simulation given time.
+
+        Parameters:
+            duration (float) : Time to simulate (seconds).
+        """
+        for _ in range(max(int(round(duration / self._dt)), 1)):
+            self.step()
+
+    def _take_ack(self, index):
+        """Returns True and consumes an echo if given Bittle has one
+        pending.
+        """
+        if self._acks[index]:
+            self._acks[index] -= 1
+            return True
+        return False
+
+
+class SimulatedLink:
+    """Link to a simulated Bittle, usable as BluetoothManager,
+    SerialManager or WifiManager.
+
+    Attributes
+    ----------
+    fleet : FleetSimulator
+        Simulator owning the Bittle.
+    index : int
+        Simulated Bittle index.
+
+    Methods
+    -------
+    send_msg(msg):
+        Sends a message to the simulated Bittle.
+    recv_msg(buffer_size=1024):
+        Returns an echo from the simulated Bittle, empty if none.
+    recv_view():
+        Same as recv_msg(), as a memoryview.
+    connect():
+        Returns True, simulated links are always connected.
+    has_connection():
+        Returns True.
+    close_connection():
+        Does nothing.
+    close():
+        Does nothing.
+    """
+
+    __slots__ = ('_fleet', '_index')
+
+    ACK = b'k\r\n'
+
+    def __init__(self, fleet, index):
+        self._fleet = fleet
+        self._index = index
+
+    def __repr__(self):
+        return f"SimulatedLink - index: {self.index}"
+
+    @property
+    def fleet(self):
+        return self._fleet
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def name(self):
+        return f"SimBittle-{self.index}"
+
+    @property
+    def address(self):
+        return f"sim:{self.index}"
+
+    ip = address
+    port = address
+
+    def send_msg(self, msg):
+        """Sends a message to the simulated Bittle.
+
+        Returns:
+            res (int) : 200, as WifiManager.send_msg does on success.
+        """
+        self._fleet.send_msg(self._index, msg)
+        return 200
+
+    def recv_msg(self, buffer_size=1024):
+        """Returns an echo from the simulated Bittle, empty if none.
+        """
+        return self.ACK if self._fleet._take_ack(self._index) else b''
+
+    def recv_view(self):
+        return memoryview(self.recv_msg())
+
+    def initialize_name_and_address(self, get_first_bittle=True):
+        return self.name, self.address
+
+    def discover_port(self):
+        return True
+
+    def initialize(self):
+        pass
+
+    def connect(self):
+        return True
+
+    def has_connection(self):
+        return True
+
+    def close_connection(self):
+        pass
+
+    def close(self):
+        pass
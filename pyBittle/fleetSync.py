@@ -0,0 +1,320 @@
+"""This module synchronizes group actions across a fleet of Bittles.
+
+Every link (RFCOMM, serial, HTTP) takes a different and varying time to
+deliver a message, so sending a command to many Bittles at once makes them
+start it at different times. FleetSync estimates each robot's one-way
+latency and jitter from echo round-trips (as NTP does, half the round-trip
+time, smoothed), and schedules each robot's send so that every message
+lands at the same instant: the slowest links are written first.
+
+Estimates are updated by every group action (its replies are echoes too)
+and, optionally, by periodic probes in background. After each group action
+the start skew (spread of the estimated arrival times, measured from that
+action's own round-trips) is reported.
+"""
+
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyBittle.bittleManager import Bittle, Command
+
+
+__author__ = "EnriqueMoran"
+
+
+_SPIN = 0.002  # Last seconds before a send are busy-waited, sleep is coarse
+
+
+class LatencyEstimate:
+    """Smoothed one-way latency of one robot's link.
+
+    Attributes
+    ----------
+    owd : float
+        One-way delay estimate (seconds), half the smoothed round-trip time.
+    jitter : float
+        Smoothed deviation of the one-way delay (seconds).
+    samples : int
+        Round-trips measured.
+    lost : int
+        Echoes not received.
+    """
+
+    __slots__ = ('owd', 'jitter', 'samples', 'lost')
+
+    def __init__(self):
+        self.owd = 0.0
+        self.jitter = 0.0
+        self.samples = 0
+        self.lost = 0
+
+    def __repr__(self):
+        return f"LatencyEstimate - owd: {self.owd:.4f}, jitter: " \
+               f"{self.jitter:.4f}, samples: {self.samples}, lost: " \
+               f"{self.lost}"
+
+    def update(self, rtt, alpha, beta):
+        """Adds a round-trip time sample (seconds).
+        """
+        owd = rtt / 2
+        if not self.samples:
+            self.owd = owd
+            self.jitter = owd / 2
+        else:
+            self.jitter += beta * (abs(owd - self.owd) - self.jitter)
+            self.owd += alpha * (owd - self.owd)
+        self.samples += 1
+
+
+class SyncReport:
+    """Result of a group action.
+
+    Attributes
+    ----------
+    msg : str
+        Message sent.
+    target : float
+        time.perf_counter() at which messages were meant to land.
+    send_times : [float]
+        time.perf_counter() at which each message was written.
+    rtts : [float]
+        Measured round-trip time of each message, None if no echo.
+    arrivals : [float]
+        Estimated arrival time of each message (send time plus half its
+        round-trip time), None if no echo.
+    """
+
+    __slots__ = ('msg', 'target', 'send_times', 'rtts', 'arrivals')
+
+    def __init__(self, msg, target, send_times, rtts):
+        self.msg = msg
+        self.target = target
+        self.send_times = send_times
+        self.rtts = rtts
+        self.arrivals = [None if rtt is None else sent + rtt / 2
+                         for sent, rtt in zip(send_times, rtts)]
+
+    def __repr__(self):
+        skew = "unknown" if self.skew is None else f"{self.skew * 1e3:.2f} ms"
+        return f"SyncReport - msg: {self.msg}, robots: " \
+               f"{len(self.send_times)}, echoes: " \
+               f"{sum(rtt is not None for rtt in self.rtts)}, skew: {skew}"
+
+    @property
+    def skew(self):
+        """Spread of estimated arrival times (seconds), None if fewer than
+        two echoes were received.
+        """
+        arrivals = [arrival for arrival in self.arrivals
+                    if arrival is not None]
+        if len(arrivals) < 2:
+            return None
+        return max(arrivals) - min(arrivals)
+
+    @property
+    def send_spread(self):
+        """Spread of send times (seconds): how far apart messages were
+        written to compensate the links' latencies.
+        """
+        return max(self.send_times) - min(self.send_times)
+
+
+class FleetSync:
+    """Latency-compensated group actions.
+
+    Attributes
+    ----------
+    members : [(Bittle, str)]
+        Robots and the transport ('bluetooth', 'serial' or 'wifi') used to
+        reach each one.
+    estimates : [LatencyEstimate]
+        Latency estimate of every member.
+    probe_msg : str
+        Message used to probe Bluetooth and serial links (its echo is
+        timed), None to only learn from group actions. WiFi links are
+        probed with health checks.
+    k : float
+        Jitter multiplier of the scheduling lead.
+    margin : float
+        Extra scheduling lead (seconds), time to start sending.
+
+    Methods
+    -------
+    probe(rounds=3):
+        Measures every link's round-trip time.
+    start(interval=10.0):
+        Probes periodically in background.
+    stop():
+        Stops probing in background.
+    send_msg(msg):
+        Sends a message to every member, landing at the same time.
+    send_command(command):
+        Sends a command to every member, landing at the same time.
+    """
+
+    def __init__(self, members, probe_msg=None, alpha=0.125, beta=0.25,
+                 k=2.0, margin=0.01):
+        self.members = [(bittle, transport) for bittle, transport in members]
+        for _, transport in self.members:
+            if transport not in ('bluetooth', 'serial', 'wifi'):
+                raise ValueError("Transport must be 'bluetooth', 'serial' "
+                                 "or 'wifi'.")
+        self.estimates = [LatencyEstimate() for _ in self.members]
+        self.probe_msg = probe_msg
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.margin = margin
+        self._lock = threading.Lock()
+        # One exchange per link at a time, probes and group actions alike
+        self._link_locks = [threading.Lock() for _ in self.members]
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(len(self.members), 1),
+            thread_name_prefix="pyBittle-sync")
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f"FleetSync - members: {len(self.members)}, lead: " \
+               f"{self.lead():.4f}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _manager(self, index):
+        bittle, transport = self.members[index]
+        return getattr(bittle, transport + 'Manager')
+
+    def _exchange(self, index, msg, at=None):
+        """Sends msg to a member (at given time.perf_counter() if set) and
+        waits for its echo. Returns (send time, round-trip time or None).
+        """
+        with self._link_locks[index]:
+            return self._timed_exchange(index, msg, at)
+
+    def _timed_exchange(self, index, msg, at):
+        manager = self._manager(index)
+        transport = self.members[index][1]
+        if at is not None:
+            delay = at - time.perf_counter() - _SPIN
+            if delay > 0:
+                time.sleep(delay)
+            while time.perf_counter() < at:
+                pass
+        start = time.perf_counter()
+        try:
+            if transport == 'wifi':
+                if msg is None:
+                    status = manager.check_health(max_age=0)
+                    return start, status.latency
+                ok = manager.send_msg(msg) not in (-1, None)
+            else:
+                ok = manager.send_msg(msg) is not False and \
+                    bool((getattr(manager, 'recv_line', None) or
+                          manager.recv_msg)())
+        except (OSError, ValueError):  # socket.error, SerialException...
+            ok = False
+        return start, time.perf_counter() - start if ok else None
+
+    def _record(self, index, rtt):
+        estimate = self.estimates[index]
+        with self._lock:
+            if rtt is None:
+                estimate.lost += 1
+            else:
+                estimate.update(rtt, self.alpha, self.beta)
+
+    def probe(self, rounds=3):
+        """Measures every link's round-trip time, rounds times (all links
+        at once). Bluetooth and serial links are only probed if probe_msg
+        is set.
+        """
+        indices = [index for index, (_, transport) in enumerate(self.members)
+                   if transport == 'wifi' or self.probe_msg is not None]
+        for _ in range(rounds):
+            futures = [(index, self._executor.submit(
+                        self._exchange, index,
+                        None if self.members[index][1] == 'wifi'
+                        else self.probe_msg)) for index in indices]
+            for index, future in futures:
+                self._record(index, future.result()[1])
+
+    def start(self, interval=10.0):
+        """Probes every link each interval seconds in background.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name="pyBittle-sync-probe",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Stops probing and releases worker threads.
+        """
+        self.stop()
+        self._executor.shutdown()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.probe(rounds=1)
+
+    def lead(self):
+        """Returns the time needed between scheduling a group action and
+        its landing (seconds): the slowest link's latency plus its jitter
+        margin.
+        """
+        with self._lock:
+            return max((estimate.owd + self.k * estimate.jitter
+                        for estimate in self.estimates), default=0.0) + \
+                self.margin
+
+    def send_msg(self, msg):
+        """Sends a message to every member so that they receive it at the
+        same time. Links without estimates are probed first.
+
+        Parameters:
+            msg (str) : Message to send.
+
+        Returns:
+            report (SyncReport) : Send times, round-trip times and skew.
+        """
+        if not (isinstance(msg, str) and msg):
+            raise TypeError("Message must be non empty str.")
+        if any(not estimate.samples for estimate in self.estimates):
+            self.probe()
+        target = time.perf_counter() + self.lead()
+        with self._lock:
+            send_at = [target - estimate.owd for estimate in self.estimates]
+        for bittle, _ in self.members:
+            bittle._should_send(msg, True)  # Keep state caches up to date
+        futures = [self._executor.submit(self._exchange, index, msg, at)
+                   for index, at in enumerate(send_at)]
+        results = [future.result() for future in futures]
+        for index, (_, rtt) in enumerate(results):
+            self._record(index, rtt)
+        return SyncReport(msg, target, [sent for sent, _ in results],
+                          [rtt for _, rtt in results])
+
+    def send_command(self, command):
+        """Sends a command to every member, see send_msg().
+
+        Parameters:
+            command (Command) : Command to send.
+        """
+        if isinstance(command, Command):
+            return self.send_msg(Bittle._commands[command])
+        else:
+            raise TypeError("Command type must be Command.")
@@ -0,0 +1,229 @@
+"""This module limits the bytes in flight to Bittle.
+
+Bittle's microcontroller reads commands from a small input buffer (64 bytes
+on the NyBoard's ATmega328P), and bytes written faster than it consumes
+them are lost or corrupted without notice. FlowController keeps count of
+the bytes written and not yet consumed (a message is consumed when its
+reply line is received, or after release_after seconds if no reply comes)
+and holds, rejects or drops writes that would exceed the robot's buffer
+budget.
+"""
+
+import collections
+import threading
+import time
+
+
+__author__ = "EnriqueMoran"
+
+
+POLICIES = ('block', 'nonblock', 'drop')
+
+
+class FlowController:
+    """Outstanding-bytes accounting against a robot-side buffer budget.
+
+    Managers call reserve() before writing a message, written() after
+    writing it and received() with every reply. A message larger than the
+    budget is only written when nothing else is outstanding.
+
+    Limits: replies are not matched with messages, any received line
+    (debug prints and telemetry included) releases the oldest message, so
+    unsolicited lines let writes overrun the budget. A WriteBatcher batch
+    is reserved and written at once, so a batch larger than the budget
+    still goes out when nothing is outstanding; keep WriteBatcher.max_bytes
+    within the budget.
+
+    Attributes
+    ----------
+    budget : int
+        Bytes Bittle can buffer.
+    policy : str
+        What to do when a write does not fit: 'block' waits for room (up to
+        timeout, then raises TimeoutError), 'nonblock' raises
+        BlockingIOError and 'drop' discards the message.
+    timeout : float
+        Maximum wait of 'block' policy (seconds), None to wait forever.
+    release_after : float
+        Seconds after which a message without reply is considered consumed,
+        None to wait for its reply.
+    outstanding : int
+        Bytes written and not consumed yet.
+
+    Methods
+    -------
+    reserve(size):
+        Waits for, or checks, room for size bytes.
+    written(size, partial=0, messages=None):
+        Registers the write of a reserved message.
+    cancel(size, timed_out=False):
+        Releases a reservation whose write failed.
+    received(data):
+        Releases the messages answered by data.
+    clear():
+        Forgets every outstanding message.
+    stats():
+        Returns write and overrun counters.
+    reset():
+        Resets counters.
+    """
+
+    def __init__(self, budget=64, policy='block', timeout=None,
+                 release_after=0.5):
+        if not (isinstance(budget, int) and budget > 0):
+            raise TypeError("Budget must be int, greater than 0.")
+        if policy not in POLICIES:
+            raise ValueError("Policy must be 'block', 'nonblock' or "
+                             "'drop'.")
+        self.budget = budget
+        self.policy = policy
+        self.timeout = timeout
+        self.release_after = release_after
+        self._condition = threading.Condition()
+        self._messages = collections.deque()  # [size, written_at]
+        self._reserved = 0
+        self.outstanding = 0
+        self.reset()
+
+    def __repr__(self):
+        return f"FlowController - budget: {self.budget}, policy: " \
+               f"{self.policy}, outstanding: {self.outstanding}"
+
+    def reset(self):
+        """Resets counters.
+        """
+        self.writes = 0
+        self.bytes_written = 0
+        self.partial_writes = 0
+        self.write_timeouts = 0
+        self.overruns = 0  # Writes that did not fit in the budget
+        self.blocked_time = 0.0
+        self.rejected = 0
+        self.dropped = 0
+        self.expired = 0
+
+    def _fits(self, size):
+        in_flight = self.outstanding + self._reserved
+        return in_flight + size <= self.budget or in_flight == 0
+
+    def _expire(self, now):
+        """Releases messages older than release_after.
+        """
+        if self.release_after is None:
+            return
+        while self._messages and \
+                now - self._messages[0][1] >= self.release_after:
+            self.outstanding -= self._messages.popleft()[0]
+            self.expired += 1
+
+    def _next_expiry(self, now):
+        if self.release_after is None or not self._messages:
+            return None
+        return max(self._messages[0][1] + self.release_after - now, 0.0)
+
+    def reserve(self, size):
+        """Reserves room for a size bytes message.
+
+        Returns:
+            res (bool) : True if the message may be written, False if it
+            must be dropped ('drop' policy).
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._expire(now)
+            if not self._fits(size):
+                self.overruns += 1
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'nonblock':
+                    self.rejected += 1
+                    raise BlockingIOError(f"No room for {size} bytes, "
+                                          f"{self.outstanding} outstanding.")
+                start = now
+                deadline = None if self.timeout is None \
+                    else now + self.timeout
+                while not self._fits(size):
+                    wait = self._next_expiry(now)
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.blocked_time += now - start
+                            raise TimeoutError(f"No room for {size} bytes "
+                                               f"after {self.timeout} s.")
+                        wait = deadline - now if wait is None \
+                            else min(wait, deadline - now)
+                    self._condition.wait(wait)
+                    now = time.monotonic()
+                    self._expire(now)
+                self.blocked_time += now - start
+            self._reserved += size
+            return True
+
+    def written(self, size, partial=0, messages=None):
+        """Registers that a reserved message was written.
+
+        Parameters:
+            size (int) : Reserved size.
+            partial (int) : Extra write calls needed to write it.
+            messages ([int]) : Sizes of the messages packed in the write
+            (see pyBittle.writeBatcher), each answered by its own reply,
+            None if it is a single message.
+        """
+        with self._condition:
+            self._reserved -= size
+            self.outstanding += size
+            now = time.monotonic()
+            for message in (size,) if messages is None else messages:
+                self._messages.append([message, now])
+            self.writes += 1
+            self.bytes_written += size
+            self.partial_writes += partial
+
+    def cancel(self, size, timed_out=False):
+        """Releases a reservation whose write failed.
+
+        Parameters:
+            size (int) : Reserved size.
+            timed_out (bool) : Whether the write timed out.
+        """
+        with self._condition:
+            self._reserved -= size
+            if timed_out:
+                self.write_timeouts += 1
+            self._condition.notify_all()
+
+    def received(self, data):
+        """Releases one outstanding message per reply line in data.
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        lines = data.count(b'\n') if data else 0
+        if not lines:
+            return
+        with self._condition:
+            for _ in range(min(lines, len(self._messages))):
+                self.outstanding -= self._messages.popleft()[0]
+            self._condition.notify_all()
+
+    def clear(self):
+        """Forgets every outstanding message (e.g. after reconnecting).
+        """
+        with self._condition:
+            self._messages.clear()
+            self.outstanding = 0
+            self._condition.notify_all()
+
+    def stats(self):
+        """Returns {'outstanding', 'writes', 'bytes_written',
+        'partial_writes', 'write_timeouts', 'overruns', 'blocked_time',
+        'rejected', 'dropped', 'expired'}.
+        """
+        with self._condition:
+            return {'outstanding': self.outstanding, 'writes': self.writes,
+                    'bytes_written': self.bytes_written,
+                    'partial_writes': self.partial_writes,
+                    'write_timeouts': self.write_timeouts,
+                    'overruns': self.overruns,
+                    'blocked_time': self.blocked_time,
+                    'rejected': self.rejected, 'dropped': self.dropped,
+                    'expired': self.expired}
@@ -0,0 +1,297 @@
+"""This module routes messages over several links at once.
+
+LinkRouter keeps Bittle's Bluetooth, serial and WiFi links open together,
+measures each link's round-trip time and error rate on every message, and
+sends each message over the fastest healthy link, failing over to the next
+one as soon as a link fails.
+"""
+
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyBittle.bittleManager import Command, Direction, movement_msg
+
+
+__author__ = "EnriqueMoran"
+
+
+TRANSPORTS = ('serial', 'bluetooth', 'wifi')  # Default preference order
+
+_MANAGERS = {'bluetooth': 'bluetoothManager', 'serial': 'serialManager',
+             'wifi': 'wifiManager'}
+
+# Round-trip time assumed for links not measured yet (seconds)
+_INITIAL_RTT = {'serial': 0.01, 'bluetooth': 0.05, 'wifi': 0.1}
+
+
+class LinkStats:
+    """Live statistics of one link.
+
+    Attributes
+    ----------
+    transport : str
+        'bluetooth', 'serial' or 'wifi'.
+    connected : bool
+        Whether the link was opened.
+    rtt : float
+        Smoothed round-trip time (seconds).
+    error_rate : float
+        Smoothed failure ratio (0 to 1).
+    consecutive_failures : int
+        Failures since last success.
+    sent : int
+        Messages sent through the link.
+    failures : int
+        Messages that failed through the link.
+    down_until : float
+        time.monotonic() until which the link is not used.
+    """
+
+    __slots__ = ('transport', 'connected', 'rtt', 'error_rate',
+                 'consecutive_failures', 'sent', 'failures', 'down_until')
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.connected = False
+        self.rtt = _INITIAL_RTT[transport]
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.sent = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def __repr__(self):
+        return f"LinkStats - transport: {self.transport}, connected: " \
+               f"{self.connected}, rtt: {self.rtt:.4f}, error_rate: " \
+               f"{self.error_rate:.3f}, sent: {self.sent}, failures: " \
+               f"{self.failures}"
+
+
+class LinkRouter:
+    """Sends messages to Bittle over its fastest healthy link.
+
+    A link is unhealthy after max_failures consecutive failures or when its
+    error rate goes over max_error_rate; it is then skipped for cooldown
+    seconds and probed again with the next message.
+
+    Attributes
+    ----------
+    bittle : Bittle
+        Bittle whose managers are used.
+    links : {str: LinkStats}
+        Statistics of every link.
+    wait_echo : bool
+        If True, Bluetooth and serial sends wait for Bittle's reply to
+        measure round-trip time and detect failures. A lost reply takes the
+        manager's receive timeout to detect.
+    resend_unconfirmed : bool
+        If True, a message written but whose reply was lost is sent again
+        over the next link (Bittle may execute it twice). False by default:
+        the message is considered sent, only the link is marked as failing.
+    alpha : float
+        Smoothing factor of rtt and error_rate.
+    max_failures : int
+        Consecutive failures that mark a link as unhealthy.
+    max_error_rate : float
+        Error rate that marks a link as unhealthy.
+    cooldown : float
+        Seconds an unhealthy link is skipped.
+
+    Methods
+    -------
+    connect():
+        Opens every available link, returns the connected ones.
+    healthy_links():
+        Returns healthy links, fastest first.
+    send_msg(msg, critical=False, force=False):
+        Sends a message over the best link.
+    send_command(command, critical=False, force=False):
+        Sends a command over the best link.
+    send_movement(direction, critical=False, force=False):
+        Sends a movement with Bittle's current gait over the best link.
+    close():
+        Closes every link.
+    """
+
+    def __init__(self, bittle, transports=TRANSPORTS, wait_echo=True,
+                 alpha=0.2, max_failures=2, max_error_rate=0.5, cooldown=5.0,
+                 resend_unconfirmed=False):
+        if not transports or any(transport not in _MANAGERS
+                                 for transport in transports):
+            raise ValueError(f"Transports must be some of {TRANSPORTS}.")
+        self.bittle = bittle
+        self.links = {transport: LinkStats(transport)
+                      for transport in transports}
+        self.wait_echo = wait_echo
+        self.resend_unconfirmed = resend_unconfirmed
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __repr__(self):
+        return f"LinkRouter - links: {list(self.links.values())}"
+
+    def connect(self):
+        """Opens every link of self.links that can be opened.
+
+        Returns:
+            res ([str]) : Connected transports.
+        """
+        for transport, link in self.links.items():
+            try:
+                if transport == 'bluetooth':
+                    link.connected = self.bittle.connect_bluetooth()
+                elif transport == 'serial':
+                    link.connected = self.bittle.connect_serial()
+                else:
+                    link.connected = bool(self.bittle.wifiManager.ip) and \
+                        self.bittle.has_wifi_connection()
+            except (OSError, ValueError):
+                link.connected = False
+        return [transport for transport, link in self.links.items()
+                if link.connected]
+
+    def healthy_links(self):
+        """Returns connected links not in cooldown, fastest first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            links = [link for link in self.links.values()
+                     if link.connected and link.down_until <= now]
+        return sorted(links, key=lambda link: link.rtt)
+
+    def _record(self, link, ok, elapsed):
+        with self._lock:
+            link.sent += 1
+            link.error_rate += self.alpha * ((not ok) - link.error_rate)
+            if ok:
+                link.rtt += self.alpha * (elapsed - link.rtt)
+                link.consecutive_failures = 0
+            else:
+                link.failures += 1
+                link.consecutive_failures += 1
+                if link.consecutive_failures >= self.max_failures or \
+                        link.error_rate > self.max_error_rate:
+                    link.down_until = time.monotonic() + self.cooldown
+
+    def _send_on(self, link, msg):
+        """Sends msg over link, returns (written, ok): whether msg was
+        written and whether it succeeded (written and its reply received).
+        """
+        manager = getattr(self.bittle, _MANAGERS[link.transport])
+        start = time.perf_counter()
+        written = False
+        try:
+            if link.transport == 'wifi':
+                written = ok = manager.send_msg(msg) == 200
+            else:
+                written = manager.send_msg(msg) is not False
+                ok = written and (not self.wait_echo or
+                                  bool(manager.recv_msg()))
+        except (OSError, ValueError):  # socket.error, SerialException...
+            ok = False
+        self._record(link, ok, time.perf_counter() - start)
+        return written, ok
+
+    def send_msg(self, msg, critical=False, force=False):
+        """Sends a message over the fastest healthy link, trying the next
+        ones if it fails.
+
+        Parameters:
+            msg (str) : Message to send.
+            critical (bool) : If True, send it over the two fastest links at
+            the same time (Bittle may execute it twice).
+            force (bool) : If True, send it even if Bittle's stateCache
+            considers it redundant.
+
+        Returns:
+            res (str) : Transport it was sent through (the fastest one that
+            succeeded if critical), None if skipped by Bittle's stateCache.
+            Unless self.resend_unconfirmed, a message written but whose
+            reply was lost is not sent again: its transport is returned.
+        """
+        if not (isinstance(msg, str) and msg):
+            raise TypeError("Message must be non empty str.")
+        if not self.bittle._should_send(msg, force):
+            return None
+        res = None
+        try:
+            res = self._send_over(msg, critical)
+        finally:
+            if res is None and self.bittle.stateCache is not None:
+                self.bittle.stateCache.invalidate()  # Retries must be sent
+        if res is None:
+            raise ConnectionError("Message could not be sent through any "
+                                  "link.")
+        return res
+
+    def _send_over(self, msg, critical):
+        """Sends msg over the healthy links, see send_msg(). Returns the
+        transport it was sent through, None if every link failed.
+        """
+        links = self.healthy_links()
+        if not links:  # Every link in cooldown, probe them anyway
+            links = sorted((link for link in self.links.values()
+                            if link.connected), key=lambda link: link.rtt)
+        if critical and len(links) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2)
+            futures = [(link, self._executor.submit(self._send_on, link, msg))
+                       for link in links[:2]]
+            results = [(link, future.result()) for link, future in futures]
+            for link, (written, ok) in results:
+                if ok:
+                    return link.transport
+            for link, (written, ok) in results:
+                if written and not self.resend_unconfirmed:
+                    return link.transport
+            links = links[2:]
+        for link in links:
+            written, ok = self._send_on(link, msg)
+            if ok or (written and not self.resend_unconfirmed):
+                return link.transport
+        return None
+
+    def send_command(self, command, critical=False, force=False):
+        """Sends a command over the fastest healthy link, see send_msg().
+
+        Parameters:
+            command (Command) : Command to send.
+        """
+        if isinstance(command, Command):
+            return self.send_msg(self.bittle._commands[command], critical,
+                                 force)
+        else:
+            raise TypeError("Command type must be Command.")
+
+    def send_movement(self, direction, critical=False, force=False):
+        """Sends a movement with Bittle's current gait over the fastest
+        healthy link, see send_msg().
+
+        Parameters:
+            direction (Direction) : Movement direction.
+        """
+        if isinstance(direction, Direction):
+            return self.send_msg(movement_msg(self.bittle.gait, direction),
+                                 critical, force)
+        else:
+            raise TypeError("Direction must be Direction type.")
+
+    def close(self):
+        """Closes every link.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for transport, link in self.links.items():
+            if link.connected:
+                if transport == 'bluetooth':
+                    self.bittle.disconnect_bluetooth()
+                elif transport == 'serial':
+                    self.bittle.disconnect_serial()
+                link.connected = False
@@ -0,0 +1,261 @@
+"""This module tunes serial links: baud rate and timeouts.
+
+tune_serial() probes candidate baud rates, fastest first, against the
+robot's echo (OpenCat answers every message with a line starting with its
+token) on the open port, and keeps the fastest one at which every probe is
+answered (the robot reads probes sent at a wrong rate as garbage, tune the
+link before making it move). The write timeout is then derived from the
+measured round trips, so stuck writes fail fast instead of waiting 5
+seconds, and the inter-byte timeout is set to a few characters' time (it
+only ends multi-byte serial read() calls early, the manager's line reads
+are not affected). The read timeout is kept: OpenCat echoes postures and
+skills once performed, which takes far longer than a probe's round trip.
+Settings are applied to the open port in place, without reconnecting.
+
+Results are cached per device (USB serial number, or vendor, product and
+USB location for adapters without one, as the NyBoard's CH340, falling back
+to the port name) in a JSON file, so later startups only send one probe to
+check the cached settings still work.
+"""
+
+import json
+import os
+import threading
+import time
+
+import serial.tools.list_ports
+
+from pyBittle.transportDispatcher import first_char_matcher
+
+
+__author__ = "EnriqueMoran"
+
+
+BAUDRATES = (1000000, 500000, 250000, 230400, 115200, 57600)
+PROBE_MSG = 'j'  # Prints joint angles, moves nothing
+INTER_BYTE_CHARS = 16  # Inter-byte timeout, in characters' time
+MIN_INTER_BYTE_TIMEOUT = 0.001
+CACHE_PATH = os.environ.get('PYBITTLE_LINK_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'pyBittle', 'serialLinks.json'))
+
+_cache = {}  # Cache file : {device key : settings}
+_cache_lock = threading.Lock()
+
+
+class LinkSettings:
+    """Tuned serial link settings.
+
+    Attributes
+    ----------
+    baudrate : int
+        Baud rate.
+    timeout : float
+        Read timeout (seconds).
+    write_timeout : float
+        Write timeout (seconds).
+    inter_byte_timeout : float
+        Inter-byte timeout (seconds).
+    rtt : float
+        Slowest probe round trip (seconds).
+    cached : bool
+        Whether the settings were read from the cache.
+
+    Methods
+    -------
+    apply(manager):
+        Applies the settings to a SerialManager.
+    """
+
+    __slots__ = ('baudrate', 'timeout', 'write_timeout',
+                 'inter_byte_timeout', 'rtt', 'cached')
+
+    def __init__(self, baudrate, timeout, write_timeout, inter_byte_timeout,
+                 rtt, cached=False):
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.inter_byte_timeout = inter_byte_timeout
+        self.rtt = rtt
+        self.cached = cached
+
+    def __repr__(self):
+        return f"LinkSettings - baudrate: {self.baudrate}, timeout: " \
+               f"{self.timeout}, write_timeout: {self.write_timeout}, " \
+               f"inter_byte_timeout: {self.inter_byte_timeout}, rtt: " \
+               f"{self.rtt:.4f}, cached: {self.cached}"
+
+    def apply(self, manager):
+        """Applies the settings to a SerialManager's port (reconfigured in
+        place if open). The manager's previous timeout is kept as its boot
+        timeout, as the robot's boot banner is slower than its replies.
+
+        Parameters:
+            manager (SerialManager) : Manager to configure.
+        """
+        if manager.boot_timeout is None:
+            manager.boot_timeout = manager.timeout
+        manager.baudrate = self.baudrate
+        manager.timeout = self.timeout
+        manager.write_timeout = self.write_timeout
+        manager.inter_byte_timeout = self.inter_byte_timeout
+        manager.initialize()
+
+    def to_dict(self):
+        return {'baudrate': self.baudrate, 'timeout': self.timeout,
+                'write_timeout': self.write_timeout,
+                'inter_byte_timeout': self.inter_byte_timeout,
+                'rtt': self.rtt}
+
+
+def device_key(port):
+    """Returns the key identifying the device behind a serial port: its USB
+    serial number, or vendor, product and USB location if it has none,
+    falling back to the port name.
+
+    Parameters:
+        port (str) : Serial port (e.g. 'COM3', '/dev/ttyUSB0').
+
+    Returns:
+        key (str) : Device key.
+    """
+    for info in serial.tools.list_ports.comports():
+        if info.device == port:
+            if info.serial_number:
+                return f"sn:{info.serial_number}"
+            if info.vid is not None:
+                return f"usb:{info.vid:04x}:{info.pid:04x}@{info.location}"
+            break
+    return f"port:{port}"
+
+
+def _load(cache_path):
+    """Returns the cache read from cache_path, reading it once.
+    """
+    cache = _cache.get(cache_path)
+    if cache is None:
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = {}
+        _cache[cache_path] = cache
+    return cache
+
+
+def _store(cache_path, key, settings):
+    cache = _load(cache_path)
+    cache[key] = settings.to_dict()
+    directory = os.path.dirname(cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(cache_path + '.tmp', 'w') as cache_file:
+        json.dump(cache, cache_file, indent=1)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def _probe(port, baudrate, probes, probe_msg, matcher, probe_timeout):
+    """Sends probes at baudrate, returns the slowest round trip (seconds),
+    None if any probe is not answered within probe_timeout.
+    """
+    port.apply_settings({'baudrate': baudrate, 'timeout': probe_timeout,
+                         'inter_byte_timeout': None})
+    port.reset_input_buffer()  # Garbage received at the previous rate
+    data = probe_msg.encode() + b'\n'
+    res = 0.0
+    for _ in range(probes):
+        start = time.perf_counter()
+        port.write(data)
+        while True:
+            line = port.readline()
+            elapsed = time.perf_counter() - start
+            if line and matcher(probe_msg, line):
+                break
+            if not line or elapsed > probe_timeout:
+                return None
+        res = max(res, elapsed)
+    return res
+
+
+def tune_serial(manager, baudrates=BAUDRATES, probes=5, probe_msg=PROBE_MSG,
+                matcher=first_char_matcher, probe_timeout=0.5,
+                timeout_factor=4.0, min_timeout=0.5, reply_timeout=None,
+                use_cache=True, cache_path=None):
+    """Tunes a connected SerialManager: picks the fastest baud rate at which
+    the robot answers every probe, sets the write timeout from the measured
+    round trips and applies them to the open port.
+
+    Parameters:
+        manager (SerialManager) : Connected manager.
+        baudrates ([int]) : Candidate baud rates.
+        probes (int) : Probes that must be answered at a baud rate.
+        probe_msg (str) : Probe message, answered by the robot.
+        matcher (callable) : matcher(msg, reply) returns True if reply
+        answers msg.
+        probe_timeout (float) : Seconds to wait for a probe's answer.
+        timeout_factor (float) : Write timeout is this many times the
+        slowest probe round trip.
+        min_timeout (float) : Shortest write timeout (seconds).
+        reply_timeout (float) : Read timeout (seconds), long enough for
+        the slowest skill to be performed and echoed; the manager's
+        timeout is kept if None.
+        use_cache (bool) : If True, cached settings of the device are
+        checked with one probe and used if answered.
+        cache_path (str) : Cache file, CACHE_PATH if None.
+
+    Returns:
+        settings (LinkSettings) : Applied settings.
+    """
+    if not manager.serial.is_open:
+        raise ConnectionError("Serial port must be open, connect() first.")
+    if not (isinstance(probes, int) and probes > 0):
+        raise TypeError("Probes must be int, greater than 0.")
+    cache_path = CACHE_PATH if cache_path is None else cache_path
+    reply_timeout = manager.timeout if reply_timeout is None \
+        else reply_timeout
+    key = device_key(manager.port)
+    if manager.write_batcher is not None:
+        manager.write_batcher.flush()
+    with manager.send_lock, manager.recv_lock:
+        if use_cache:
+            with _cache_lock:
+                cached = _load(cache_path).get(key)
+            if cached is not None and \
+                    _probe(manager.serial, cached['baudrate'], 1, probe_msg,
+                           matcher, probe_timeout) is not None:
+                settings = LinkSettings(cached=True, **dict(
+                    cached, timeout=reply_timeout))
+                settings.apply(manager)
+                return settings
+        for baudrate in sorted(baudrates, reverse=True):
+            rtt = _probe(manager.serial, baudrate, probes, probe_msg,
+                         matcher, probe_timeout)
+            if rtt is not None:
+                break
+        else:
+            manager.initialize()  # Back to the manager's settings
+            raise ConnectionError(f"No answer at any of {list(baudrates)} "
+                                  f"bauds.")
+        write_timeout = round(max(rtt * timeout_factor, min_timeout), 3)
+        settings = LinkSettings(
+            baudrate, reply_timeout, write_timeout,
+            round(max(INTER_BYTE_CHARS * 10 / baudrate,
+                      MIN_INTER_BYTE_TIMEOUT), 4), rtt)
+        settings.apply(manager)
+    with _cache_lock:
+        _store(cache_path, key, settings)
+    return settings
+
+
+def clear_link_cache(cache_path=None):
+    """Discards cached link settings, deleting the cache file.
+
+    Parameters:
+        cache_path (str) : Cache file, CACHE_PATH if None.
+    """
+    cache_path = CACHE_PATH if cache_path is None else cache_path
+    with _cache_lock:
+        _cache.pop(cache_path, None)
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
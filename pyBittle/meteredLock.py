@@ -0,0 +1,96 @@
+"""This module provides a lock that measures its contention.
+
+MeteredLock is used by the managers to serialize access to their socket or
+serial port, and reports how often and how long threads waited for it.
+"""
+
+import threading
+import time
+
+
+__author__ = "EnriqueMoran"
+
+
+class MeteredLock:
+    """threading.Lock that counts acquisitions and contention.
+
+    Attributes
+    ----------
+    acquisitions : int
+        Times the lock was acquired.
+    contentions : int
+        Times a thread had to wait for the lock.
+    wait_time : float
+        Total time threads waited for the lock (seconds).
+    max_wait : float
+        Longest wait for the lock (seconds).
+
+    Methods
+    -------
+    acquire(blocking=True, timeout=-1):
+        Acquires the lock, see threading.Lock.acquire.
+    release():
+        Releases the lock.
+    stats():
+        Returns contention counters.
+    reset():
+        Resets contention counters.
+    """
+
+    __slots__ = ('_lock', 'acquisitions', 'contentions', 'wait_time',
+                 'max_wait')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __repr__(self):
+        return f"MeteredLock - acquisitions: {self.acquisitions}, " \
+               f"contentions: {self.contentions}, wait_time: " \
+               f"{self.wait_time}"
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.acquisitions += 1  # Counters are only updated holding lock
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        waited = time.perf_counter() - start
+        self.acquisitions += 1
+        self.contentions += 1
+        self.wait_time += waited
+        if waited > self.max_wait:
+            self.max_wait = waited
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def stats(self):
+        """Returns {'acquisitions', 'contentions', 'wait_time',
+        'max_wait'}.
+        """
+        return {'acquisitions': self.acquisitions,
+                'contentions': self.contentions,
+                'wait_time': self.wait_time, 'max_wait': self.max_wait}
+
+    def reset(self):
+        """Resets contention counters.
+        """
+        self.acquisitions = 0
+        self.contentions = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
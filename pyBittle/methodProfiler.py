@@ -0,0 +1,238 @@
+"""This module profiles pyBittle public methods.
+
+MethodProfiler wraps the public methods of Bittle and the managers, records
+call counts and wall/CPU time per method and dumps them as a cProfile
+(pstats) file or as collapsed stacks for flamegraph tools.
+
+Profiling is disabled by default and the original methods are left
+untouched, so it has no overhead. Enable it with profiler.enable() or by
+setting the PYBITTLE_PROFILE environment variable; if
+PYBITTLE_PROFILE_OUTPUT is set too, the report is written to that path at
+exit (collapsed stacks if it ends with '.folded', pstats otherwise).
+"""
+
+import atexit
+import functools
+import marshal
+import os
+import threading
+import time
+
+from pyBittle.bittleManager import Bittle, CompactBittle
+from pyBittle.bluetoothManager import BluetoothManager
+from pyBittle.serialManager import SerialManager
+from pyBittle.wifiManager import WifiManager
+
+
+__author__ = "EnriqueMoran"
+
+
+class MethodProfiler:
+    """Opt-in profiler of public methods.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether methods are currently wrapped.
+    classes : [type]
+        Classes whose public methods are profiled.
+
+    Methods
+    -------
+    enable():
+        Wraps public methods and starts recording.
+    disable():
+        Restores original methods. Recorded data is kept.
+    reset():
+        Discards recorded data.
+    stats():
+        Returns {method: (calls, wall, cpu, own_wall)}.
+    report(sort='wall'):
+        Returns a text table with recorded data.
+    dump_stats(path):
+        Writes recorded data as a pstats (cProfile) file.
+    dump_collapsed(path):
+        Writes recorded data as collapsed stacks (flamegraph format).
+    """
+
+    def __init__(self, classes=None):
+        self._classes = list(classes) if classes else \
+            [Bittle, CompactBittle, BluetoothManager, SerialManager,
+             WifiManager]
+        self._originals = {}  # (class, name) : original function
+        self._codes = {}  # method : (filename, line, function name)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def __repr__(self):
+        return f"MethodProfiler - enabled: {self.enabled}, classes: " \
+               f"{[cls.__name__ for cls in self.classes]}"
+
+    @property
+    def enabled(self):
+        return bool(self._originals)
+
+    @property
+    def classes(self):
+        return list(self._classes)
+
+    def enable(self):
+        """Wraps the public methods of self.classes.
+        """
+        if self.enabled:
+            return
+        for cls in self._classes:
+            for name, attribute in list(vars(cls).items()):
+                if name.startswith('_') or not callable(attribute) or \
+                        isinstance(attribute, type):
+                    continue
+                key = f"{cls.__name__}.{name}"
+                code = getattr(attribute, '__code__', None)
+                if code is not None:
+                    self._codes[key] = (code.co_filename,
+                                        code.co_firstlineno, key)
+                else:
+                    self._codes[key] = ('~', 0, key)
+                self._originals[(cls, name)] = attribute
+                setattr(cls, name, self._wrap(key, attribute))
+
+    def disable(self):
+        """Restores original methods.
+        """
+        for (cls, name), attribute in self._originals.items():
+            setattr(cls, name, attribute)
+        self._originals = {}
+
+    def reset(self):
+        """Discards recorded data.
+        """
+        with self._lock:
+            self._stats = {}  # method : [calls, wall, cpu, own_wall]
+            self._callers = {}  # (caller, method) : [calls, own_wall, wall]
+            self._stacks = {}  # (method, ...) : own_wall
+
+    def _wrap(self, key, function):
+        """Returns function wrapped for recording under given key.
+        """
+        profiler = self
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                stack = profiler._local.stack
+            except AttributeError:
+                stack = profiler._local.stack = []
+            frame = [key, 0.0]  # Method, time spent in profiled children
+            stack.append(frame)
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                cpu = time.thread_time() - cpu
+                wall = time.perf_counter() - wall
+                path = tuple(item[0] for item in stack)
+                stack.pop()
+                if stack:
+                    stack[-1][1] += wall
+                profiler._record(path, wall, cpu, wall - frame[1])
+        return wrapper
+
+    def _record(self, path, wall, cpu, own_wall):
+        key = path[-1]
+        caller = path[-2] if len(path) > 1 else None
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = [0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3] += own_wall
+            callers = self._callers.get((caller, key))
+            if callers is None:
+                callers = self._callers[(caller, key)] = [0, 0.0, 0.0]
+            callers[0] += 1
+            callers[1] += own_wall
+            callers[2] += wall
+            self._stacks[path] = self._stacks.get(path, 0.0) + own_wall
+
+    def stats(self):
+        """Returns recorded data.
+
+        Returns:
+            res ({str: (int, float, float, float)}) : Method name mapped to
+            calls, total wall time, total CPU time and wall time excluding
+            profiled callees (seconds).
+        """
+        with self._lock:
+            return {key: tuple(value) for key, value in self._stats.items()}
+
+    def report(self, sort='wall'):
+        """Returns recorded data as a text table.
+
+        Parameters:
+            sort (str) : Column to sort by: 'calls', 'wall', 'cpu' or 'own'.
+        """
+        columns = {'calls': 0, 'wall': 1, 'cpu': 2, 'own': 3}
+        if sort not in columns:
+            raise ValueError("Sort must be 'calls', 'wall', 'cpu' or 'own'.")
+        rows = sorted(self.stats().items(),
+                      key=lambda item: item[1][columns[sort]], reverse=True)
+        lines = [f"{'method':<40} {'calls':>9} {'wall (s)':>11} "
+                 f"{'cpu (s)':>11} {'own (s)':>11} {'per call (us)':>14}"]
+        for key, (calls, wall, cpu, own) in rows:
+            lines.append(f"{key:<40} {calls:>9} {wall:>11.6f} {cpu:>11.6f} "
+                         f"{own:>11.6f} {wall / calls * 1e6:>14.2f}")
+        return "\n".join(lines)
+
+    def dump_stats(self, path):
+        """Writes recorded data in pstats format, readable by
+        pstats.Stats(path), snakeviz, gprof2dot...
+
+        Parameters:
+            path (str) : Output file path.
+        """
+        with self._lock:
+            stats = {key: list(value) for key, value in self._stats.items()}
+            callers = {key: list(value)
+                       for key, value in self._callers.items()}
+        res = {}
+        for key, (calls, wall, _, own) in stats.items():
+            res[self._codes[key]] = (calls, calls, own, wall, {})
+        for (caller, key), (calls, own, wall) in callers.items():
+            if caller is not None:
+                res[self._codes[key]][4][self._codes[caller]] = \
+                    (calls, calls, own, wall)
+        with open(path, 'wb') as output:
+            marshal.dump(res, output)
+
+    def dump_collapsed(self, path):
+        """Writes recorded data as collapsed stacks (one 'a;b;c <us>' line
+        per call path), readable by flamegraph.pl, speedscope, inferno...
+
+        Parameters:
+            path (str) : Output file path.
+        """
+        with self._lock:
+            stacks = dict(self._stacks)
+        with open(path, 'w') as output:
+            for stack, own in sorted(stacks.items()):
+                output.write(f"{';'.join(stack)} {round(own * 1e6)}\n")
+
+
+profiler = MethodProfiler()
+
+
+def _dump_at_exit(path):
+    if path.endswith('.folded'):
+        profiler.dump_collapsed(path)
+    else:
+        profiler.dump_stats(path)
+
+
+if os.environ.get('PYBITTLE_PROFILE'):
+    profiler.enable()
+    if os.environ.get('PYBITTLE_PROFILE_OUTPUT'):
+        atexit.register(_dump_at_exit, os.environ['PYBITTLE_PROFILE_OUTPUT'])
@@ -0,0 +1,177 @@
+"""This module manages reusable receive buffers.
+
+ReceiveBuffer allows reading incoming data into a preallocated bytearray
+and handing it to callers as memoryview slices, so sustained streams do not
+allocate a new bytes object per read.
+"""
+
+__author__ = "EnriqueMoran"
+
+
+class ReceiveBuffer:
+    """Preallocated, adaptively sized receive buffer.
+
+    Views returned by fill() and read_line() point into the internal buffer
+    and are only valid until the next read; copy them (bytes(view)) to keep
+    the data around.
+
+    Attributes
+    ----------
+    size : int
+        Current buffer size (bytes).
+    min_size : int
+        Lower bound the buffer can shrink to (bytes).
+    max_size : int
+        Upper bound the buffer can grow to (bytes).
+    shrink_after : int
+        Consecutive small reads needed before shrinking the buffer.
+    reallocations : int
+        Number of times the buffer has been reallocated.
+
+    Methods
+    -------
+    fill(read_into):
+        Reads once into the buffer and returns a view of the received data.
+    read_line(read_into):
+        Returns a view of the next line (till '\n' character).
+    clear():
+        Discards pending data.
+    """
+
+    def __init__(self, size=1024, min_size=64, max_size=65536,
+                 shrink_after=32):
+        if not (isinstance(min_size, int) and min_size > 0):
+            raise TypeError("Min size must be int, greater than 0.")
+        if not (isinstance(max_size, int) and max_size >= min_size):
+            raise TypeError("Max size must be int, not lower than min size.")
+        if not (isinstance(size, int) and min_size <= size <= max_size):
+            raise TypeError("Size must be int, between min and max size.")
+        if not (isinstance(shrink_after, int) and shrink_after > 0):
+            raise TypeError("Shrink after must be int, greater than 0.")
+        self._min_size = min_size
+        self._max_size = max_size
+        self._shrink_after = shrink_after
+        self._small_reads = 0  # Consecutive reads using < 1/4 of the buffer
+        self._start = 0  # Pending (unread) data is buffer[start:end]
+        self._end = 0
+        self.reallocations = 0
+        self._allocate(size)
+
+    def __repr__(self):
+        return f"ReceiveBuffer - size: {self.size}, min_size: " \
+               f"{self.min_size}, max_size: {self.max_size}, pending: " \
+               f"{self.pending}"
+
+    def __len__(self):
+        return self.pending
+
+    @property
+    def size(self):
+        return len(self._buffer)
+
+    @property
+    def min_size(self):
+        return self._min_size
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def shrink_after(self):
+        return self._shrink_after
+
+    @property
+    def pending(self):
+        return self._end - self._start
+
+    def _allocate(self, size):
+        """Replaces the buffer keeping pending data. Views handed out before
+        keep referencing the previous buffer, so they stay valid.
+        """
+        buffer = bytearray(size)
+        pending = self.pending
+        if pending:
+            buffer[:pending] = self._buffer[self._start:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start = 0
+        self._end = pending
+        self.reallocations += 1
+
+    def _adapt(self, nbytes):
+        """Grows the buffer when a read fills it and shrinks it after
+        self.shrink_after consecutive reads using less than a quarter of it.
+        """
+        size = self.size
+        if nbytes >= size and size < self.max_size:
+            self._small_reads = 0
+            self._allocate(min(size * 2, self.max_size))
+        elif nbytes < size // 4 and size > self.min_size:
+            self._small_reads += 1
+            if self._small_reads >= self.shrink_after:
+                self._small_reads = 0
+                self._allocate(max(size // 2, self.min_size, self.pending))
+        else:
+            self._small_reads = 0
+
+    def fill(self, read_into):
+        """Reads once into the buffer.
+
+        Pending data left by read_line() is returned first without reading.
+
+        Parameters:
+            read_into (callable) : Function writing into a writable buffer
+            and returning the number of bytes written (socket.recv_into,
+            serial.Serial.readinto...).
+
+        Returns:
+            data (memoryview) : Received data, empty on EOF or timeout.
+        """
+        if self.pending:
+            data = self._view[self._start:self._end]
+            self._start = self._end = 0
+            return data
+        nbytes = read_into(self._view) or 0
+        data = self._view[:nbytes]
+        self._adapt(nbytes)
+        return data
+
+    def read_line(self, read_into):
+        """Reads till '\n' character, buffering any extra received data for
+        the next call.
+
+        Parameters:
+            read_into (callable) : Function writing into a writable buffer
+            and returning the number of bytes written.
+
+        Returns:
+            data (memoryview) : Received line including '\n'; on EOF or
+            timeout, whatever was received so far (possibly empty).
+        """
+        while True:
+            index = self._buffer.find(b'\n', self._start, self._end)
+            if index >= 0:
+                data = self._view[self._start:index + 1]
+                self._start = index + 1
+                return data
+            if self._start:  # Move pending data to the front
+                pending = self.pending
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+                self._start, self._end = 0, pending
+            if self._end == self.size:  # Line does not fit, grow
+                if self.size >= self.max_size:
+                    break
+                self._allocate(min(self.size * 2, self.max_size))
+            nbytes = read_into(self._view[self._end:]) or 0
+            if not nbytes:
+                break
+            self._end += nbytes
+        data = self._view[self._start:self._end]
+        self._start = self._end = 0
+        return data
+
+    def clear(self):
+        """Discards pending data.
+        """
+        self._start = self._end = 0
@@ -0,0 +1,349 @@
+"""This module plans the commands that drive Bittle along a 2D route.
+
+A route is a list of (x, y) waypoints (meters), starting at Bittle's
+position. Every segment is driven as an optional turn (Direction
+FORWARDLEFT or FORWARDRIGHT, an arc whose radius is the gait's speed over
+its turn rate) followed by a straight run (Direction FORWARD), using a
+MotionModel with each gait's calibrated speed and turn rate.
+
+The gait of every segment is chosen by dynamic programming over the whole
+route, minimizing travel time plus penalties for gait switches (Bittle
+spends switch_time changing posture), for every command sent and for
+commands shorter than their gait can perform reliably. Consecutive runs with
+the same message are merged into a single command, so straight sections
+are sent once however many waypoints they have.
+
+The result is a RoutePlan: a choreography (see pyBittle.choreography) of
+movements and waits, ending with a stop command. Plans are cached, so
+driving the same route again costs a dictionary lookup.
+"""
+
+import collections
+import math
+import threading
+
+from pyBittle.bittleManager import Command, Direction, Gait
+from pyBittle.choreography import compile_choreography
+
+
+__author__ = "EnriqueMoran"
+
+
+# Gait : (speed m/s, turn rate rad/s, shortest reliable command seconds),
+# measured on a Bittle on flat floor, calibrate for your own.
+DEFAULT_GAITS = {
+    Gait.CRAWL: (0.05, 0.35, 0.2),
+    Gait.WALK: (0.10, 0.60, 0.3),
+    Gait.TROT: (0.18, 0.80, 0.5),
+    Gait.RUN: (0.30, 0.90, 0.8)
+}
+
+PLAN_CACHE_SIZE = 128  # Cached plans, least recently used dropped
+
+_cache = collections.OrderedDict()  # (Waypoints, model, options) : RoutePlan
+_cache_lock = threading.Lock()
+
+
+class MotionModel:
+    """Speed and turn rate of every gait.
+
+    Attributes
+    ----------
+    gaits : {Gait: (float, float, float)}
+        Speed (m/s), turn rate (rad/s) and shortest reliable command
+        duration (seconds) of every usable gait.
+
+    Methods
+    -------
+    set(gait, speed, turn_rate, min_duration=0.0):
+        Sets a gait's parameters.
+    calibrate(gait, seconds, distance=0.0, angle=0.0):
+        Sets a gait's speed or turn rate from a measured run.
+    """
+
+    def __init__(self, gaits=None):
+        self.gaits = {}
+        for gait, params in (DEFAULT_GAITS if gaits is None
+                             else gaits).items():
+            self.set(gait, *params)
+
+    def __repr__(self):
+        return "MotionModel - " + ", ".join(
+            f"{gait.name}: {speed} m/s {turn_rate} rad/s"
+            for gait, (speed, turn_rate, _) in self.gaits.items())
+
+    def set(self, gait, speed, turn_rate, min_duration=0.0):
+        """Sets a gait's parameters.
+
+        Parameters:
+            gait (Gait) : Gait.
+            speed (float) : Forward speed (m/s).
+            turn_rate (float) : Turn rate while moving forward (rad/s).
+            min_duration (float) : Shortest command the gait performs
+            reliably (seconds).
+        """
+        if not isinstance(gait, Gait):
+            raise TypeError("Gait must be Gait type.")
+        for name, value in (('Speed', speed), ('Turn rate', turn_rate)):
+            if not (isinstance(value, (int, float)) and value > 0):
+                raise TypeError(f"{name} must be number, greater than 0.")
+        if not (isinstance(min_duration, (int, float)) and
+                min_duration >= 0):
+            raise TypeError("Min duration must be positive number.")
+        self.gaits[gait] = (float(speed), float(turn_rate),
+                            float(min_duration))
+
+    def calibrate(self, gait, seconds, distance=0.0, angle=0.0):
+        """Updates a gait from a measured run: distance travelled moving
+        forward or angle turned (radians) in given seconds.
+        """
+        if not (isinstance(seconds, (int, float)) and seconds > 0):
+            raise TypeError("Seconds must be number, greater than 0.")
+        speed, turn_rate, min_duration = self.gaits[gait]
+        if distance:
+            speed = distance / seconds
+        if angle:
+            turn_rate = abs(angle) / seconds
+        self.set(gait, speed, turn_rate, min_duration)
+
+    def key(self):
+        """Returns a hashable snapshot of the model.
+        """
+        return tuple(sorted((gait.value, params)
+                            for gait, params in self.gaits.items()))
+
+
+class RoutePlan:
+    """Commands driving a route.
+
+    Attributes
+    ----------
+    steps : list
+        Choreography: (Gait, Direction) movements, waits (seconds) and the
+        final stop Command.
+    waypoints : ((float, float))
+        Waypoints driven through (unreachable ones skipped).
+    gaits : (Gait)
+        Gait of every segment between waypoints.
+    duration : float
+        Estimated travel time (seconds).
+    commands : int
+        Commands sent, stop included.
+    gait_switches : int
+        Gait changes along the route.
+
+    Methods
+    -------
+    routine():
+        Returns the plan compiled into a choreography Routine.
+    play(manager, speed=1.0):
+        Drives the route through given manager.
+    """
+
+    __slots__ = ('steps', 'waypoints', 'gaits', 'duration', 'commands',
+                 'gait_switches')
+
+    def __init__(self, steps, waypoints, gaits, duration, commands,
+                 gait_switches):
+        self.steps = steps
+        self.waypoints = waypoints
+        self.gaits = gaits
+        self.duration = duration
+        self.commands = commands
+        self.gait_switches = gait_switches
+
+    def __repr__(self):
+        return f"RoutePlan - segments: {len(self.gaits)}, commands: " \
+               f"{self.commands}, gait switches: {self.gait_switches}, " \
+               f"duration: {self.duration:.2f}"
+
+    def routine(self):
+        return compile_choreography(self.steps)
+
+    def play(self, manager, speed=1.0):
+        """Drives the route through given manager, see Routine.play().
+        """
+        return self.routine().play(manager, speed)
+
+
+def _wrap(angle):
+    """Returns angle in [-pi, pi).
+    """
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+def _segment(start, heading, target, speed, turn_rate, tolerance,
+             long_way=True):
+    """Returns how to drive from start (with heading) to target with a
+    gait: (turn angle, turn seconds, straight seconds, heading at target),
+    None if unreachable. The turn is the arc tangent to the straight run;
+    if the target is inside that turning circle, the other way round is
+    tried when long_way is True.
+    """
+    x, y = start
+    tx, ty = target
+    distance = math.hypot(tx - x, ty - y)
+    bearing = _wrap(math.atan2(ty - y, tx - x) - heading)
+    if distance == 0 or abs(bearing) <= tolerance:
+        return 0.0, 0.0, distance / speed, heading
+    radius = speed / turn_rate
+    side = math.copysign(1.0, bearing)  # 1 left, -1 right
+    for side in ((side, -side) if long_way else (side,)):
+        cx = x - side * radius * math.sin(heading)  # Turning circle center
+        cy = y + side * radius * math.cos(heading)
+        center_distance = math.hypot(tx - cx, ty - cy)
+        if center_distance < radius:
+            continue
+        straight = math.sqrt(center_distance ** 2 - radius ** 2)
+        tangent_point = math.atan2(ty - cy, tx - cx) - \
+            side * math.atan2(straight, radius)
+        arrival = tangent_point + side * math.pi / 2
+        turn = side * ((side * (arrival - heading)) % (2 * math.pi))
+        return turn, abs(turn) / turn_rate, straight / speed, heading + turn
+    return None
+
+
+def _reachable(points, heading, model, tolerance):
+    """Returns points without the intermediate waypoints that even the
+    tightest turning gait can't reach without looping.
+    """
+    speed, turn_rate, _ = min(model.gaits.values(),
+                              key=lambda params: params[0] / params[1])
+    res = [points[0]]
+    for target in points[1:-1]:
+        option = _segment(res[-1], heading, target, speed, turn_rate,
+                          tolerance, long_way=False)
+        if option is not None:
+            res.append(target)
+            heading = option[3]
+    res.append(points[-1])
+    return tuple(res)
+
+
+def plan_route(waypoints, model=None, heading=0.0, switch_time=0.5,
+               command_cost=0.1, short_penalty=1.0, turn_tolerance=0.05,
+               stop=Command.BALANCE, use_cache=True):
+    """Plans the commands driving Bittle through waypoints. Intermediate
+    waypoints closer than any gait can turn to are skipped.
+
+    Parameters:
+        waypoints ([(float, float)]) : Route (meters), starting at Bittle's
+        position.
+        model (MotionModel) : Gait speeds and turn rates, defaults if None.
+        heading (float) : Bittle's initial heading (radians, 0 is +x).
+        switch_time (float) : Seconds lost on every gait switch.
+        command_cost (float) : Penalty of every command (seconds).
+        short_penalty (float) : Penalty of every command shorter than its
+        gait's min_duration (seconds).
+        turn_tolerance (float) : Heading errors below it are not corrected
+        (radians).
+        stop (Command) : Command sent at the end, None to keep moving.
+        use_cache (bool) : If True, returns the cached plan when the same
+        route has already been planned (the last PLAN_CACHE_SIZE used ones
+        are kept).
+
+    Returns:
+        plan (RoutePlan) : Planned commands.
+    """
+    points = tuple((float(x), float(y)) for x, y in waypoints)
+    if len(points) < 2:
+        raise ValueError("Route must have at least two waypoints.")
+    model = MotionModel() if model is None else model
+    if not model.gaits:
+        raise ValueError("Motion model has no gaits.")
+    key = (points, model.key(), heading, switch_time, command_cost,
+           short_penalty, turn_tolerance, stop)
+    if use_cache:
+        with _cache_lock:
+            plan = _cache.get(key)
+            if plan is not None:
+                _cache.move_to_end(key)
+        if plan is not None:
+            return plan
+
+    def cost(gait, previous, option):
+        turn, turn_time, straight_time, _ = option
+        min_duration = model.gaits[gait][2]
+        commands = (turn != 0) + (straight_time > 0 and
+                                  (turn != 0 or gait != previous))
+        res = turn_time + straight_time + command_cost * commands
+        if previous is not None and gait != previous:
+            res += switch_time
+        for seconds in (turn_time, straight_time):
+            if 0 < seconds < min_duration:
+                res += short_penalty
+        return res
+
+    # Viterbi over segments. State: gait of the segment, holding (cost,
+    # previous gait, segment option); the heading at each waypoint is the
+    # one reached by the best path into that state.
+    points = _reachable(points, heading, model, turn_tolerance)
+    layers = []
+    states = {None: (0.0, None, (0.0, 0.0, 0.0, heading))}
+    for start, target in zip(points, points[1:]):
+        layer = {}
+        for gait, (speed, turn_rate, _) in model.gaits.items():
+            for previous, (total, _, reached) in states.items():
+                option = _segment(start, reached[3], target, speed,
+                                  turn_rate, turn_tolerance)
+                if option is None:
+                    continue
+                total += cost(gait, previous, option)
+                if gait not in layer or total < layer[gait][0]:
+                    layer[gait] = (total, previous, option)
+        if not layer:
+            raise ValueError(f"Waypoint {target} can't be reached.")
+        layers.append(layer)
+        states = layer
+    gait = min(states, key=lambda gait: states[gait][0])
+    chosen = []
+    for layer in reversed(layers):
+        chosen.append((gait, layer[gait][2]))
+        gait = layer[gait][1]
+    chosen.reverse()
+
+    steps = []
+    current = None
+    duration = 0.0
+    commands = switches = 0
+    previous = None
+    for gait, (turn, turn_time, straight_time, _) in chosen:
+        extra = 0.0
+        if previous is not None and gait != previous:
+            switches += 1
+            extra = switch_time
+        previous = gait
+        for direction, seconds in (
+                (Direction.FORWARDLEFT if turn > 0 else
+                 Direction.FORWARDRIGHT, turn_time),
+                (Direction.FORWARD, straight_time)):
+            if seconds <= 0:
+                continue
+            movement = (gait, direction)
+            seconds = round(seconds + extra, 3)
+            extra = 0.0
+            if movement == current:  # Merge with the running command
+                steps[-1] = round(steps[-1] + seconds, 3)
+            else:
+                steps += [movement, seconds]
+                current = movement
+                commands += 1
+            duration += seconds
+    if stop is not None:
+        steps.append(stop)
+        commands += 1
+    plan = RoutePlan(steps, points, tuple(gait for gait, _ in chosen),
+                     duration, commands, switches)
+    if use_cache:
+        with _cache_lock:
+            _cache[key] = plan
+            if len(_cache) > PLAN_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return plan
+
+
+def clear_plan_cache():
+    """Discards cached plans.
+    """
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,223 @@
+"""This module estimates round-trip times to set adaptive timeouts.
+
+RttEstimator measures the time between sending a message and receiving
+Bittle's reply and keeps, per transport and command class, a smoothed RTT
+and its variance (as TCP does, RFC 6298). The resulting timeout is used by
+BluetoothManager and SerialManager instead of their fixed timeouts, so a
+lost reply is detected in about the time the link really needs.
+"""
+
+import collections
+import threading
+import time
+
+from pyBittle.stateCache import MOVEMENTS
+
+
+__author__ = "EnriqueMoran"
+
+
+def command_class(msg):
+    """Returns the class of a message: 'token' (single character),
+    'movement' (gait and direction), 'skill' ('k' messages) or 'custom'.
+    """
+    if len(msg) == 1:
+        return 'token'
+    elif msg in MOVEMENTS:
+        return 'movement'
+    elif msg.startswith('k'):
+        return 'skill'
+    return 'custom'
+
+
+class RttEstimate:
+    """Smoothed round-trip time of one (transport, command class).
+
+    Attributes
+    ----------
+    srtt : float
+        Smoothed round-trip time (seconds), None until first sample.
+    rttvar : float
+        Round-trip time variation (seconds).
+    timeout : float
+        Current timeout (seconds).
+    samples : int
+        Replies measured.
+    timeouts : int
+        Replies not received in time.
+    """
+
+    __slots__ = ('srtt', 'rttvar', 'timeout', 'samples', 'timeouts')
+
+    def __init__(self, timeout):
+        self.srtt = None
+        self.rttvar = 0.0
+        self.timeout = timeout
+        self.samples = 0
+        self.timeouts = 0
+
+    def __repr__(self):
+        return f"RttEstimate - srtt: {self.srtt}, rttvar: {self.rttvar}, " \
+               f"timeout: {self.timeout}, samples: {self.samples}, " \
+               f"timeouts: {self.timeouts}"
+
+
+class RttEstimator:
+    """Adaptive timeout estimator, per transport and command class.
+
+    Managers call sent() when sending a message and received() or
+    timed_out() when its reply arrives or not; replies (complete lines) are
+    matched with sent messages in order. Messages waiting for longer than
+    max_timeout are forgotten (their replies were never read).
+
+    Attributes
+    ----------
+    initial_timeout : float
+        Timeout used before any sample is measured (seconds).
+    min_timeout : float
+        Lower bound of timeouts (seconds).
+    max_timeout : float
+        Upper bound of timeouts (seconds).
+    alpha : float
+        Smoothing factor of srtt.
+    beta : float
+        Smoothing factor of rttvar.
+    k : float
+        Variance multiplier of the timeout.
+
+    Methods
+    -------
+    sent(transport, msg):
+        Registers a message waiting for reply.
+    timeout(transport):
+        Returns the timeout for the oldest message waiting for reply.
+    received(transport, lines=1):
+        Registers the replies of the oldest messages waiting for them.
+    timed_out(transport):
+        Registers that the oldest message waiting for reply got none.
+    estimate(transport, cls):
+        Returns the RttEstimate of given transport and command class.
+    estimates():
+        Returns every estimate.
+    """
+
+    def __init__(self, initial_timeout=1.0, min_timeout=0.05,
+                 max_timeout=10.0, alpha=0.125, beta=0.25, k=4.0):
+        if not (0 < min_timeout <= initial_timeout <= max_timeout):
+            raise ValueError("Timeouts must satisfy "
+                             "0 < min <= initial <= max.")
+        self.initial_timeout = float(initial_timeout)
+        self.min_timeout = float(min_timeout)
+        self.max_timeout = float(max_timeout)
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self._lock = threading.Lock()
+        self._estimates = {}  # (transport, class) : RttEstimate
+        self._pending = collections.defaultdict(collections.deque)
+
+    def __repr__(self):
+        return f"RttEstimator - estimates: {self.estimates()}"
+
+    def _estimate(self, key):
+        estimate = self._estimates.get(key)
+        if estimate is None:
+            estimate = self._estimates[key] = \
+                RttEstimate(self.initial_timeout)
+        return estimate
+
+    def sent(self, transport, msg):
+        """Registers a message waiting for reply.
+
+        Parameters:
+            transport (str) : Transport it was sent through.
+            msg (str) : Sent message.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            pending = self._pending[transport]
+            while pending and now - pending[0][1] > self.max_timeout:
+                pending.popleft()
+            pending.append(((transport, command_class(msg)), now))
+
+    def timeout(self, transport):
+        """Returns the timeout (seconds) for the oldest message waiting for
+        reply through given transport, None if none is waiting.
+        """
+        with self._lock:
+            pending = self._pending[transport]
+            if not pending:
+                return None
+            key, sent_at = pending[0]
+            remaining = self._estimate(key).timeout - \
+                (time.perf_counter() - sent_at)
+            return max(remaining, self.min_timeout)
+
+    def received(self, transport, lines=1):
+        """Registers the replies of the oldest messages waiting for them
+        and updates their estimates. Call it once per complete reply line,
+        not per received chunk.
+
+        Parameters:
+            transport (str) : Transport they were received through.
+            lines (int) : Complete reply lines received.
+
+        Returns:
+            rtt (float) : Round-trip time of the last one, None if no
+            message was waiting.
+        """
+        now = time.perf_counter()
+        rtt = None
+        with self._lock:
+            pending = self._pending[transport]
+            for _ in range(min(lines, len(pending))):
+                key, sent_at = pending.popleft()
+                rtt = now - sent_at
+                estimate = self._estimate(key)
+                if estimate.srtt is None:
+                    estimate.srtt = rtt
+                    estimate.rttvar = rtt / 2
+                else:
+                    estimate.rttvar += self.beta * \
+                        (abs(estimate.srtt - rtt) - estimate.rttvar)
+                    estimate.srtt += self.alpha * (rtt - estimate.srtt)
+                estimate.samples += 1
+                estimate.timeout = min(max(estimate.srtt + self.k *
+                                           estimate.rttvar,
+                                           self.min_timeout),
+                                       self.max_timeout)
+        return rtt
+
+    def timed_out(self, transport):
+        """Registers that the oldest message waiting for reply got none and
+        doubles its timeout (up to self.max_timeout).
+        """
+        with self._lock:
+            pending = self._pending[transport]
+            if not pending:
+                return
+            key, _ = pending.popleft()
+            estimate = self._estimate(key)
+            estimate.timeouts += 1
+            estimate.timeout = min(estimate.timeout * 2, self.max_timeout)
+
+    def clear(self, transport=None):
+        """Forgets messages waiting for reply (all transports if None).
+        """
+        with self._lock:
+            if transport is None:
+                self._pending.clear()
+            else:
+                self._pending[transport].clear()
+
+    def estimate(self, transport, cls):
+        """Returns the RttEstimate of given transport and command class.
+        """
+        with self._lock:
+            return self._estimate((transport, cls))
+
+    def estimates(self):
+        """Returns {(transport, command class): RttEstimate}.
+        """
+        with self._lock:
+            return dict(self._estimates)
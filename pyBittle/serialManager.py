@@ -6,6 +6,10 @@ SerialManager allows sending commands to Bittle through Serial.
 import serial
 import serial.tools.list_ports
 
+from pyBittle.meteredLock import MeteredLock
+from pyBittle.receiveBuffer import ReceiveBuffer
+from pyBittle.tracing import tracer
+
 __author__ = "EnriqueMoran"
 
 
@@ -18,19 +22,40 @@ class SerialManager:
         Serial communication port.
     baudrate : int
         Baud rate.
-    timeout : int
+    timeout : float
         Serial communication timeout (seconds).
+    write_timeout : float
+        Serial write timeout (seconds), None to block until written.
+    inter_byte_timeout : float
+        Seconds a read waits between bytes, None to disable.
+    boot_timeout : float
+        Seconds connect() waits for each boot banner line, timeout if None.
     parity : int
         Serial communication parity (possible values: none, odd, even).
     serial : serial.Serial
         Serial communication instance.
+    rtt_estimator : RttEstimator
+        If set, timeout for receiving replies is adapted to measured
+        round-trip times instead of timeout. None by default.
+    flow_control : FlowController
+        If set, limits the bytes written and not yet answered by Bittle.
+        None by default.
+    write_batcher : WriteBatcher
+        If set, messages sent close together are written at once. None by
+        default.
+    recv_buffer : ReceiveBuffer
+        Reusable buffer used by recv_view().
+    send_lock : MeteredLock
+        Serializes writes to the port, measuring contention.
+    recv_lock : MeteredLock
+        Serializes reads from the port, measuring contention.
 
     Methods
     -------
     initialize():
         Sets serial communication parameters. If any of the parameters is
         updated after initialization, this method must be called to apply
-        the changes.
+        the changes; an open port is reconfigured without reopening it.
     discover_port():
         Searches among avaliable communication ports the one associated
         to CH340 USB driver, which is used by Bittle.
@@ -38,21 +63,45 @@ class SerialManager:
         Starts serial communication. Return wether connection was achieved.
     close_connection():
         Closes serial communication.
+    close():
+        Releases the port, also done when used as a context manager.
     send_msg(msg):
-        Sends a message to Bittle.
+        Sends a message to Bittle. Returns False if dropped by flow control.
+    send_raw(data):
+        Sends already encoded data to Bittle. Returns False if dropped by
+        flow control.
     recv_msg():
         Returns received message from Bittle (byte).
+    recv_view():
+        Returns received message from Bittle as a view of recv_buffer.
     """
 
     def __init__(self):
         self._port = "COM1"
         self._baudrate = 115200
         self._timeout = 5
+        self._write_timeout = None
+        self._inter_byte_timeout = None
+        self._boot_timeout = None
         self._parity = serial.PARITY_NONE
         self.serial = serial.Serial()
+        self.recv_buffer = ReceiveBuffer()
+        self.rtt_estimator = None
+        self.flow_control = None
+        self.write_batcher = None
+        self.send_lock = MeteredLock()
+        self.recv_lock = MeteredLock()
 
     def __del__(self):
-        self.serial.close()
+        port = getattr(self, 'serial', None)  # __init__ may have failed
+        if port is not None:
+            port.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def __repr__(self):
         return f"SerialManager - port: {self.port}, baudrate: " \
@@ -91,10 +140,49 @@ class SerialManager:
 
     @timeout.setter
     def timeout(self, new_timeout):
-        if isinstance(new_timeout, int) and new_timeout >= 0:
+        if isinstance(new_timeout, (int, float)) and new_timeout >= 0:
             self._timeout = new_timeout
         else:
-            raise TypeError("Timeout must be positive int.")
+            raise TypeError("Timeout must be positive int or float.")
+
+    @property
+    def write_timeout(self):
+        return self._write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, new_timeout):
+        if new_timeout is None or (isinstance(new_timeout, (int, float))
+                                   and new_timeout >= 0):
+            self._write_timeout = new_timeout
+        else:
+            raise TypeError("Write timeout must be None, positive int or "
+                            "float.")
+
+    @property
+    def inter_byte_timeout(self):
+        return self._inter_byte_timeout
+
+    @inter_byte_timeout.setter
+    def inter_byte_timeout(self, new_timeout):
+        if new_timeout is None or (isinstance(new_timeout, (int, float))
+                                   and new_timeout >= 0):
+            self._inter_byte_timeout = new_timeout
+        else:
+            raise TypeError("Inter byte timeout must be None, positive int "
+                            "or float.")
+
+    @property
+    def boot_timeout(self):
+        return self._boot_timeout
+
+    @boot_timeout.setter
+    def boot_timeout(self, new_timeout):
+        if new_timeout is None or (isinstance(new_timeout, (int, float))
+                                   and new_timeout >= 0):
+            self._boot_timeout = new_timeout
+        else:
+            raise TypeError("Boot timeout must be None, positive int or "
+                            "float.")
 
     @property
     def parity(self):
@@ -115,12 +203,17 @@ class SerialManager:
             raise TypeError("Parity must be non empty str.")
 
     def initialize(self):
-        """Sets serial communication parameters.
+        """Sets serial communication parameters. An open port is
+        reconfigured in place (only changed settings are applied), it is
+        only reopened if self.port changed.
         """
-        self.serial.baudrate = self.baudrate
-        self.serial.port = self.port
-        self.serial.timeout = self.timeout
-        self.serial.parity = self.parity
+        self.serial.apply_settings({
+            'baudrate': self.baudrate, 'timeout': self.timeout,
+            'write_timeout': self.write_timeout,
+            'inter_byte_timeout': self.inter_byte_timeout,
+            'parity': self.parity})
+        if self.serial.port != self.port:
+            self.serial.port = self.port
 
     def discover_port(self):
         """Search among avaliable communication ports the one associated
@@ -137,40 +230,222 @@ class SerialManager:
 
     def connect(self):
         """Connects to Bittle and wait until full response is given
-        (response will contain "Finished! at the end").
+        (response will contain "Finished! at the end"), up to
+        self.boot_timeout (self.timeout if None) for each line. An already
+        open port is closed and opened again; the port is closed if the
+        handshake raises.
+
         Returns:
             res (bool) : True if connected successfully, False otherwise.
         """
         res = False
+        if self.serial.is_open:
+            self.serial.close()
         self.serial.open()
-        while True:
-            data = self.recv_msg()
-            if len(data) == 0:
-                    break
-            elif b"Finished!" in data:
-                res = True
-                self.recv_msg()  # Remove last blank line
-                break
+        self.recv_buffer.clear()
+        if self.flow_control is not None:
+            self.flow_control.clear()
+        try:
+            with self.recv_lock:  # Boot banner, not a reply to a message
+                timeout = self.serial.timeout
+                if self.boot_timeout is not None:
+                    self.serial.timeout = self.boot_timeout
+                try:
+                    while True:
+                        data = self.serial.readline()
+                        if len(data) == 0:
+                            break
+                        elif b"Finished!" in data:
+                            res = True
+                            self.serial.readline()  # Remove last blank line
+                            break
+                finally:
+                    self.serial.timeout = timeout
+        except BaseException:
+            self.serial.close()
+            raise
         return res
 
 
     def close_connection(self):
-        """Closes serial communication.
+        """Closes serial communication, writing queued messages first.
         """
-        self.serial.close()
+        try:
+            self._flush_batch()
+        finally:
+            self.serial.close()
+
+    def close(self):
+        """Closes serial communication and releases the port. The manager
+        can still connect() again.
+        """
+        self.close_connection()
+        self.recv_buffer.clear()
 
     def send_msg(self, msg):
-        """Sends a message to Bittle.
+        """Sends a message to Bittle (terminated by a newline if batched
+        by self.write_batcher, see pyBittle.writeBatcher).
+
+        Returns:
+            res (bool) : False if self.flow_control dropped the message,
+            True otherwise (or queued in self.write_batcher).
         """
         if isinstance(msg, str) and msg:
-            self.serial.write(msg.encode())
+            if self.write_batcher is not None:
+                self.write_batcher.queue(self._send, msg)
+                return True
+            return self._send(msg.encode(), msg)
         else:
             raise TypeError("Message must be non empty str.")
 
+    def send_raw(self, data):
+        """Sends already encoded data to Bittle.
+
+        Parameters:
+            data (bytes) : Data to send.
+
+        Returns:
+            res (bool) : False if self.flow_control dropped the data, True
+            otherwise.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)) and data:
+            self._flush_batch()
+            return self._send(data)
+        else:
+            raise TypeError("Data must be non empty bytes.")
+
+    def _send(self, data, msg=None, batch=None):
+        """Writes data through self.flow_control (if set), registering msg
+        in self.rtt_estimator once written; batch is [(msg, size, trace)]
+        of the messages packed in data by self.write_batcher, None if data
+        is msg alone. Returns False if dropped.
+        """
+        if batch is None:
+            trace = tracer.current() if tracer.enabled else None
+            if trace is not None:
+                trace.lap('encode')
+            batch = ((msg, len(data), trace),)
+        flow_control = self.flow_control
+        if flow_control is not None and not flow_control.reserve(len(data)):
+            return False
+        try:
+            with self.send_lock:
+                for _, _, trace in batch:
+                    if trace is not None:
+                        trace.lap('enqueue')
+                        tracer.written(self, trace)
+                partial = self._write_all(data)
+                for _, _, trace in batch:
+                    if trace is not None:
+                        trace.lap('write')
+                if flow_control is not None:
+                    flow_control.written(len(data), partial,
+                                         [size for _, size, _ in batch]
+                                         if len(batch) > 1 else None)
+                if self.rtt_estimator is not None:
+                    for msg, _, _ in batch:
+                        if msg is not None:
+                            self.rtt_estimator.sent('serial', msg)
+        except BaseException as err:
+            for _, _, trace in batch:
+                if trace is not None:
+                    tracer.discard(self, trace)
+            if flow_control is not None:
+                flow_control.cancel(len(data), isinstance(
+                                    err, serial.SerialTimeoutException))
+            raise
+        return True
+
+    def _flush_batch(self):
+        """Writes messages queued in self.write_batcher, if set.
+        """
+        if self.write_batcher is not None:
+            self.write_batcher.flush()
+
+    def _write_all(self, data):
+        """Writes data, rewriting whatever write() did not take. Returns
+        the number of partial writes. Raises serial.SerialTimeoutException
+        after self.write_timeout.
+        """
+        partial = 0
+        written = self.serial.write(data)
+        while written is not None and written < len(data):
+            if written == 0:
+                raise serial.SerialTimeoutException("Write timeout")
+            partial += 1
+            data = data[written:]
+            written = self.serial.write(data)
+        return partial
+
     def recv_msg(self):
         """Reads a serial data line (till '\n' character).
 
         Returns:
             data (byte) : Received data.
         """
-        return self.serial.readline()
+        self._flush_batch()
+        with self.recv_lock:
+            awaited = self._set_reply_timeout()
+            data = self.serial.readline()
+            self._reply_done(awaited, data)
+        return data
+
+    def _read_into(self, buffer):
+        """Reads into buffer whatever is waiting (at least one byte, waiting
+        up to self.timeout), returns the number of bytes read.
+        """
+        size = min(max(self.serial.in_waiting, 1), len(buffer))
+        size = self.serial.readinto(buffer[:size])
+        if size and tracer.enabled:
+            tracer.received_bytes(self)
+        return size
+
+    def recv_view(self):
+        """Reads a serial data line (till '\n' character) into
+        self.recv_buffer.
+
+        The view is only valid until the next call, copy it (bytes(data))
+        to keep it.
+
+        Returns:
+            data (memoryview) : Received data.
+        """
+        self._flush_batch()
+        with self.recv_lock:
+            awaited = self._set_reply_timeout()
+            data = self.recv_buffer.read_line(self._read_into)
+            self._reply_done(awaited, data)
+        return data
+
+    def _set_reply_timeout(self):
+        """Sets serial timeout from self.rtt_estimator (only touching the
+        port when it changes). Returns True if a reply is awaited.
+        """
+        if self.rtt_estimator is None:
+            return False
+        timeout = self.rtt_estimator.timeout('serial')
+        value = self.timeout if timeout is None else round(timeout, 3)
+        if self.serial.timeout != value:
+            self.serial.timeout = value
+        return timeout is not None
+
+    def _reply_done(self, awaited, data):
+        """Registers in self.rtt_estimator whether the awaited reply was
+        received (a partial line means the read timed out), and releases
+        answered messages from self.flow_control.
+        """
+        if data and self.flow_control is not None:
+            self.flow_control.received(data)
+        if data and tracer.enabled:
+            tracer.received_line(self, data)
+        if awaited:
+            if not data:
+                self.rtt_estimator.timed_out('serial')
+            else:  # A sample per complete reply line, not per chunk
+                if isinstance(data, memoryview):
+                    data = data.tobytes()
+                lines = data.count(b'\n')
+                if lines:
+                    self.rtt_estimator.received('serial', lines)
+                if not data.endswith(b'\n'):
+                    self.rtt_estimator.timed_out('serial')
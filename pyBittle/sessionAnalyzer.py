@@ -0,0 +1,459 @@
+"""This module analyzes captured session logs offline.
+
+A session log is a CSV file with one row per message sent:
+
+    sent,received,robot,transport,msg,status
+
+sent and received are timestamps in seconds (received is empty if no reply
+arrived), status is 'ok', 'timeout' or 'retry' (message sent again after a
+failure). SessionLog writes such files, and rows_from_spans() turns
+pyBittle.tracing spans into rows.
+
+analyze() streams a log in chunks of rows, so logs much larger than memory
+can be processed. Every chunk is accumulated with vectorized NumPy
+operations into per-robot, per-transport and per-command latency
+histograms (logarithmic bins, 1 us to 1000 s, about 2.3 % wide), status
+counters and a throughput time series. Percentiles are read from the
+histograms, so their precision is the width of a bin. The result can be
+printed as a report and compared against a baseline run.
+
+Requires NumPy (pip install pyBittle[sim]), this module is not imported by
+the pyBittle package, import it explicitly. It can also be run as a script:
+
+    python -m pyBittle.sessionAnalyzer LOG [--baseline LOG] [--interval S]
+"""
+
+import argparse
+import csv
+import math
+import sys
+
+import numpy as np
+
+from pyBittle.bittleManager import Bittle
+
+
+__author__ = "EnriqueMoran"
+
+
+COLUMNS = ('sent', 'received', 'robot', 'transport', 'msg', 'status')
+STATUSES = ('ok', 'timeout', 'retry')
+DIMENSIONS = ('robot', 'transport', 'command')
+
+_BINS_PER_DECADE = 100
+_MIN_EXPONENT = -6  # 1 us
+_MAX_EXPONENT = 3  # 1000 s
+_BINS = (_MAX_EXPONENT - _MIN_EXPONENT) * _BINS_PER_DECADE
+_EDGES = np.logspace(_MIN_EXPONENT, _MAX_EXPONENT, _BINS + 1)
+_CENTERS = np.sqrt(_EDGES[:-1] * _EDGES[1:])
+
+# Message : Command name, commands are reported by name
+_COMMAND_NAMES = {msg: command.name for command, msg
+                  in Bittle._commands.items()}
+
+
+class SessionLog:
+    """Writes session logs.
+
+    Methods
+    -------
+    record(sent, received, robot, transport, msg, status='ok'):
+        Writes a row.
+    close():
+        Closes the log file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(COLUMNS)
+
+    def __repr__(self):
+        return f"SessionLog - path: {self._file.name}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, sent, received, robot, transport, msg, status='ok'):
+        """Writes a row, received is None if no reply arrived.
+        """
+        if status not in STATUSES:
+            raise ValueError("Status must be 'ok', 'timeout' or 'retry'.")
+        self._writer.writerow((repr(sent), '' if received is None
+                               else repr(received), robot, transport, msg,
+                               status))
+
+    def close(self):
+        self._file.close()
+
+
+def rows_from_spans(spans):
+    """Returns session log rows from pyBittle.tracing spans: one 'ok' row
+    per completed command.
+
+    Parameters:
+        spans (list) : tracing.tracer.spans().
+    """
+    return [(start, end, robot, transport, msg.strip(), 'ok')
+            for _, robot, transport, msg, name, start, end in spans
+            if name is None]
+
+
+class _Codes:
+    """Maps strings to consecutive integer codes.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.names = []
+
+    def __call__(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+
+def iter_chunks(path, chunk_rows=500000):
+    """Yields the columns of a session log, chunk_rows rows at a time.
+
+    Parameters:
+        path (str) : Session log path.
+        chunk_rows (int) : Rows per chunk.
+
+    Returns:
+        chunks (generator) : (sent, received, robot, transport, command,
+        status, codes) per chunk: float64 arrays of timestamps (received is
+        NaN if missing), int32 arrays of codes and the code to name lists
+        ({dimension: [str]}), shared by every chunk.
+    """
+    codes = {dimension: _Codes() for dimension in DIMENSIONS}
+    status_codes = {status: code for code, status in enumerate(STATUSES)}
+    robot, transport, command = (codes[dimension] for dimension
+                                 in DIMENSIONS)
+    with open(path, newline='') as log:
+        reader = csv.reader(log)
+        header = next(reader, None)
+        if header is None or tuple(header) != COLUMNS:
+            raise ValueError(f"Session log must start with header "
+                             f"{','.join(COLUMNS)}.")
+        while True:
+            rows = [row for _, row in zip(range(chunk_rows), reader) if row]
+            if not rows:
+                break
+            sent, received, robots, transports, msgs, statuses = zip(*rows)
+            yield (np.array(sent, dtype=np.float64),
+                   np.array([value or 'nan' for value in received],
+                            dtype=np.float64),
+                   np.fromiter(map(robot, robots), np.int32, len(rows)),
+                   np.fromiter(map(transport, transports), np.int32,
+                               len(rows)),
+                   np.fromiter((command(_COMMAND_NAMES.get(msg, msg))
+                                for msg in msgs), np.int32, len(rows)),
+                   np.fromiter(map(status_codes.__getitem__, statuses),
+                               np.int32, len(rows)),
+                   {dimension: codes[dimension].names
+                    for dimension in DIMENSIONS})
+
+
+def _grow(array, rows):
+    """Returns array with at least rows rows (new rows are zeros).
+    """
+    if array.shape[0] >= rows:
+        return array
+    grown = np.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+
+class _GroupAccumulator:
+    """Latency histograms and status counters per group of one dimension.
+    """
+
+    def __init__(self):
+        self.histograms = np.zeros((0, _BINS), dtype=np.int64)
+        self.statuses = np.zeros((0, len(STATUSES)), dtype=np.int64)
+        self.latency_sum = np.zeros(0)
+        self.latency_max = np.zeros(0)
+
+    def add(self, groups, bins, latencies, answered, status, group_count):
+        self.histograms = _grow(self.histograms, group_count)
+        self.statuses = _grow(self.statuses, group_count)
+        self.latency_sum = _grow(self.latency_sum, group_count)
+        self.latency_max = _grow(self.latency_max, group_count)
+        answered_groups = groups[answered]
+        self.histograms += np.bincount(
+            answered_groups * _BINS + bins, minlength=group_count * _BINS
+        ).reshape(group_count, _BINS)
+        self.statuses += np.bincount(
+            groups * len(STATUSES) + status,
+            minlength=group_count * len(STATUSES)
+        ).reshape(group_count, len(STATUSES))
+        self.latency_sum += np.bincount(answered_groups, latencies,
+                                        minlength=group_count)
+        np.maximum.at(self.latency_max, answered_groups, latencies)
+
+
+def _percentiles(histograms, quantiles):
+    """Returns the percentiles (rows: groups, columns: quantiles) read from
+    histograms, NaN for groups without samples.
+    """
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1:]
+    res = np.full((histograms.shape[0], len(quantiles)), np.nan)
+    for column, quantile in enumerate(quantiles):
+        reached = cumulative >= np.maximum(np.ceil(totals * quantile), 1)
+        res[:, column] = _CENTERS[reached.argmax(axis=1)]
+    res[totals[:, 0] == 0] = np.nan
+    return res
+
+
+class SessionSummary:
+    """Result of analyze().
+
+    Attributes
+    ----------
+    rows : int
+        Messages in the log.
+    start : float
+        First send timestamp.
+    duration : float
+        Time between first and last send (seconds).
+    groups : {str: {str: dict}}
+        Statistics of every group of every dimension ('robot', 'transport'
+        and 'command'): count, answered, timeouts, retries, timeout_rate,
+        retry_rate, mean, p50, p90, p99, max (seconds) and outliers
+        (answered messages slower than outlier_factor times the group's
+        median).
+    throughput : numpy.ndarray
+        Messages sent per second in each interval.
+    interval : float
+        Throughput interval (seconds).
+    slowest : [tuple]
+        (latency, sent, robot, transport, command) of the slowest messages.
+
+    Methods
+    -------
+    report():
+        Returns a text summary.
+    compare(baseline):
+        Returns a text comparison against a baseline summary.
+    """
+
+    def __init__(self, rows, start, duration, groups, throughput, interval,
+                 slowest):
+        self.rows = rows
+        self.start = start
+        self.duration = duration
+        self.groups = groups
+        self.throughput = throughput
+        self.interval = interval
+        self.slowest = slowest
+
+    def __repr__(self):
+        return f"SessionSummary - rows: {self.rows}, duration: " \
+               f"{self.duration:.1f}, robots: {len(self.groups['robot'])}"
+
+    def report(self):
+        """Returns a text summary: per group statistics, throughput and
+        slowest messages.
+        """
+        lines = [f"{self.rows} messages in {self.duration:.1f} s"]
+        if len(self.throughput):
+            lines.append(f"Throughput ({self.interval:g} s intervals): "
+                         f"mean {self.throughput.mean():.1f} msg/s, min "
+                         f"{self.throughput.min():.1f}, max "
+                         f"{self.throughput.max():.1f}")
+        for dimension in DIMENSIONS:
+            lines.append("")
+            lines.append(f"{dimension:<24} {'count':>9} {'p50 (ms)':>9} "
+                         f"{'p90 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9} "
+                         f"{'timeout':>8} {'retry':>7} {'outliers':>8}")
+            for name, stats in sorted(self.groups[dimension].items()):
+                lines.append(
+                    f"{str(name)[:24]:<24} {stats['count']:>9} "
+                    f"{stats['p50'] * 1e3:>9.2f} {stats['p90'] * 1e3:>9.2f} "
+                    f"{stats['p99'] * 1e3:>9.2f} {stats['max'] * 1e3:>9.2f} "
+                    f"{stats['timeout_rate']:>8.2%} "
+                    f"{stats['retry_rate']:>7.2%} {stats['outliers']:>8}")
+        if self.slowest:
+            lines.append("")
+            lines.append("Slowest messages:")
+            for latency, sent, robot, transport, command in self.slowest:
+                lines.append(f"  {latency * 1e3:10.2f} ms  at "
+                             f"{sent - self.start:10.3f} s  {robot} "
+                             f"{transport} {command}")
+        return "\n".join(lines)
+
+    def compare(self, baseline):
+        """Returns a text comparison against a baseline summary: change of
+        p50, p99, timeout and retry rates of every group present in both.
+
+        Parameters:
+            baseline (SessionSummary) : Baseline run summary.
+        """
+        lines = []
+        if len(self.throughput) and len(baseline.throughput):
+            lines.append(f"Throughput: {baseline.throughput.mean():.1f} -> "
+                         f"{self.throughput.mean():.1f} msg/s")
+        for dimension in DIMENSIONS:
+            common = sorted(set(self.groups[dimension]) &
+                            set(baseline.groups[dimension]))
+            if not common:
+                continue
+            lines.append("")
+            lines.append(f"{dimension:<24} {'p50 change':>11} "
+                         f"{'p99 change':>11} {'timeout':>17} "
+                         f"{'retry':>17}")
+            for name in common:
+                new = self.groups[dimension][name]
+                old = baseline.groups[dimension][name]
+                lines.append(
+                    f"{str(name)[:24]:<24} "
+                    f"{_change(old['p50'], new['p50']):>11} "
+                    f"{_change(old['p99'], new['p99']):>11} "
+                    f"{old['timeout_rate']:>7.2%} -> "
+                    f"{new['timeout_rate']:<6.2%} "
+                    f"{old['retry_rate']:>7.2%} -> {new['retry_rate']:<6.2%}")
+        return "\n".join(lines)
+
+
+def _change(old, new):
+    if math.isnan(old) or math.isnan(new) or old == 0:
+        return "n/a"
+    return f"{(new - old) / old:+.1%}"
+
+
+def analyze(path, chunk_rows=500000, interval=1.0, outlier_factor=5.0,
+            top=10):
+    """Analyzes a session log, streaming it in chunks.
+
+    Parameters:
+        path (str) : Session log path.
+        chunk_rows (int) : Rows processed at once.
+        interval (float) : Throughput interval (seconds).
+        outlier_factor (float) : Messages slower than this factor times
+        their command's median latency are outliers.
+        top (int) : Slowest messages reported.
+
+    Returns:
+        summary (SessionSummary) : Statistics.
+    """
+    accumulators = {dimension: _GroupAccumulator() for dimension
+                    in DIMENSIONS}
+    throughput = np.zeros(0, dtype=np.int64)
+    start = end = None
+    rows = 0
+    names = {dimension: [] for dimension in DIMENSIONS}
+    slowest = np.zeros(0)
+    slowest_rows = []  # (sent, robot, transport, command) codes
+    for sent, received, robot, transport, command, status, names in \
+            iter_chunks(path, chunk_rows):
+        rows += len(sent)
+        chunk_start = sent.min()
+        if start is None:
+            start = chunk_start
+        elif chunk_start < start:  # Out of order log, shift time series
+            shift = int(math.ceil((start - chunk_start) / interval))
+            throughput = np.concatenate([np.zeros(shift, np.int64),
+                                         throughput])
+            start -= shift * interval
+        end = sent.max() if end is None else max(end, sent.max())
+        buckets = ((sent - start) / interval).astype(np.int64)
+        counts = np.bincount(buckets)
+        throughput = _grow(throughput, len(counts))
+        throughput[:len(counts)] += counts
+
+        latencies = received - sent
+        answered = ~np.isnan(latencies)
+        answered_latencies = latencies[answered]
+        bins = np.clip(((np.log10(np.maximum(answered_latencies, 1e-9)) -
+                         _MIN_EXPONENT) * _BINS_PER_DECADE).astype(np.int64),
+                       0, _BINS - 1)
+        for dimension, groups in zip(DIMENSIONS,
+                                     (robot, transport, command)):
+            accumulators[dimension].add(groups, bins, answered_latencies,
+                                        answered, status,
+                                        len(names[dimension]))
+
+        # Slowest messages: merge this chunk's top with the previous one
+        if top:
+            indices = np.flatnonzero(answered)
+            if len(indices) > top:
+                indices = indices[np.argpartition(latencies[indices],
+                                                  -top)[-top:]]
+            candidates = np.concatenate([slowest, latencies[indices]])
+            rows_info = slowest_rows + [(sent[i], robot[i], transport[i],
+                                         command[i]) for i in indices]
+            keep = np.argsort(candidates)[::-1][:top]
+            slowest = candidates[keep]
+            slowest_rows = [rows_info[i] for i in keep]
+    if start is None:
+        raise ValueError("Session log has no rows.")
+
+    groups = {}
+    for dimension in DIMENSIONS:
+        accumulator = accumulators[dimension]
+        percentiles = _percentiles(accumulator.histograms, (0.5, 0.9, 0.99))
+        answered = accumulator.histograms.sum(axis=1)
+        counts = accumulator.statuses.sum(axis=1)
+        # Outliers: histogram bins above outlier_factor times the median
+        thresholds = np.searchsorted(_EDGES, percentiles[:, 0] *
+                                     outlier_factor) - 1
+        above = np.arange(_BINS)[None, :] >= thresholds[:, None]
+        outliers = (accumulator.histograms * above).sum(axis=1)
+        groups[dimension] = {
+            name: {'count': int(counts[code]),
+                   'answered': int(answered[code]),
+                   'timeouts': int(accumulator.statuses[code, 1]),
+                   'retries': int(accumulator.statuses[code, 2]),
+                   'timeout_rate': accumulator.statuses[code, 1] /
+                   counts[code],
+                   'retry_rate': accumulator.statuses[code, 2] /
+                   counts[code],
+                   'mean': accumulator.latency_sum[code] / answered[code]
+                   if answered[code] else math.nan,
+                   'p50': percentiles[code, 0],
+                   'p90': percentiles[code, 1],
+                   'p99': percentiles[code, 2],
+                   'max': accumulator.latency_max[code]
+                   if answered[code] else math.nan,
+                   'outliers': int(outliers[code])}
+            for code, name in enumerate(names[dimension])}
+    return SessionSummary(
+        rows, start, end - start, groups,
+        throughput[:int((end - start) // interval) + 1] / interval, interval,
+        [(float(latency), float(sent), names['robot'][robot],
+          names['transport'][transport], names['command'][command])
+         for latency, (sent, robot, transport, command)
+         in zip(slowest, slowest_rows)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pyBittle.sessionAnalyzer",
+        description="Analyze a pyBittle session log.")
+    parser.add_argument('log', help="session log (CSV)")
+    parser.add_argument('--baseline', help="baseline session log to compare "
+                        "against")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="throughput interval (seconds)")
+    parser.add_argument('--chunk-rows', type=int, default=500000,
+                        help="rows processed at once")
+    args = parser.parse_args(argv)
+    summary = analyze(args.log, args.chunk_rows, args.interval)
+    print(summary.report())
+    if args.baseline:
+        print()
+        print(f"Compared to {args.baseline}:")
+        print(summary.compare(analyze(args.baseline, args.chunk_rows,
+                                      args.interval)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,474 @@
+"""This module uploads custom skills in checksummed chunks.
+
+A skill (OpenCat joint frames) is encoded once into binary and sent as
+chunks no larger than the link can take at once, each one carrying its
+offset in the skill, the skill size and a CRC32. The receiver answers every
+chunk with an acknowledgement line ('=offset,length') or a rejection
+('!offset,length'); up to window chunks are sent before waiting for their
+answers, and only rejected or unanswered byte ranges are sent again, so an
+interrupted upload is resumed by calling run() again. The chunk size grows
+while chunks get through and is halved when they do not.
+
+The robot side of the protocol is implemented by ChunkReceiver; Bittle's
+firmware must run an equivalent receiver (stock OpenCat firmware does not).
+"""
+
+import struct
+import time
+import zlib
+
+from array import array
+
+
+__author__ = "EnriqueMoran"
+
+
+_CHUNK = struct.Struct('<cIIHI')  # Marker, offset, total, length, crc32
+_MARKER = b'#'
+
+CHUNK_HEADER_SIZE = _CHUNK.size
+MAX_CHUNK_SIZE = 1024  # Payload bytes, limited by receivers' memory
+
+# Joints per frame of each kind of skill
+GAIT_JOINTS = 8
+POSTURE_JOINTS = 16
+BEHAVIOR_JOINTS = 20  # 16 joints, speed, delay, trigger axis and angle
+
+
+def encode_skill(frames, angle_ratio=1, expected_roll=0, expected_pitch=0,
+                 loop=None):
+    """Encodes a skill as OpenCat skill data (signed bytes): frame count
+    (negative for behaviors), expected roll and pitch, angle ratio, loop
+    start, end and repetitions (behaviors only) and the frames.
+
+    Parameters:
+        frames ([[int]]) : Joint angles of every frame: 8 per frame for
+        gaits, 16 for postures (one frame) and 20 for behaviors.
+        angle_ratio (int) : Angles are multiplied by it on Bittle.
+        expected_roll (int) : Expected body roll (degrees).
+        expected_pitch (int) : Expected body pitch (degrees).
+        loop ((int, int, int)) : Loop start frame, end frame and
+        repetitions; makes the skill a behavior.
+
+    Returns:
+        data (bytes) : Encoded skill.
+    """
+    frames = [list(frame) for frame in frames]
+    if not frames:
+        raise ValueError("Skill must have frames.")
+    joints = len(frames[0])
+    if any(len(frame) != joints for frame in frames):
+        raise ValueError("Every frame must have the same joints.")
+    if loop is not None:
+        if joints != BEHAVIOR_JOINTS:
+            raise ValueError(f"Behavior frames must have {BEHAVIOR_JOINTS} "
+                             f"values.")
+        header = [-len(frames), expected_roll, expected_pitch, angle_ratio] \
+            + list(loop)
+    elif joints in (GAIT_JOINTS, POSTURE_JOINTS):
+        header = [len(frames), expected_roll, expected_pitch, angle_ratio]
+    else:
+        raise ValueError(f"Frames must have {GAIT_JOINTS} (gait), "
+                         f"{POSTURE_JOINTS} (posture) or {BEHAVIOR_JOINTS} "
+                         f"(behavior) values.")
+    try:
+        data = array('b', header)
+        for frame in frames:
+            data.extend(frame)
+    except OverflowError:
+        raise ValueError("Skill values must be in [-128, 127].") from None
+    return data.tobytes()
+
+
+def encode_chunk(data, offset, length):
+    """Returns the chunk carrying data[offset:offset + length].
+    """
+    payload = bytes(data[offset:offset + length])
+    header = _CHUNK.pack(_MARKER, offset, len(data), len(payload), 0)
+    crc = zlib.crc32(payload, zlib.crc32(header[:-4]))
+    return header[:-4] + struct.pack('<I', crc) + payload
+
+
+class ChunkReceiver:
+    """Robot side of the chunk protocol: reassembles a skill from a byte
+    stream and returns the answer of every chunk.
+
+    Attributes
+    ----------
+    total : int
+        Skill size, None until the first valid chunk.
+    received : int
+        Skill bytes received (every distinct chunk counted once).
+    rejected : int
+        Chunks with a wrong checksum.
+
+    Methods
+    -------
+    feed(data):
+        Processes received bytes, returns the answer lines.
+    complete():
+        Returns True if the whole skill was received.
+    data():
+        Returns the received skill.
+    """
+
+    def __init__(self, max_chunk=MAX_CHUNK_SIZE):
+        self.max_chunk = max_chunk
+        self.total = None
+        self.received = 0
+        self.rejected = 0
+        self._buffer = bytearray()
+        self._data = None
+        self._ranges = set()  # Received (offset, length)
+
+    def __repr__(self):
+        return f"ChunkReceiver - total: {self.total}, received: " \
+               f"{self.received}, rejected: {self.rejected}"
+
+    def feed(self, data):
+        """Processes received bytes.
+
+        Parameters:
+            data (bytes) : Received bytes.
+
+        Returns:
+            answers ([bytes]) : Answer lines of the complete chunks.
+        """
+        buffer = self._buffer
+        buffer += data
+        answers = []
+        while True:
+            start = buffer.find(_MARKER)
+            if start < 0:
+                buffer.clear()
+                break
+            del buffer[:start]
+            if len(buffer) < _CHUNK.size:
+                break
+            _, offset, total, length, crc = _CHUNK.unpack_from(buffer)
+            if length > self.max_chunk or offset + length > total:
+                del buffer[:1]  # Corrupted header, resynchronize
+                continue
+            end = _CHUNK.size + length
+            if len(buffer) < end:
+                break
+            payload = bytes(buffer[_CHUNK.size:end])
+            valid = zlib.crc32(payload, zlib.crc32(
+                bytes(buffer[:_CHUNK.size - 4]))) == crc
+            if valid and self.total not in (None, total):
+                valid = False  # Chunk of another skill
+            if not valid:
+                self.rejected += 1
+                answers.append(b'!%d,%d\n' % (offset, length))
+                del buffer[:1]
+                continue
+            del buffer[:end]
+            if self._data is None:
+                self.total = total
+                self._data = bytearray(total)
+            self._data[offset:offset + length] = payload
+            if (offset, length) not in self._ranges:
+                self._ranges.add((offset, length))
+                self.received += length
+            answers.append(b'=%d,%d\n' % (offset, length))
+        return answers
+
+    def complete(self):
+        if self._data is None:
+            return False
+        covered = 0
+        for offset, length in sorted(self._ranges):
+            if offset > covered:
+                return False
+            covered = max(covered, offset + length)
+        return covered >= self.total
+
+    def data(self):
+        """Returns the received skill, None until complete.
+        """
+        return bytes(self._data) if self.complete() else None
+
+
+class UploadReport:
+    """Result of an upload.
+
+    Attributes
+    ----------
+    size : int
+        Skill size (bytes).
+    chunks : int
+        Chunks sent, including retransmissions.
+    retransmissions : int
+        Chunks sent again.
+    wire_bytes : int
+        Bytes written, including chunk headers.
+    elapsed : float
+        Upload time (seconds).
+    chunk_size : int
+        Final chunk size.
+    """
+
+    __slots__ = ('size', 'chunks', 'retransmissions', 'wire_bytes',
+                 'elapsed', 'chunk_size')
+
+    def __init__(self, size, chunks, retransmissions, wire_bytes, elapsed,
+                 chunk_size):
+        self.size = size
+        self.chunks = chunks
+        self.retransmissions = retransmissions
+        self.wire_bytes = wire_bytes
+        self.elapsed = elapsed
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return f"UploadReport - size: {self.size}, chunks: {self.chunks}, " \
+               f"retransmissions: {self.retransmissions}, elapsed: " \
+               f"{self.elapsed:.3f}, throughput: {self.throughput:.0f} B/s"
+
+    @property
+    def throughput(self):
+        """Skill bytes uploaded per second.
+        """
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def default_chunk_size(manager):
+    """Returns the initial chunk payload size for a manager: what fits in
+    its flow control budget if set, otherwise 64 bytes (NyBoard's input
+    buffer) minus the chunk header.
+    """
+    flow_control = getattr(manager, 'flow_control', None)
+    budget = flow_control.budget if flow_control is not None else 64
+    return max(budget - CHUNK_HEADER_SIZE, 1)
+
+
+class SkillUpload:
+    """Resumable chunked upload of one skill.
+
+    Attributes
+    ----------
+    manager : BluetoothManager or SerialManager
+        Manager to upload through.
+    data : bytes
+        Encoded skill.
+    chunk_size : int
+        Current chunk payload size.
+    min_chunk : int
+        Smallest chunk payload size.
+    max_chunk : int
+        Largest chunk payload size, by default what fits in the manager's
+        flow control budget if set.
+    window : int
+        Chunks sent before waiting for their answers (as many as fit in
+        the flow control budget).
+    max_stalls : int
+        Rounds without any acknowledged chunk before giving up.
+    answer_timeout : float
+        Seconds to wait for a round's answers once its chunks are sent,
+        however many other lines (IMU, status prints) Bittle sends.
+
+    Methods
+    -------
+    run():
+        Uploads the missing byte ranges, returns an UploadReport.
+    missing():
+        Returns the byte ranges not acknowledged yet.
+    """
+
+    def __init__(self, manager, data, chunk_size=None, min_chunk=8,
+                 max_chunk=None, window=4, max_stalls=5, answer_timeout=2.0):
+        if not (isinstance(data, (bytes, bytearray)) and data):
+            raise TypeError("Data must be non empty bytes.")
+        if not (isinstance(window, int) and window > 0):
+            raise TypeError("Window must be int, greater than 0.")
+        if not (isinstance(answer_timeout, (int, float)) and
+                answer_timeout > 0):
+            raise TypeError("Answer timeout must be number, greater than 0.")
+        self.manager = manager
+        self.data = bytes(data)
+        flow_control = getattr(manager, 'flow_control', None)
+        # Bytes in flight are limited by the manager's flow control budget
+        self._budget = None if flow_control is None else flow_control.budget
+        if max_chunk is None:
+            max_chunk = MAX_CHUNK_SIZE if self._budget is None \
+                else default_chunk_size(manager)
+        self.max_chunk = min(max_chunk, MAX_CHUNK_SIZE)
+        self.min_chunk = min(min_chunk, self.max_chunk)
+        self.chunk_size = min(max(chunk_size or default_chunk_size(manager),
+                                  self.min_chunk), self.max_chunk)
+        self.window = window
+        self.max_stalls = max_stalls
+        self.answer_timeout = answer_timeout
+        self._missing = [[0, len(self.data)]]
+        self._read = getattr(manager, 'recv_line', None) or manager.recv_msg
+        self._chunks = 0
+        self._retransmissions = 0
+        self._wire_bytes = 0
+        self._elapsed = 0.0
+
+    def __repr__(self):
+        return f"SkillUpload - size: {len(self.data)}, missing: " \
+               f"{sum(end - start for start, end in self._missing)}, " \
+               f"chunk_size: {self.chunk_size}"
+
+    def missing(self):
+        """Returns [(start, end)] byte ranges not acknowledged yet.
+        """
+        return [tuple(byte_range) for byte_range in self._missing]
+
+    def _take(self):
+        """Removes and returns up to self.window chunk ranges from the
+        missing ones (and no more than fit in the flow control budget).
+        """
+        batch = []
+        in_flight = 0
+        while self._missing and len(batch) < self.window:
+            start, end = self._missing[0]
+            length = min(self.chunk_size, end - start)
+            in_flight += length + CHUNK_HEADER_SIZE
+            if batch and self._budget is not None and \
+                    in_flight > self._budget:
+                break
+            batch.append((start, length))
+            if start + length == end:
+                self._missing.pop(0)
+            else:
+                self._missing[0][0] = start + length
+        return batch
+
+    def _requeue(self, ranges):
+        """Returns ranges to the missing ones, merging adjacent ranges.
+        """
+        merged = []
+        for start, end in sorted(self._missing +
+                                 [[offset, offset + length]
+                                  for offset, length in ranges]):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self._missing = merged
+
+    def _acknowledged(self, offset, length):
+        """Removes a late acknowledged range from the missing ones.
+        """
+        end = offset + length
+        remaining = []
+        for start, stop in self._missing:
+            if stop <= offset or start >= end:
+                remaining.append([start, stop])
+                continue
+            if start < offset:
+                remaining.append([start, offset])
+            if stop > end:
+                remaining.append([end, stop])
+        self._missing = remaining
+
+    def _answer(self, deadline):
+        """Reads lines until a chunk answer, returns (accepted, offset,
+        length), None on timeout or once time.perf_counter() passes
+        deadline.
+        """
+        while time.perf_counter() < deadline:
+            try:
+                line = bytes(self._read()).strip()
+            except OSError:  # Socket timeout
+                return None
+            if not line:
+                return None
+            if line[:1] in (b'=', b'!'):
+                try:
+                    offset, length = map(int, line[1:].split(b','))
+                except ValueError:
+                    continue
+                return line[:1] == b'=', offset, length
+        return None
+
+    def _send_round(self, batch):
+        """Sends a batch of chunks and collects their answers. Returns the
+        ranges acknowledged and the ranges to send again.
+        """
+        waiting = set()
+        for offset, length in batch:
+            chunk = encode_chunk(self.data, offset, length)
+            self._chunks += 1
+            if self.manager.send_raw(chunk) is False:
+                continue  # Dropped by flow control, send again
+            self._wire_bytes += len(chunk)
+            waiting.add((offset, length))
+        acked = set()
+        failed = set(batch) - waiting
+        deadline = time.perf_counter() + self.answer_timeout
+        while waiting:
+            answer = self._answer(deadline)
+            if answer is None:
+                break
+            accepted, offset, length = answer
+            if (offset, length) in waiting:
+                waiting.discard((offset, length))
+                (acked if accepted else failed).add((offset, length))
+            elif accepted:
+                acked.add((offset, length))  # Late answer
+        return acked, failed | waiting
+
+    def run(self):
+        """Uploads the byte ranges not acknowledged yet.
+
+        Raises ConnectionError after max_stalls rounds without any
+        acknowledged chunk; calling run() again resumes the upload.
+
+        Returns:
+            report (UploadReport) : Upload statistics (accumulated over
+            every run() of this upload).
+        """
+        start = time.perf_counter()
+        stalls = 0
+        try:
+            while self._missing:
+                batch = self._take()
+                acked, failed = self._send_round(batch)
+                for offset, length in acked:
+                    self._acknowledged(offset, length)
+                retry = [byte_range for byte_range in failed
+                         if byte_range not in acked]
+                if retry:
+                    self._retransmissions += len(retry)
+                    self._requeue(retry)
+                    self.chunk_size = max(self.chunk_size // 2,
+                                          self.min_chunk)
+                else:
+                    self.chunk_size = min(self.chunk_size * 2,
+                                          self.max_chunk)
+                stalls = 0 if acked else stalls + 1
+                if stalls >= self.max_stalls:
+                    raise ConnectionError(
+                        f"Upload stalled, {len(self.missing())} ranges "
+                        f"missing.")
+        finally:
+            self._elapsed += time.perf_counter() - start
+        return self.report()
+
+    def report(self):
+        """Returns the UploadReport of this upload so far.
+        """
+        return UploadReport(len(self.data), self._chunks,
+                            self._retransmissions, self._wire_bytes,
+                            self._elapsed, self.chunk_size)
+
+
+def upload_skill(manager, skill, **kwargs):
+    """Uploads a skill through a manager.
+
+    Parameters:
+        manager (BluetoothManager or SerialManager) : Manager to upload
+        through.
+        skill (bytes or [[int]]) : Encoded skill, or frames to encode with
+        encode_skill().
+        kwargs : SkillUpload parameters.
+
+    Returns:
+        report (UploadReport) : Upload statistics.
+    """
+    if not isinstance(skill, (bytes, bytearray)):
+        skill = encode_skill(skill)
+    return SkillUpload(manager, skill, **kwargs).run()
@@ -0,0 +1,149 @@
+"""This module tracks Bittle's state to avoid redundant commands.
+
+StateCache models Bittle's current posture and movement from the messages
+sent to it and from its replies, so messages that would not change what
+Bittle is doing (sending 'ksit' while sitting, 'kwkF' while walking forward)
+can be skipped.
+"""
+
+import threading
+import time
+
+from pyBittle.bittleManager import Direction, Gait
+
+
+__author__ = "EnriqueMoran"
+
+
+# Static postures, sending them again does not change anything
+POSTURES = frozenset(['d', 'kbalance', 'ksit', 'kzero', 'kstp', 'kbuttUp',
+                      'klu', 'kstr'])
+
+# Continuous movements: gait (or backward gait) followed by a direction
+MOVEMENTS = frozenset(
+    [gait.value + direction.value for gait in Gait for direction in Direction
+     if not direction.value.startswith('B')] +
+    ['kbk' + direction.value[1:] for direction in Direction
+     if direction.value.startswith('B')])
+
+# Replies meaning Bittle has been reset, its state is unknown
+RESET_REPLIES = (b'Finished!', b'Ready', b'Calibrat')
+
+
+class StateCache:
+    """Models Bittle's current state and filters redundant messages.
+
+    Postures and movements are state setting messages: they are skipped if
+    Bittle is already in that state. Any other message (skills, toggles,
+    custom messages) is always sent and leaves the state unknown.
+
+    Attributes
+    ----------
+    state : str
+        Last state setting message sent, None if unknown.
+    max_age : float
+        Seconds after which the state is considered unknown, None for no
+        limit.
+    hits : int
+        Messages skipped.
+    misses : int
+        Messages sent (including forced ones).
+    forced : int
+        Messages sent because of the force flag.
+    bytes_saved : int
+        Size of skipped messages.
+
+    Methods
+    -------
+    should_send(msg, force=False):
+        Returns True if msg must be sent and updates the state.
+    observe(data):
+        Updates the state with a reply from Bittle.
+    invalidate():
+        Sets the state as unknown.
+    stats():
+        Returns hit/miss counters.
+    """
+
+    def __init__(self, max_age=None):
+        self._lock = threading.Lock()
+        self._state = None
+        self._updated = 0.0
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.forced = 0
+        self.bytes_saved = 0
+
+    def __repr__(self):
+        return f"StateCache - state: {self.state}, hits: {self.hits}, " \
+               f"misses: {self.misses}, forced: {self.forced}"
+
+    @property
+    def state(self):
+        if self._expired():
+            return None
+        return self._state
+
+    @property
+    def max_age(self):
+        return self._max_age
+
+    @max_age.setter
+    def max_age(self, new_max_age):
+        if new_max_age is None or \
+                (isinstance(new_max_age, (int, float)) and new_max_age > 0):
+            self._max_age = new_max_age
+        else:
+            raise TypeError("Max age must be None or number, greater than 0.")
+
+    def _expired(self):
+        return self._max_age is not None and \
+            time.monotonic() - self._updated > self._max_age
+
+    def should_send(self, msg, force=False):
+        """Returns True if msg must be sent, False if Bittle is already in
+        the state it sets. The state is updated as if msg was sent, call
+        invalidate() if it is not (send raised or failed).
+
+        Parameters:
+            msg (str) : Message to send.
+            force (bool) : If True, msg is always sent.
+        """
+        with self._lock:
+            if not force and msg == self._state and not self._expired():
+                self.hits += 1
+                self.bytes_saved += len(msg)
+                return False
+            self.misses += 1
+            if force:
+                self.forced += 1
+            self._state = msg if msg in POSTURES or msg in MOVEMENTS \
+                else None
+            self._updated = time.monotonic()
+            return True
+
+    def observe(self, data):
+        """Updates the state with a reply from Bittle.
+
+        Parameters:
+            data (bytes) : Received data.
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if data and any(reply in data for reply in RESET_REPLIES):
+            self.invalidate()
+
+    def invalidate(self):
+        """Sets the state as unknown, next message will be sent.
+        """
+        with self._lock:
+            self._state = None
+
+    def stats(self):
+        """Returns {'hits', 'misses', 'forced', 'bytes_saved', 'hit_rate'}.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'forced': self.forced, 'bytes_saved': self.bytes_saved,
+                'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,439 @@
+"""This module records telemetry samples into columnar on-disk stores.
+
+A store is a directory holding one recording (e.g. one robot's IMU): every
+field (plus the 'time' index, float64 seconds) is a column with a fixed
+NumPy dtype, split into chunks of chunk_rows samples, each column of each
+chunk in its own raw file. Reading maps those files (numpy.memmap), so a
+time window costs a binary search on the time column and touches only the
+pages of that window, however long the recording.
+
+    meta.json           Fields, dtypes and chunk size.
+    rows                Committed samples (little endian uint64),
+                        overwritten in place on every flush.
+    000000.time         Chunk 0 time column.
+    000000.yaw          Chunk 0 'yaw' column...
+
+A single writer appends (samples are buffered and written every flush_rows
+samples or on flush()); any number of readers, in the same or other
+processes, can query while it records: they only see committed samples.
+
+Received lines are parsed with parse_numbers() (e.g. OpenCat's "ypr" IMU
+lines), and attach() records an EventBus topic in background.
+
+Requires NumPy (pip install pyBittle[sim]), this module is not imported by
+the pyBittle package, import it explicitly.
+"""
+
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+__author__ = "EnriqueMoran"
+
+
+IMU_FIELDS = (('yaw', 'f4'), ('pitch', 'f4'), ('roll', 'f4'))
+
+_ROWS = struct.Struct('<Q')
+
+_NUMBER = re.compile(rb'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+
+def parse_numbers(line):
+    """Returns the numbers in a received line.
+
+    Parameters:
+        line (bytes or str) : Received line (e.g. b"ypr\t1.5\t-3.0\t0.2").
+
+    Returns:
+        values ([float]) : Numbers found, in order.
+    """
+    if isinstance(line, str):
+        line = line.encode()
+    return [float(number) for number in _NUMBER.findall(bytes(line))]
+
+
+class TelemetryStore:
+    """Columnar, chunked and memory-mapped telemetry recording.
+
+    Attributes
+    ----------
+    path : str
+        Store directory.
+    fields : ((str, numpy.dtype))
+        Fields and their dtypes, 'time' first.
+    chunk_rows : int
+        Samples per chunk file.
+    flush_rows : int
+        Samples buffered before being written.
+
+    Methods
+    -------
+    append(values, timestamp=None):
+        Buffers a sample.
+    append_many(timestamps, columns):
+        Appends many samples at once.
+    append_line(line, timestamp=None):
+        Parses and buffers a received line.
+    attach(bus, topic='imu'):
+        Records an EventBus topic in background.
+    flush():
+        Writes buffered samples, making them visible to readers.
+    close():
+        Flushes and closes files.
+    time_range():
+        Returns first and last committed timestamps.
+    slice(start=None, end=None, fields=None):
+        Returns the samples of a time window.
+    iter_slices(start=None, end=None, fields=None):
+        Yields the samples of a time window, chunk by chunk.
+    """
+
+    def __init__(self, path, fields=IMU_FIELDS, chunk_rows=65536,
+                 flush_rows=1024):
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):  # Existing store, fields are its own
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            chunk_rows = meta['chunk_rows']
+            fields = [(name, dtype) for name, dtype in meta['fields']
+                      if name != 'time']
+        else:
+            if not (isinstance(chunk_rows, int) and chunk_rows > 0):
+                raise TypeError("Chunk rows must be int, greater than 0.")
+            names = [name for name, _ in fields]
+            if 'time' in names or len(set(names)) != len(names) or \
+                    not all(re.fullmatch(r'\w+', name) for name in names):
+                raise ValueError("Field names must be unique words other "
+                                 "than 'time'.")
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, 'w') as meta_file:
+                json.dump({'version': 1, 'chunk_rows': chunk_rows,
+                           'fields': [('time', 'f8')] +
+                           [(name, np.dtype(dtype).str)
+                            for name, dtype in fields]}, meta_file)
+        if not (isinstance(flush_rows, int) and flush_rows > 0):
+            raise TypeError("Flush rows must be int, greater than 0.")
+        self.fields = (('time', np.dtype('f8')),) + \
+            tuple((name, np.dtype(dtype)) for name, dtype in fields)
+        self.chunk_rows = chunk_rows
+        self.flush_rows = flush_rows
+        self._buffer = {name: np.empty(flush_rows, dtype)
+                        for name, dtype in self.fields}
+        self._buffered = 0
+        self._files = {}  # Field : open file of the chunk being written
+        self._maps = {}  # (chunk, field) : memmap of a full chunk
+        self._bounds = {}  # Chunk : (first, last) time of a full chunk
+        self._lock = threading.Lock()
+        self._rows = None  # Writer's committed rows, read on first append
+        self._rows_file = None
+        self._last_time = None
+        self._subscriptions = []
+
+    def __repr__(self):
+        return f"TelemetryStore - path: {self.path}, fields: " \
+               f"{[name for name, _ in self.fields[1:]]}, samples: " \
+               f"{len(self)}"
+
+    def __len__(self):
+        return self._committed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _column_path(self, chunk, name):
+        return os.path.join(self.path, f"{chunk:06d}.{name}")
+
+    def _committed(self):
+        """Returns the number of committed samples.
+        """
+        try:
+            with open(os.path.join(self.path, 'rows'), 'rb') as rows_file:
+                data = rows_file.read(_ROWS.size)
+        except FileNotFoundError:
+            return 0
+        return _ROWS.unpack(data)[0] if len(data) == _ROWS.size else 0
+
+    def _commit(self, rows):
+        """Publishes rows committed samples to readers: a single aligned
+        8 bytes write, readers see either the old or the new count.
+        """
+        if self._rows_file is None:
+            path = os.path.join(self.path, 'rows')
+            self._rows_file = open(path, 'r+b' if os.path.exists(path)
+                                   else 'w+b', buffering=0)
+        self._rows_file.seek(0)
+        self._rows_file.write(_ROWS.pack(rows))
+        self._rows = rows
+
+    def append(self, values, timestamp=None):
+        """Buffers a sample.
+
+        Parameters:
+            values (sequence) : Value of every field, in order.
+            timestamp (float) : Sample time (seconds), time.time() if None.
+            Samples must be appended in time order, ValueError is raised
+            otherwise.
+        """
+        if len(values) != len(self.fields) - 1:
+            raise ValueError(f"Sample must have {len(self.fields) - 1} "
+                             f"values.")
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            row = self._buffered
+            last = self._buffer['time'][row - 1] if row else \
+                self._last_committed_time()
+            if last is not None and timestamp < last:
+                raise ValueError("Samples must be appended in time order.")
+            self._buffer['time'][row] = timestamp
+            for (name, _), value in zip(self.fields[1:], values):
+                self._buffer[name][row] = value
+            self._buffered += 1
+            if self._buffered == self.flush_rows:
+                self._flush()
+
+    def append_line(self, line, timestamp=None):
+        """Parses a received line and buffers it as a sample.
+
+        Returns:
+            res (bool) : False if the line has not one number per field.
+        """
+        values = parse_numbers(line)
+        if len(values) != len(self.fields) - 1:
+            return False
+        self.append(values, timestamp)
+        return True
+
+    def append_many(self, timestamps, columns):
+        """Appends many samples at once (buffered samples are flushed
+        first).
+
+        Parameters:
+            timestamps (numpy.ndarray) : Sample times, in order.
+            columns (dict or sequence) : Array of every field, by name or in
+            order.
+        """
+        if not isinstance(columns, dict):
+            columns = dict(zip((name for name, _ in self.fields[1:]),
+                               columns))
+        data = {'time': np.asarray(timestamps, dtype='f8')}
+        for name, dtype in self.fields[1:]:
+            data[name] = np.asarray(columns[name], dtype=dtype)
+            if data[name].shape != data['time'].shape:
+                raise ValueError("Columns must have one value per "
+                                 "timestamp.")
+        with self._lock:
+            self._flush()
+            self._write(data, len(data['time']))
+
+    def flush(self):
+        """Writes buffered samples, making them visible to readers.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffered:
+            self._write(self._buffer, self._buffered)
+            self._buffered = 0  # Kept buffered if the write raised
+
+    def _last_committed_time(self):
+        """Returns the last committed timestamp, None if empty (reading the
+        committed rows of an existing store once).
+        """
+        if self._rows is None:
+            self._rows = self._committed()
+            if self._rows:
+                self._last_time = self.time_range()[1]
+        return self._last_time
+
+    def _write(self, data, rows):
+        """Writes the first rows of data to the column files and commits
+        their count.
+        """
+        if not rows:
+            return
+        times = data['time'][:rows]
+        last = self._last_committed_time()
+        if np.any(np.diff(times) < 0) or (last is not None and
+                                          times[0] < last):
+            raise ValueError("Samples must be appended in time order.")
+        offset = 0
+        total = self._rows
+        try:
+            while offset < rows:
+                chunk, position = divmod(total, self.chunk_rows)
+                size = min(rows - offset, self.chunk_rows - position)
+                if position == 0:
+                    self._close_files()
+                for name, dtype in self.fields:
+                    column = self._files.get(name)
+                    if column is None:
+                        column = self._files[name] = open(
+                            self._column_path(chunk, name), 'ab')
+                        # Drop samples written but never committed (crash
+                        # or failed write)
+                        column.truncate(position * dtype.itemsize)
+                    column.write(data[name][offset:offset + size].tobytes())
+                    column.flush()
+                total += size
+                offset += size
+        except BaseException:
+            self._close_files()  # Reopened and truncated by the next write
+            raise
+        self._last_time = float(times[-1])
+        self._commit(total)
+
+    def _close_files(self):
+        for column in self._files.values():
+            column.close()
+        self._files = {}
+
+    def close(self):
+        """Stops attached recordings, flushes and closes files.
+        """
+        for subscription in self._subscriptions:
+            subscription.close()
+        self._subscriptions = []
+        with self._lock:
+            self._flush()
+            self._close_files()
+            if self._rows_file is not None:
+                self._rows_file.close()
+                self._rows_file = None
+        self._maps = {}
+
+    def attach(self, bus, topic='imu'):
+        """Records every line of an EventBus topic (parsed with
+        append_line(), timestamped on reception: the event's monotonic
+        received_at, shifted to time.time() of the attach call, so wall
+        clock adjustments don't break time order).
+
+        Parameters:
+            bus (EventBus) : Bus to subscribe to.
+            topic (str) : Recorded topic.
+
+        Returns:
+            subscription (Subscription) : Subscription, closed by close().
+        """
+        offset = time.time() - time.monotonic()
+        subscription = bus.subscribe(topic, callback=lambda event:
+                                     self.append_line(event.data,
+                                                      event.received_at +
+                                                      offset))
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def time_range(self):
+        """Returns (first, last) committed timestamps, None if empty.
+        """
+        bounds = self._chunk_bounds(self._committed())
+        if not bounds:
+            return None
+        return bounds[0][0], bounds[-1][1]
+
+    def _chunk_rows(self, chunk, rows):
+        """Returns the committed samples of a chunk, rows committed in
+        total.
+        """
+        return min(rows - chunk * self.chunk_rows, self.chunk_rows)
+
+    def _chunk_bounds(self, rows):
+        """Returns (first, last) time of every chunk, rows committed.
+        """
+        res = []
+        for chunk in range(-(-rows // self.chunk_rows)):
+            bounds = self._bounds.get(chunk)
+            if bounds is None:
+                size = self._chunk_rows(chunk, rows)
+                times = self._column(chunk, 'time', self.fields[0][1], size,
+                                     size == self.chunk_rows)
+                bounds = (float(times[0]), float(times[size - 1]))
+                if size == self.chunk_rows:
+                    self._bounds[chunk] = bounds
+            res.append(bounds)
+        return res
+
+    def _column(self, chunk, name, dtype, rows, full):
+        """Returns a chunk column mapped in memory. Full chunks never change,
+        their maps are kept.
+        """
+        key = (chunk, name)
+        column = self._maps.get(key)
+        if column is None:
+            column = np.memmap(self._column_path(chunk, name), dtype=dtype,
+                               mode='r', shape=(rows,))
+            if full:
+                self._maps[key] = column
+        return column
+
+    def iter_slices(self, start=None, end=None, fields=None):
+        """Yields the committed samples with start <= time < end, chunk by
+        chunk, as read-only views of the files.
+
+        Parameters:
+            start (float) : Window start, from the first sample if None.
+            end (float) : Window end, until the last sample if None.
+            fields ([str]) : Fields to return, all if None.
+
+        Returns:
+            slices (generator) : {field: numpy.ndarray} per chunk, 'time'
+            included.
+        """
+        dtypes = dict(self.fields)
+        names = ['time'] + [name for name in (fields or dtypes)
+                            if name != 'time']
+        for name in names:
+            if name not in dtypes:
+                raise ValueError(f"Unknown field '{name}'.")
+        committed = self._committed()
+        bounds = self._chunk_bounds(committed)
+        if not bounds:
+            return
+        first_chunk = 0 if start is None else \
+            int(np.searchsorted([last for _, last in bounds], start, 'left'))
+        last_chunk = len(bounds) if end is None else \
+            int(np.searchsorted([first for first, _ in bounds], end, 'left'))
+        for chunk in range(first_chunk, last_chunk):
+            rows = self._chunk_rows(chunk, committed)
+            full = rows == self.chunk_rows
+            times = self._column(chunk, 'time', dtypes['time'], rows, full)
+            low = 0 if start is None else \
+                int(np.searchsorted(times, start, 'left'))
+            high = rows if end is None else \
+                int(np.searchsorted(times, end, 'left'))
+            if low < high:
+                yield {name: self._column(chunk, name, dtypes[name], rows,
+                                          full)[low:high]
+                       for name in names}
+
+    def slice(self, start=None, end=None, fields=None):
+        """Returns the committed samples with start <= time < end. Windows
+        within one chunk are views of the files, larger ones are copied.
+
+        Parameters:
+            start (float) : Window start, from the first sample if None.
+            end (float) : Window end, until the last sample if None.
+            fields ([str]) : Fields to return, all if None.
+
+        Returns:
+            samples ({str: numpy.ndarray}) : Array of every field, 'time'
+            included.
+        """
+        parts = list(self.iter_slices(start, end, fields))
+        if len(parts) == 1:
+            return parts[0]
+        dtypes = dict(self.fields)
+        names = ['time'] + [name for name in (fields or dtypes)
+                            if name != 'time']
+        return {name: np.concatenate([part[name] for part in parts])
+                if parts else np.empty(0, dtypes[name]) for name in names}
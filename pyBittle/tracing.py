@@ -0,0 +1,286 @@
+"""This module traces individual commands through Bittle and the managers.
+
+Every message sent by a Bittle (or submitted to a TransportDispatcher) gets
+a trace made of consecutive spans:
+
+    validate        State cache decision (Bittle).
+    dispatch_queue  TransportDispatcher queue wait.
+    encode          Message encoding.
+    enqueue         Flow control and send lock waits.
+    write           Transport write (the whole HTTP request for WiFi).
+    first_byte      From the end of the write to the first byte received.
+    ack             From the first byte to the reply line matching the
+                    message (OpenCat echoes its token).
+
+plus a span named after the message covering the whole command. Spans carry
+the robot id (Bittle._id) and transport, are appended to a bounded deque
+(appends are atomic, no lock is taken) and can be exported as Chrome trace
+JSON, viewable in chrome://tracing or https://ui.perfetto.dev.
+
+Tracing is disabled by default and costs a flag check per message. Enable it
+with tracer.enable() or by setting the PYBITTLE_TRACE environment variable;
+if PYBITTLE_TRACE_OUTPUT is set too, the trace is written to that path at
+exit.
+"""
+
+import atexit
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+
+
+__author__ = "EnriqueMoran"
+
+
+_AWAITING = 64  # Traces kept per manager waiting for their reply
+
+
+class Trace:
+    """Spans of one command, recorded as consecutive laps.
+
+    Attributes
+    ----------
+    id : int
+        Trace id.
+    robot : str
+        Robot id, None if unknown.
+    transport : str
+        'bluetooth', 'serial' or 'wifi'.
+    msg : str
+        Traced message.
+    started : float
+        time.perf_counter() of the start of the trace.
+    """
+
+    __slots__ = ('tracer', 'id', 'robot', 'transport', 'msg', 'started',
+                 'mark', 'first_byte')
+
+    def __init__(self, tracer, trace_id, robot, transport, msg):
+        self.tracer = tracer
+        self.id = trace_id
+        self.robot = robot
+        self.transport = transport
+        self.msg = msg
+        self.started = self.mark = time.perf_counter()
+        self.first_byte = None
+
+    def __repr__(self):
+        return f"Trace - id: {self.id}, robot: {self.robot}, transport: " \
+               f"{self.transport}, msg: {self.msg}"
+
+    def lap(self, name):
+        """Records a span from the end of the previous one until now.
+        """
+        now = time.perf_counter()
+        self.tracer._record(self, name, self.mark, now)
+        self.mark = now
+
+    def finish(self):
+        """Records the span of the whole command.
+        """
+        self.tracer._record(self, None, self.started, time.perf_counter())
+
+
+class Tracer:
+    """Opt-in per-command tracer.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether commands are traced.
+    capacity : int
+        Spans kept, the oldest ones are discarded.
+
+    Methods
+    -------
+    enable():
+        Starts tracing.
+    disable():
+        Stops tracing. Recorded spans are kept.
+    clear():
+        Discards recorded spans.
+    begin(robot, transport, msg):
+        Starts the trace of a message in the calling thread.
+    current():
+        Returns the calling thread's trace.
+    spans():
+        Returns recorded spans.
+    chrome_trace():
+        Returns recorded spans in Chrome trace format.
+    dump_chrome_trace(path):
+        Writes recorded spans as Chrome trace JSON.
+    """
+
+    def __init__(self, capacity=100000):
+        self.enabled = False
+        self.capacity = capacity
+        self._spans = collections.deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        # Manager : deque of traces waiting for reply, weak so closed
+        # managers are not kept alive by the tracer
+        self._awaiting = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        return f"Tracer - enabled: {self.enabled}, spans: {len(self._spans)}"
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        """Discards recorded spans and pending traces.
+        """
+        self._spans.clear()
+        self._awaiting = weakref.WeakKeyDictionary()
+
+    def begin(self, robot, transport, msg):
+        """Starts a trace and makes it the calling thread's current one.
+
+        Parameters:
+            robot (str) : Robot id, None if unknown.
+            transport (str) : 'bluetooth', 'serial' or 'wifi'.
+            msg (str) : Traced message.
+
+        Returns:
+            trace (Trace) : Started trace.
+        """
+        trace = Trace(self, next(self._ids), robot, transport, msg)
+        self._local.trace = trace
+        return trace
+
+    def current(self):
+        """Returns the calling thread's current trace, None if there is
+        none or tracing is disabled.
+        """
+        if not self.enabled:
+            return None
+        return getattr(self._local, 'trace', None)
+
+    def attach(self, trace):
+        """Makes trace the calling thread's current one (e.g. a writer
+        thread sending a message traced in another thread).
+        """
+        self._local.trace = trace
+
+    def detach(self):
+        """Clears the calling thread's current trace.
+        """
+        self._local.trace = None
+
+    def _record(self, trace, name, start, end):
+        self._spans.append((trace.id, trace.robot, trace.transport,
+                            trace.msg, name, start, end))
+
+    def written(self, manager, trace):
+        """Registers that trace's message was written to manager, so its
+        reply is timed.
+        """
+        awaiting = self._awaiting.get(manager)
+        if awaiting is None:
+            awaiting = self._awaiting.setdefault(
+                manager, collections.deque(maxlen=_AWAITING))
+        awaiting.append(trace)
+
+    def discard(self, manager, trace):
+        """Stops waiting for the reply of a message whose write failed.
+        """
+        try:
+            self._awaiting[manager].remove(trace)
+        except (KeyError, ValueError):
+            pass
+
+    def received_bytes(self, manager):
+        """Registers that manager received bytes: first byte of the reply
+        of its oldest written message.
+        """
+        awaiting = self._awaiting.get(manager)
+        try:
+            trace = awaiting[0]
+        except (TypeError, IndexError):
+            return
+        if trace.first_byte is None:
+            trace.lap('first_byte')
+            trace.first_byte = trace.mark
+
+    def received_line(self, manager, data):
+        """Registers reply lines received by manager: a line starting with
+        the token of its oldest written message completes that trace.
+        """
+        awaiting = self._awaiting.get(manager)
+        if not awaiting:
+            return
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        for line in data.splitlines():
+            line = line.lstrip()
+            try:
+                trace = awaiting[0]
+            except IndexError:
+                return
+            if line and line[:1] == trace.msg[:1].encode():
+                awaiting.popleft()
+                if trace.first_byte is None:
+                    trace.lap('first_byte')
+                    trace.first_byte = trace.mark
+                trace.lap('ack')
+                trace.finish()
+
+    def spans(self):
+        """Returns recorded spans.
+
+        Returns:
+            res ([(int, str, str, str, str, float, float)]) : Trace id,
+            robot, transport, message, span name (None for the whole
+            command), start and end (time.perf_counter() seconds).
+        """
+        return list(self._spans)
+
+    def chrome_trace(self):
+        """Returns recorded spans in Chrome trace format: one process per
+        robot and one track per command.
+
+        Returns:
+            res (dict) : Chrome trace ({'traceEvents': [...]}).
+        """
+        events = []
+        robots = {}
+        for trace_id, robot, transport, msg, name, start, end in \
+                self.spans():
+            pid = robots.get(robot)
+            if pid is None:
+                pid = robots[robot] = len(robots) + 1
+                events.append({'name': 'process_name', 'ph': 'M',
+                               'pid': pid, 'args': {
+                                   'name': f"Bittle {robot}"}})
+            events.append({'name': msg if name is None else name,
+                           'cat': transport, 'ph': 'X',
+                           'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                           'pid': pid, 'tid': trace_id,
+                           'args': {'msg': msg, 'trace': trace_id}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_chrome_trace(self, path):
+        """Writes recorded spans as Chrome trace JSON.
+
+        Parameters:
+            path (str) : Output file path.
+        """
+        with open(path, 'w') as output:
+            json.dump(self.chrome_trace(), output)
+
+
+tracer = Tracer()
+
+
+if os.environ.get('PYBITTLE_TRACE'):
+    tracer.enable()
+    if os.environ.get('PYBITTLE_TRACE_OUTPUT'):
+        atexit.register(tracer.dump_chrome_trace,
+                        os.environ['PYBITTLE_TRACE_OUTPUT'])
@@ -0,0 +1,360 @@
+"""This module shares one transport between many threads.
+
+TransportDispatcher owns a manager's writes and reads: messages submitted
+from any thread are queued and written by a single writer thread, and a
+single reader thread routes every reply to the thread waiting for it (in
+send order), so concurrent producers neither interleave writes nor steal
+each other's replies.
+
+Replies are matched by their first character by default, OpenCat (and
+pyBittle.fleetSimulator) answer a message with its token; pass
+echo_matcher for firmware echoing the whole command.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+from pyBittle.tracing import tracer
+
+
+__author__ = "EnriqueMoran"
+
+
+_MIN_BACKOFF = 0.001  # Pause after a read returning nothing at once
+_MAX_BACKOFF = 0.05
+_EXPIRE_INTERVAL = 0.05  # Timeout check period, reads may block longer
+
+
+def first_char_matcher(msg, reply):
+    """Returns True if reply starts with msg's token (first character),
+    as OpenCat's acknowledgement ('k' for every skill, gait and posture).
+    """
+    reply = reply.lstrip()
+    return bool(reply) and reply[:1] == msg[:1].encode()
+
+
+def echo_matcher(msg, reply):
+    """Returns True if reply starts with msg's command (msg up to its
+    first space, as 'ksit' or 'i'), for firmware echoing whole commands.
+    """
+    command = msg.split(None, 1)
+    return bool(command) and reply.lstrip().startswith(command[0].encode())
+
+
+class _Waiter:
+    __slots__ = ('msg', 'future', 'sent_at', 'expired', 'trace')
+
+    def __init__(self, msg, future, trace=None):
+        self.msg = msg
+        self.future = future
+        self.sent_at = 0.0
+        self.expired = False
+        self.trace = trace
+
+
+class TransportDispatcher:
+    """Single writer and reply router for one manager.
+
+    Replies are matched against the oldest waiting message, skipping
+    waiters that already timed out (their reply may have been lost);
+    replies matching none (debug prints, telemetry) are passed to
+    unsolicited. A waiter gets a TimeoutError after reply_timeout (checked
+    by the writer thread every _EXPIRE_INTERVAL, so a blocking read does
+    not delay it), and is kept for as long again so its late reply is not
+    routed to the next waiter.
+
+    Attributes
+    ----------
+    manager : BluetoothManager, SerialManager or WifiManager
+        Manager whose transport is shared.
+    reply_timeout : float
+        Seconds to wait for a reply.
+    matcher : callable
+        matcher(msg, reply) returns True if reply answers msg,
+        first_char_matcher by default.
+    unsolicited : callable
+        Called with every reply no one is waiting for, None to drop them.
+    robot : str
+        Robot id of traces (see pyBittle.tracing), None by default.
+
+    Methods
+    -------
+    start():
+        Starts writer and reader threads.
+    stop():
+        Stops threads, failing pending requests.
+    submit(msg, expect_reply=True):
+        Queues a message, returns a Future of its reply.
+    request(msg, timeout=None):
+        Sends a message and returns its reply.
+    metrics():
+        Returns throughput and contention counters.
+    """
+
+    def __init__(self, manager, reply_timeout=2.0, max_queue=0,
+                 matcher=first_char_matcher, unsolicited=None):
+        self.manager = manager
+        self.reply_timeout = reply_timeout
+        self.matcher = matcher
+        self.unsolicited = unsolicited
+        self.robot = None
+        self._transport = type(manager).__name__.replace('Manager',
+                                                         '').lower()
+        if hasattr(manager, 'recv_line'):
+            self._read = manager.recv_line
+        elif hasattr(manager, 'recv_msg'):
+            self._read = manager.recv_msg
+        else:  # WifiManager, reply is the response code
+            self._read = None
+        self._queue = queue.Queue(max_queue)
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._running = False
+        self._threads = []
+        self._counters = collections.Counter()
+        self._queue_wait = 0.0
+        self._max_queue_wait = 0.0
+        self._reply_time = 0.0
+        self._max_depth = 0
+
+    def __repr__(self):
+        return f"TransportDispatcher - manager: {self.manager!r}, " \
+               f"running: {self._running}, pending: {len(self._pending)}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """Starts writer and reader threads.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._threads = [threading.Thread(target=self._write_loop,
+                                          name="pyBittle-writer",
+                                          daemon=True)]
+        if self._read is not None:
+            self._threads.append(threading.Thread(target=self._read_loop,
+                                                  name="pyBittle-reader",
+                                                  daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Stops threads; queued and waiting requests fail with
+        ConnectionError.
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].future.set_exception(
+                    ConnectionError("Dispatcher stopped."))
+        with self._lock:
+            for waiter in self._pending:
+                if not waiter.future.done():
+                    waiter.future.set_exception(
+                        ConnectionError("Dispatcher stopped."))
+            self._pending.clear()
+
+    def submit(self, msg, expect_reply=True):
+        """Queues a message to be written by the writer thread.
+
+        Parameters:
+            msg (str) : Message to send.
+            expect_reply (bool) : If True, the future resolves with the
+            reply; otherwise with None once written.
+
+        Returns:
+            future (concurrent.futures.Future) : Reply (bytes), or response
+            code (int) for WifiManager.
+        """
+        if not (isinstance(msg, str) and msg):
+            raise TypeError("Message must be non empty str.")
+        if not self._running:
+            raise ConnectionError("Dispatcher is not running.")
+        trace = None
+        if tracer.enabled:
+            trace = tracer.begin(self.robot, self._transport, msg)
+            tracer.detach()  # Continued by the writer thread
+        waiter = _Waiter(msg, Future(), trace)
+        self._queue.put((time.perf_counter(), waiter, expect_reply))
+        depth = self._queue.qsize()
+        if depth > self._max_depth:
+            self._max_depth = depth
+        return waiter.future
+
+    def request(self, msg, timeout=None):
+        """Sends a message and waits for its reply.
+
+        Parameters:
+            msg (str) : Message to send.
+            timeout (float) : Seconds to wait, self.reply_timeout if None.
+
+        Returns:
+            reply (bytes) : Bittle's reply (response code for WifiManager).
+        """
+        future = self.submit(msg)
+        return future.result(self.reply_timeout * 2 if timeout is None
+                             else timeout)
+
+    def _write_loop(self):
+        # Replies are awaited, expire them even if the reader is blocked
+        timeout = _EXPIRE_INTERVAL if self._read is not None else None
+        while True:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._expire()
+                continue
+            if item is None:
+                break
+            queued_at, waiter, expect_reply = item
+            if not waiter.future.set_running_or_notify_cancel():
+                continue
+            waited = time.perf_counter() - queued_at
+            if waiter.trace is not None:
+                waiter.trace.lap('dispatch_queue')
+                tracer.attach(waiter.trace)
+            with self._lock:
+                self._queue_wait += waited
+                if waited > self._max_queue_wait:
+                    self._max_queue_wait = waited
+            try:
+                if self._read is None:
+                    waiter.future.set_result(self.manager.send_msg(
+                                             waiter.msg))
+                    self._counters['written'] += 1
+                    continue
+                waiter.sent_at = time.perf_counter()
+                if expect_reply:  # Registered before writing, reply may be
+                    with self._lock:  # read before send_msg returns
+                        self._pending.append(waiter)
+                self.manager.send_msg(waiter.msg)
+                self._counters['written'] += 1
+                if not expect_reply:
+                    waiter.future.set_result(None)
+            except Exception as err:
+                self._counters['errors'] += 1
+                with self._lock:
+                    if waiter in self._pending:
+                        self._pending.remove(waiter)
+                if not waiter.future.done():
+                    waiter.future.set_exception(err)
+            finally:
+                if waiter.trace is not None:
+                    tracer.detach()
+            if timeout is not None:
+                self._expire()
+
+    def _read_loop(self):
+        backoff = 0.0
+        while self._running:
+            start = time.perf_counter()
+            try:
+                reply = self._read()
+            except OSError:  # Socket timeout or error
+                reply = b''
+                if not self._running:
+                    break
+            if reply:
+                backoff = 0.0
+                self._route(bytes(reply))
+            elif time.perf_counter() - start < _MIN_BACKOFF:
+                # Returned at once (closed port or socket), don't spin
+                backoff = min(max(backoff * 2, _MIN_BACKOFF), _MAX_BACKOFF)
+                time.sleep(backoff)
+            self._expire()
+
+    def _route(self, reply):
+        """Hands reply to the oldest waiter it matches, skipping (and
+        forgetting) timed out waiters before it.
+        """
+        waiter = None
+        with self._lock:
+            for index, pending in enumerate(self._pending):
+                if self.matcher(pending.msg, reply):
+                    waiter = pending
+                    for _ in range(index + 1):
+                        self._pending.popleft()
+                    break
+                if not pending.expired:  # Still waiting for its reply
+                    break
+        if waiter is None:
+            self._counters['unsolicited'] += 1
+            if self.unsolicited is not None:
+                self.unsolicited(reply)
+        elif waiter.expired:
+            self._counters['late'] += 1
+        else:
+            elapsed = time.perf_counter() - waiter.sent_at
+            with self._lock:
+                self._reply_time += elapsed
+            self._counters['replies'] += 1
+            waiter.future.set_result(reply)
+
+    def _expire(self):
+        """Fails waiters older than reply_timeout and forgets them after
+        twice that time.
+        """
+        now = time.perf_counter()
+        expired = []
+        with self._lock:
+            for waiter in self._pending:
+                if now - waiter.sent_at < self.reply_timeout:
+                    break
+                if not waiter.expired:
+                    waiter.expired = True
+                    expired.append(waiter)
+            while self._pending and now - self._pending[0].sent_at >= \
+                    self.reply_timeout * 2:
+                self._pending.popleft()
+        for waiter in expired:
+            self._counters['timeouts'] += 1
+            if not waiter.future.done():
+                waiter.future.set_exception(
+                    TimeoutError(f"No reply to '{waiter.msg}'."))
+
+    def metrics(self):
+        """Returns throughput and contention counters.
+
+        Returns:
+            res (dict) : written, replies, late, unsolicited, timeouts and
+            errors counters, queue wait (total, max), max queue depth,
+            mean reply latency and the manager's lock statistics.
+        """
+        with self._lock:
+            res = dict(self._counters)
+            replies = res.get('replies', 0)
+            res.update({'queue_wait': self._queue_wait,
+                        'max_queue_wait': self._max_queue_wait,
+                        'max_queue_depth': self._max_depth,
+                        'mean_reply_time': self._reply_time / replies
+                        if replies else 0.0,
+                        'pending': len(self._pending)})
+        for name in ('send_lock', 'recv_lock'):
+            lock = getattr(self.manager, name, None)
+            if lock is not None:
+                res[name] = lock.stats()
+        return res
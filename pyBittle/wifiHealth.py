@@ -0,0 +1,142 @@
+"""This module monitors WiFi connection health.
+
+HealthStatus holds the result of a WifiManager health check, and
+WifiHealthMonitor runs those checks periodically in background, publishing
+reachability and latency to subscribers, so callers can poll liveness
+without sending requests to Bittle's ESP8266 themselves.
+"""
+
+import threading
+import time
+
+
+__author__ = "EnriqueMoran"
+
+
+class HealthStatus:
+    """Result of a health check.
+
+    Attributes
+    ----------
+    reachable : bool
+        Whether Bittle's REST API answered.
+    status_code : int
+        HTTP response code, -1 if unreachable, None for TCP probes.
+    latency : float
+        Check duration (seconds), None if unreachable.
+    checked_at : float
+        time.monotonic() of the check.
+    probe : str
+        Probe used: 'head', 'get', 'tcp' or 'send' (result of a command).
+    """
+
+    __slots__ = ('reachable', 'status_code', 'latency', 'checked_at',
+                 'probe')
+
+    def __init__(self, reachable, status_code, latency, probe,
+                 checked_at=None):
+        self.reachable = reachable
+        self.status_code = status_code
+        self.latency = latency
+        self.probe = probe
+        self.checked_at = time.monotonic() if checked_at is None \
+            else checked_at
+
+    def __repr__(self):
+        return f"HealthStatus - reachable: {self.reachable}, status_code: " \
+               f"{self.status_code}, latency: {self.latency}, probe: " \
+               f"{self.probe}, age: {self.age:.3f}"
+
+    @property
+    def age(self):
+        return time.monotonic() - self.checked_at
+
+
+class WifiHealthMonitor:
+    """Checks a WifiManager health periodically in background.
+
+    Attributes
+    ----------
+    manager : WifiManager
+        Manager to check.
+    interval : float
+        Seconds between checks.
+    status : HealthStatus
+        Last check result, None until first check.
+
+    Methods
+    -------
+    start():
+        Starts checking in background.
+    stop():
+        Stops checking.
+    subscribe(callback):
+        Calls callback(status) after every check.
+    unsubscribe(callback):
+        Stops calling callback.
+    """
+
+    def __init__(self, manager, interval=5.0):
+        if not (isinstance(interval, (int, float)) and interval > 0):
+            raise TypeError("Interval must be number, greater than 0.")
+        self.manager = manager
+        self.interval = interval
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f"WifiHealthMonitor - interval: {self.interval}, status: " \
+               f"{self.status}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def status(self):
+        return self.manager.health
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def subscribe(self, callback):
+        """Calls callback(status) after every check (from the monitor
+        thread).
+        """
+        self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self._subscribers = [subscriber for subscriber in self._subscribers
+                             if subscriber != callback]
+
+    def start(self):
+        """Starts checking in background.
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="pyBittle-wifi-health",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops checking.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Recent command results count as checks, do not repeat them
+            status = self.manager.check_health(max_age=self.interval)
+            for subscriber in self._subscribers:
+                subscriber(status)
+            self._stop.wait(max(self.interval - status.age, 0.0))
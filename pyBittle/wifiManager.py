@@ -4,8 +4,16 @@ WifiManager allows sending commands to Bittle by using the ESP8266 REST API.
 """
 
 import ipaddress
+import socket
+import threading
+import time
+
 import requests
 
+from pyBittle.tracing import tracer
+from pyBittle.wifiHealth import HealthStatus
+from pyBittle.writeBatcher import MSG_DELIMITER
+
 
 __author__ = "EnriqueMoran"
 
@@ -19,6 +27,20 @@ class WifiManager:
         Bittle's ip address.
     http_address : str
         Bittle's REST API address.
+    session : requests.Session
+        Pooled HTTP connection used for every request.
+    health_ttl : float
+        Seconds a health check result is reused (0 disables caching).
+    probe : str
+        Health check probe: 'head' (HEAD actionpage request), 'get' (GET
+        actionpage request) or 'tcp' (TCP connection to HTTP port).
+    timeout : float
+        Request timeout (seconds).
+    health : HealthStatus
+        Last health check result, None if not checked yet.
+    write_batcher : WriteBatcher
+        If set, messages sent close together are sent in a single request.
+        None by default.
 
     Methods
     -------
@@ -26,13 +48,30 @@ class WifiManager:
         Returns REST API actionpage request response code.
     has_connection():
         Returns True if there is connection to REST API, False otherwise.
+    check_health(max_age=None):
+        Returns a cached or new HealthStatus.
     send_msg(msg):
         Sends a message to Bittle.
+    close():
+        Closes pooled connections, also done when used as a context manager.
     """
 
     def __init__(self):
         self._ip = ""
         self._http_address = f""
+        self._health_ttl = 1.0
+        self._probe = 'head'
+        self._timeout = 5.0
+        self.session = requests.Session()
+        self.health = None
+        self.write_batcher = None
+        self._health_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def __repr__(self):
         return f"WifiManager - ip: {self.ip}, " \
@@ -58,6 +97,99 @@ class WifiManager:
     def http_address(self):
         return self._http_address
 
+    @property
+    def health_ttl(self):
+        return self._health_ttl
+
+    @health_ttl.setter
+    def health_ttl(self, new_ttl):
+        if isinstance(new_ttl, (int, float)) and new_ttl >= 0:
+            self._health_ttl = new_ttl
+        else:
+            raise TypeError("Health TTL must be positive int or float.")
+
+    @property
+    def probe(self):
+        return self._probe
+
+    @probe.setter
+    def probe(self, new_probe):
+        if new_probe in ('head', 'get', 'tcp'):
+            self._probe = new_probe
+        else:
+            raise TypeError("Probe must be 'head', 'get' or 'tcp'.")
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, new_timeout):
+        if isinstance(new_timeout, (int, float)) and new_timeout > 0:
+            self._timeout = new_timeout
+        else:
+            raise TypeError("Timeout must be int or float, greater than 0.")
+
+    def close(self):
+        """Closes pooled connections, sending queued messages first.
+        """
+        try:
+            if self.write_batcher is not None:
+                self.write_batcher.flush()
+        finally:
+            self.session.close()
+
+    def _probe_health(self):
+        """Runs self.probe against Bittle's REST API.
+
+        Returns:
+            status (HealthStatus) : Check result.
+        """
+        start = time.perf_counter()
+        try:
+            if self.probe == 'tcp':
+                with socket.create_connection((self.ip, 80), self.timeout):
+                    status_code = None
+            else:
+                status_code = self._request_actionpage(self.probe == 'head')
+        except:
+            return HealthStatus(False, -1, None, self.probe)
+        return HealthStatus(True, status_code, time.perf_counter() - start,
+                            self.probe)
+
+    def _request_actionpage(self, head):
+        """Returns actionpage request response code, falling back to GET if
+        HEAD is not supported.
+        """
+        http_address = self.http_address + "actionpage"
+        if head:
+            response = self.session.head(http_address, timeout=self.timeout)
+            if response.status_code not in (405, 501):
+                return response.status_code
+        return self.session.get(http_address,
+                                timeout=self.timeout).status_code
+
+    def check_health(self, max_age=None):
+        """Returns the last health check result if it is recent enough,
+        otherwise checks again. Concurrent callers share the same check.
+
+        Parameters:
+            max_age (float) : Maximum age of a reused result (seconds),
+            self.health_ttl if None.
+
+        Returns:
+            status (HealthStatus) : Check result.
+        """
+        max_age = self.health_ttl if max_age is None else max_age
+        health = self.health
+        if health is not None and health.age <= max_age:
+            return health
+        with self._health_lock:
+            health = self.health  # May have been checked while waiting
+            if health is None or health.age > max_age:
+                health = self.health = self._probe_health()
+        return health
+
     def get_status_code(self):
         """Returns Action Page request response.
 
@@ -65,13 +197,12 @@ class WifiManager:
             res (int) : Action Page request response code, -1 if
             there is no connection.
         """
-        res = -1
-        http_address = self.http_address + "actionpage"
-        try:
-            response = requests.get(http_address)
-            res = response.status_code
-        except:
-            pass
+        res = self.check_health().status_code
+        if res is None:  # TCP probe result, no HTTP response code
+            try:
+                res = self._request_actionpage(head=False)
+            except:
+                res = -1
         return res
 
     def has_connection(self):
@@ -82,15 +213,8 @@ class WifiManager:
             res (bool) : True if there is connection with REST API,
             False otherwise.
         """
-        res = False
-        http_address = self.http_address + "actionpage"
-        try:
-            response = requests.get(http_address)
-            if response.status_code == 200:
-                res = True
-        except:
-            pass
-        return res
+        health = self.check_health()
+        return health.reachable and health.status_code in (200, None)
 
     def send_msg(self, msg):
         """Sends a message to Bittle. Returns request response (int).
@@ -100,17 +224,49 @@ class WifiManager:
 
         Returns:
             status_code (int) : Request response code, -1 if there is no
-            connection with REST API.
+            connection with REST API; True if queued in self.write_batcher
+            (its failures are raised by the next send and reported to the
+            batcher's failure_callbacks).
         """
-        res = -1
         if isinstance(msg, str) and msg:
-            query = {'name': msg}
-            http_address = self.http_address + "action"
-            try:
-                response = requests.get(http_address, params=query)
-                res = response.status_code
-            except:
-                pass
-            return res
+            if self.write_batcher is not None:
+                self.write_batcher.queue(self._send, msg)
+                return True
+            return self._send(msg.encode(), msg)
         else:
             raise TypeError("Message must be non empty str.")
+
+    def _send(self, data, msg=None, batch=None):
+        """Sends msg in an action request; batch is [(msg, size, trace)] of
+        the messages packed in data by self.write_batcher, sent together in
+        a single request (separated by newlines, the last one unterminated
+        as a message sent alone), None if data is msg alone. Returns the
+        request response code, -1 if there is no connection with REST API.
+        """
+        res = -1
+        if batch is None:
+            trace = tracer.current() if tracer.enabled else None
+            traces = () if trace is None else (trace,)
+            span = 'encode'
+        else:
+            msg = data.decode()[:-len(MSG_DELIMITER)]
+            traces = [trace for _, _, trace in batch if trace is not None]
+            span = 'enqueue'  # Encoded when queued, waited for the batch
+        query = {'name': msg}
+        http_address = self.http_address + "action"
+        for trace in traces:
+            trace.lap(span)
+        start = time.perf_counter()
+        try:
+            response = self.session.get(http_address, params=query,
+                                        timeout=self.timeout)
+            res = response.status_code
+        except:
+            pass
+        for trace in traces:  # The response is Bittle's reply
+            trace.lap('write')
+            trace.finish()
+        # Command results are free health checks
+        self.health = HealthStatus(res != -1, res, time.perf_counter() -
+                                   start if res != -1 else None, 'send')
+        return res
@@ -0,0 +1,245 @@
+"""This module coalesces the commands sent in a burst into single writes.
+
+A control loop tick often sends several commands at once (gait, direction,
+head angles...), each of them a write() / send() syscall, or a whole HTTP
+request over WiFi. A manager with a WriteBatcher set (its write_batcher
+attribute) queues messages instead of writing them: a background thread
+writes every message queued within window microseconds of the first one as
+a single write. Batched messages are terminated by a newline (frame_msg(),
+OpenCat ends a token at a newline) so the robot still parses them one by
+one; this is the only change on the wire, messages sent without a
+WriteBatcher are written as they are.
+
+A batch is written earlier if it reaches max_bytes, when flush() is called,
+before the manager reads (a reply can't arrive before its message is
+written), before send_raw() and before closing the connection. Flow
+control and round-trip time estimation still account every message.
+
+Writes made by the background thread can't raise to the sender: the error
+is kept and raised by the next queue() or flush(), and failure_callbacks
+are called (e.g. a Bittle's StateCache.invalidate, as the messages it
+tracked were not sent).
+"""
+
+import threading
+import time
+
+from pyBittle.tracing import tracer
+
+
+__author__ = "EnriqueMoran"
+
+
+MSG_DELIMITER = b'\n'  # Message terminator
+
+
+def frame_msg(msg):
+    """Returns msg encoded and terminated by MSG_DELIMITER, as batched
+    messages are written.
+    """
+    data = msg.encode()
+    return data if data.endswith(MSG_DELIMITER) else data + MSG_DELIMITER
+
+
+class WriteBatcher:
+    """Queues messages and writes those sent close together at once.
+
+    Managers call queue() with their send function; send(data, batch=...)
+    must write data in a single write, batch being [(msg, size, trace)] of
+    the messages packed in it.
+
+    Attributes
+    ----------
+    window : float
+        Microseconds a batch waits for more messages after its first one.
+    max_bytes : int
+        Batch size written without waiting for the window, None for no
+        limit.
+    failure_callbacks : set
+        Called without arguments when a batch is not sent (its write raised,
+        was dropped by flow control or got an HTTP error over WiFi).
+    commands : int
+        Messages queued.
+    writes : int
+        Batches written (write syscalls, or HTTP requests over WiFi).
+    bytes_written : int
+        Bytes written.
+    dropped : int
+        Messages of batches dropped by the manager's flow control.
+    failed : int
+        Messages of batches whose write raised or got an HTTP error.
+
+    Methods
+    -------
+    queue(send, msg):
+        Queues a message to be written with send.
+    flush():
+        Writes queued messages now.
+    close():
+        Writes queued messages and stops the background thread.
+    stats():
+        Returns message and write counters.
+    reset():
+        Resets counters.
+    """
+
+    def __init__(self, window=500, max_bytes=None):
+        if not (isinstance(window, (int, float)) and window >= 0):
+            raise TypeError("Window must be positive int or float.")
+        if not (max_bytes is None or (isinstance(max_bytes, int) and
+                                      max_bytes > 0)):
+            raise TypeError("Max bytes must be int, greater than 0.")
+        self.window = window
+        self.max_bytes = max_bytes
+        self.failure_callbacks = set()
+        self.error = None
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()  # Keeps batches in order
+        self._pending = []  # [(send, data, msg, trace)]
+        self._size = 0
+        self._deadline = None
+        self._thread = None
+        self._closed = False
+        self.reset()
+
+    def __repr__(self):
+        return f"WriteBatcher - window: {self.window} us, max_bytes: " \
+               f"{self.max_bytes}, pending: {len(self._pending)}"
+
+    def reset(self):
+        """Resets counters.
+        """
+        self.commands = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def stats(self):
+        """Returns {'commands', 'writes', 'bytes_written', 'dropped',
+        'failed', 'commands_per_write'}.
+        """
+        with self._condition:
+            return {'commands': self.commands, 'writes': self.writes,
+                    'bytes_written': self.bytes_written,
+                    'dropped': self.dropped, 'failed': self.failed,
+                    'commands_per_write': self.commands / self.writes
+                    if self.writes else 0.0}
+
+    def queue(self, send, msg):
+        """Queues a message, written with send within self.window.
+
+        Parameters:
+            send (callable) : Manager's send function.
+            msg (str) : Message to send.
+        """
+        trace = tracer.current() if tracer.enabled else None
+        data = frame_msg(msg)
+        if trace is not None:
+            trace.lap('encode')
+        with self._condition:
+            self._raise_error()
+            if self._closed:
+                raise RuntimeError("Write batcher is closed.")
+            if not self._pending:
+                self._deadline = time.perf_counter() + self.window / 1e6
+                self._condition.notify()
+            self._pending.append((send, data, msg, trace))
+            self._size += len(data)
+            self.commands += 1
+            full = self.max_bytes is not None and \
+                self._size >= self.max_bytes
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Writes queued messages now, raising the error of a failed
+        background write if any.
+        """
+        with self._condition:
+            self._raise_error()
+        self._flush()
+
+    def close(self):
+        """Writes queued messages and stops the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        """Background thread: writes every batch once its window ends.
+        """
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                delay = self._deadline - time.perf_counter()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+            try:
+                self._flush()
+            except Exception as err:
+                with self._condition:
+                    self.error = err
+
+    def _flush(self):
+        """Writes queued messages, one write per run of messages queued
+        with the same send function.
+        """
+        with self._write_lock:
+            with self._condition:
+                pending = self._pending
+                if not pending:
+                    return
+                self._pending = []
+                self._size = 0
+            start = 0
+            while start < len(pending):
+                send = pending[start][0]
+                end = start + 1
+                while end < len(pending) and pending[end][0] == send:
+                    end += 1
+                batch = pending[start:end]
+                data = b''.join(part for _, part, _, _ in batch)
+                try:
+                    res = send(data, batch=[(msg, len(part), trace)
+                                            for _, part, msg, trace in batch])
+                except BaseException:
+                    with self._condition:
+                        self.failed += len(pending) - start
+                    self._failed()
+                    raise
+                with self._condition:
+                    if res is False:
+                        self.dropped += len(batch)
+                    else:
+                        self.writes += 1
+                        self.bytes_written += len(data)
+                        if res is not True and res != 200:  # HTTP error
+                            self.failed += len(batch)
+                if res is not True and res != 200:
+                    self._failed()
+                start = end
+
+    def _failed(self):
+        """Calls self.failure_callbacks.
+        """
+        for callback in list(self.failure_callbacks):
+            callback()
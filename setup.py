@@ -21,6 +21,7 @@ setup(
     author='EnriqueMoran',
     author_email='enriquemoran95@gmail.com',
     install_requires=['pybluez', 'pyserial', 'requests'],
+    extras_require={'sim': ['numpy']},
     packages=find_packages(),
     zip_safe=False,
 )